@@ -14,6 +14,14 @@ done
 
 echo "Run flask migrations..."
 flask db upgrade
-echo "Starting flask server..."
-gunicorn --bind 0.0.0.0:5000 wsgi:app --workers=4 --timeout=120 --log-level=debug
+# SERVER_MODE=asgi serves the async (Quart) app, see asgi.py
+if [ "${SERVER_MODE:-wsgi}" = "asgi" ]; then
+  echo "Starting ASGI server..."
+  gunicorn --bind 0.0.0.0:5000 asgi:app --workers="${GUNICORN_WORKERS:-4}" \
+    --worker-class=uvicorn.workers.UvicornWorker --timeout=120 --log-level="${GUNICORN_LOG_LEVEL:-info}"
+else
+  # the worker model, preloading and warm-up are set by the GUNICORN_* variables, see gunicorn.conf.py
+  echo "Starting flask server (${GUNICORN_WORKER_CLASS:-gthread} workers)..."
+  gunicorn -c gunicorn.conf.py wsgi:app
+fi
 echo "Done!"
@@ -0,0 +1,4 @@
+import os
+from src.aio import create_async_app
+
+app = create_async_app(os.environ.get('FLASK_ENV', 'default'))
@@ -0,0 +1,5 @@
+import os
+from dotenv import load_dotenv
+
+# like pytest, fall back to the development settings when no .env file is present
+load_dotenv(os.path.join(os.path.dirname(__file__), '../.env.dev'))
@@ -0,0 +1,33 @@
+"""Micro-benchmark: per-payment cost of building the SecurityCredential.
+
+Compares re-reading the certificate and re-running RSA on every payment
+(`MPESA.rsa_encrypt`) with the cached `CredentialProvider`.
+
+    $ python -m benchmarks.bench_credential [iterations]
+"""
+import os
+import sys
+import tempfile
+import timeit
+from Crypto.PublicKey import RSA
+from src import create_app
+from src.api_1_0.helpers.credential import CredentialProvider
+from src.api_1_0.helpers.mpesa import MPESA
+
+
+def main(iterations: int = 1000) -> None:
+    app = create_app('testing')
+    with tempfile.TemporaryDirectory() as tmp, app.app_context():
+        certificate = os.path.join(tmp, 'key.cer')
+        with open(certificate, 'wb') as f:
+            f.write(RSA.generate(2048).publickey().export_key())
+        provider = CredentialProvider('password', certificate)
+        before = timeit.timeit(lambda: MPESA.rsa_encrypt('password', certificate), number=iterations)
+        after = timeit.timeit(provider.get_credential, number=iterations)
+    print(f'rsa_encrypt per call:            {before / iterations * 1e6:10.1f} µs')
+    print(f'CredentialProvider per call:     {after / iterations * 1e6:10.1f} µs')
+    print(f'speed-up:                        {before / after:10.0f}x')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -0,0 +1,46 @@
+"""Benchmark: latency of Daraja calls over new connections vs. the pooled transport.
+
+Runs against the local Daraja stub, so the numbers are the connection set-up
+overhead only (over TLS, the difference is considerably larger).
+
+    $ python -m benchmarks.bench_transport [iterations]
+"""
+import statistics
+import sys
+import time
+from typing import Callable, List
+import requests
+from benchmarks.daraja_stub import start_stub
+from src.api_1_0.helpers.transport import Transport
+
+
+def measure(call: Callable[[], requests.Response], iterations: int) -> List[float]:
+    """Times each call, in milliseconds."""
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        call().json()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def report(name: str, timings: List[float]) -> None:
+    timings = sorted(timings)
+    print(f'{name:<24} p50 {statistics.median(timings):7.3f} ms | '
+          f'p95 {timings[int(len(timings) * 0.95) - 1]:7.3f} ms | mean {statistics.mean(timings):7.3f} ms')
+
+
+def main(iterations: int = 500) -> None:
+    server, base_url = start_stub()
+    url, payload = f'{base_url}/mpesa/b2b/v1/remittax', {'Amount': 100, 'AccountReference': 'bench'}
+    transport = Transport()
+    try:
+        report('new connection', measure(lambda: requests.post(url=url, json=payload), iterations))
+        report('pooled keep-alive', measure(lambda: transport.post(url=url, json=payload), iterations))
+    finally:
+        transport.close()
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
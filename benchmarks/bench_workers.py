@@ -0,0 +1,164 @@
+"""Benchmark: the gunicorn worker models (sync, gthread, gevent) on I/O-bound payment traffic.
+
+Serves the app with `gunicorn -c gunicorn.conf.py` once per worker class, against the
+local Daraja stub (whose latency stands in for Daraja's), and drives `/payment/initiate`
+with `--concurrency` clients. Needs gunicorn (and gevent for the gevent workers).
+
+    $ python -m benchmarks.bench_workers --requests 2000 --concurrency 64 --latency 0.2
+    $ python -m benchmarks.bench_workers --worker-classes gthread,gevent --workers 2 --threads 16
+"""
+import argparse
+import importlib.util
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+import requests
+from benchmarks.daraja_stub import StubOptions, start_stub
+from benchmarks.load_test import free_port, percentile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--worker-classes', default='sync,gthread,gevent')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=8, help='threads per gthread worker')
+    parser.add_argument('--worker-connections', type=int, default=1000, help='connections per gevent worker')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--latency', type=float, default=0.2, help='Daraja stub latency, in seconds')
+    parser.add_argument('--jitter', type=float, default=0.02)
+    parser.add_argument('--database-uri', help='defaults to a temporary SQLite database per worker class')
+    parser.add_argument('--startup-timeout', type=float, default=30.0, help='seconds to wait for gunicorn')
+    return parser.parse_args(argv)
+
+
+def environment(args: argparse.Namespace, workdir: str, stub_url: str, port: int,
+                worker_class: str) -> Dict[str, str]:
+    """Returns the environment of the app served with the worker class."""
+    env = dict(os.environ)
+    env.update(
+        FLASK_ENV='testing',
+        SQLALCHEMY_DATABASE_URI_TEST=args.database_uri or f'sqlite:///{workdir}/{worker_class}.db',
+        B2B_BASE_URL=stub_url,
+        BASE_URL=f'http://127.0.0.1:{port}/api/v1.0',
+        # the config looks the certificate up in config/cert/
+        SSL_CERT=os.path.relpath(os.path.join(workdir, 'key.cer'), os.path.join(ROOT, 'config', 'cert')),
+        ACCESS_TOKEN_CACHE_FILE=os.path.join(workdir, f'{worker_class}-token.json'),
+        DARAJA_TPS='100000', DARAJA_BURST='100000',
+        LOG_LEVEL='CRITICAL',
+        GUNICORN_BIND=f'127.0.0.1:{port}',
+        GUNICORN_WORKER_CLASS=worker_class,
+        GUNICORN_WORKERS=str(args.workers),
+        GUNICORN_THREADS=str(args.threads),
+        GUNICORN_WORKER_CONNECTIONS=str(args.worker_connections),
+        GUNICORN_LOG_LEVEL='warning',
+        GUNICORN_GRACEFUL_TIMEOUT='5'
+    )
+    return env
+
+
+def prepare(env: Dict[str, str], workdir: str) -> None:
+    """Creates the certificate and the tables, in a separate process (the config is read from the environment)."""
+    script = (
+        'from Crypto.PublicKey import RSA\n'
+        f'open({os.path.join(workdir, "key.cer")!r}, "wb").write(RSA.generate(2048).publickey().export_key())\n'
+        'from src import create_app, db\n'
+        'app = create_app("testing")\n'
+        'with app.app_context():\n'
+        '    db.create_all()\n'
+    )
+    subprocess.run([sys.executable, '-c', script], env=env, cwd=ROOT, check=True)
+
+
+def wait_until_ready(base_url: str, process: subprocess.Popen, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'gunicorn exited with {process.returncode}')
+        try:
+            if requests.get(f'{base_url}/health', timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError('gunicorn did not start in time')
+
+
+def drive(base_url: str, args: argparse.Namespace) -> Dict[str, Any]:
+    """Sends the payments, returns the throughput and latency."""
+    session = requests.Session()
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency))
+
+    def send(_) -> tuple:
+        start = time.perf_counter()
+        try:
+            status = session.post(f'{base_url}/payment/initiate', json={'Amount': '100', 'pnr': uuid.uuid4().hex},
+                                  timeout=60).status_code
+        except requests.RequestException:
+            status = 0
+        return status, (time.perf_counter() - start) * 1000
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(send, range(args.requests)))
+    elapsed = time.perf_counter() - started
+    timings = sorted(t for _, t in results)
+    return {
+        'rps': round(len(results) / elapsed, 1),
+        'p50': round(percentile(timings, 50), 1),
+        'p95': round(percentile(timings, 95), 1),
+        'p99': round(percentile(timings, 99), 1),
+        'mean': round(statistics.mean(timings), 1),
+        'errors': sum(1 for status, _ in results if status != 201)
+    }
+
+
+def bench(args: argparse.Namespace, worker_class: str, stub_url: str) -> Dict[str, Any]:
+    """Serves the app with the worker class, and drives it."""
+    workdir, port = tempfile.mkdtemp(prefix=f'mpesa-b2b-{worker_class}-'), free_port()
+    env = environment(args, workdir, stub_url, port, worker_class)
+    prepare(env, workdir)
+    process = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'wsgi:app'],
+                               env=env, cwd=ROOT)
+    base_url = env['BASE_URL']
+    try:
+        wait_until_ready(base_url, process, args.startup_timeout)
+        return drive(base_url, args)
+    finally:
+        process.terminate()
+        process.wait(30)
+
+
+def main(argv: List[str] = None) -> int:
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    if importlib.util.find_spec('gunicorn') is None:
+        print('gunicorn is not installed.', file=sys.stderr)
+        return 1
+    stub, stub_url = start_stub(options=StubOptions(latency=args.latency, jitter=args.jitter))
+    print(f'{args.requests} payments, concurrency {args.concurrency}, {args.workers} workers, '
+          f'Daraja latency {args.latency * 1000:.0f}ms')
+    print(f"{'worker class':<14}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'mean ms':>9}{'errors':>8}")
+    try:
+        for worker_class in args.worker_classes.split(','):
+            if worker_class == 'gevent' and importlib.util.find_spec('gevent') is None:
+                print(f'{worker_class:<14}skipped, gevent is not installed')
+                continue
+            report = bench(args, worker_class, stub_url)
+            label = f'{worker_class} x{args.threads}' if worker_class == 'gthread' else worker_class
+            print(f"{label:<14}{report['rps']:>9}{report['p50']:>9}{report['p95']:>9}{report['p99']:>9}"
+                  f"{report['mean']:>9}{report['errors']:>8}")
+    finally:
+        stub.shutdown()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
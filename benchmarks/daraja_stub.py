@@ -0,0 +1,188 @@
+"""A local stand-in for the Daraja OAuth, B2B and Transaction Status APIs, including the result callbacks.
+
+Latency, error rate, throttling and the result callbacks are configurable, so the
+wrapper can be benchmarked (or load-tested) without Safaricom's sandbox.
+
+    $ python -m benchmarks.daraja_stub --port 8080 --latency 0.2 --error-rate 0.05 --tps 50
+"""
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from typing import Any, Dict, Tuple
+import requests
+
+
+@dataclass
+class StubOptions:
+    """How the stub behaves."""
+    latency: float = 0.0  # seconds added to every response
+    jitter: float = 0.0  # +/- seconds, uniformly distributed
+    error_rate: float = 0.0  # share of B2B requests rejected with an errorCode
+    tps: float = 0.0  # B2B requests per second before throttling kicks in, 0 to disable
+    callback_delay: float = -1.0  # seconds before the result callback is sent, negative to disable
+    callback_failure_rate: float = 0.0  # share of result callbacks with a non-zero ResultCode
+    token_ttl: int = 3599
+    counters: Dict[str, int] = field(default_factory=dict)
+
+
+class DarajaStubHandler(BaseHTTPRequestHandler):
+    """Answers the Daraja endpoints used by the wrapper."""
+    # keep connections alive, like the real API does
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    options = StubOptions()
+    _lock = threading.Lock()
+    _window = [0.0, 0]  # start of the current 1s throttling window, requests in it
+
+    def do_GET(self):
+        if self.path.startswith('/oauth/v1/generate'):
+            self._count('oauth')
+            return self._reply({'access_token': 'stub-token', 'expires_in': str(self.options.token_ttl)})
+        self._reply({'errorMessage': 'not found'}, status=404)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path == '/mpesa/transactionstatus/v1/query':
+            return self._transaction_status(json.loads(body or b'{}'))
+        if self.path != '/mpesa/b2b/v1/remittax':
+            return self._reply({'errorMessage': 'not found'}, status=404)
+        self._count('remittax')
+        if self._throttled():
+            self._count('throttled')
+            return self._reply({'requestId': uuid.uuid4().hex, 'errorCode': '500.003.02',
+                                'errorMessage': 'Spike arrest violation'}, status=429)
+        if random.random() < self.options.error_rate:
+            self._count('errors')
+            return self._reply({'requestId': uuid.uuid4().hex, 'errorCode': '500.001.1001',
+                                'errorMessage': 'Unable to process the request.'})
+        response = {
+            'ConversationID': f'AG_{uuid.uuid4().hex}',
+            'OriginatorConversationID': uuid.uuid4().hex,
+            'ResponseCode': '0',
+            'ResponseDescription': 'Accept the service request successfully.'
+        }
+        self._reply(response)
+        if self.options.callback_delay >= 0:
+            payload = json.loads(body or b'{}')
+            timer = threading.Timer(self.options.callback_delay, send_callback,
+                                    args=(self.options, payload, response))
+            timer.daemon = True
+            timer.start()
+
+    def _transaction_status(self, payload: Dict[str, Any]) -> None:
+        """Accepts a status query, and delivers the (completed) status to its ResultURL."""
+        self._count('transaction_status')
+        self._reply({'ConversationID': f'AG_{uuid.uuid4().hex}', 'OriginatorConversationID': uuid.uuid4().hex,
+                     'ResponseCode': '0', 'ResponseDescription': 'Accept the service request successfully.'})
+        if self.options.callback_delay >= 0:
+            result = {
+                'Result': {
+                    'ResultType': 0,
+                    'ResultCode': 0,
+                    'ResultDesc': 'The service request is processed successfully.',
+                    'ResultParameters': {'ResultParameter': [{'Key': 'TransactionStatus', 'Value': 'Completed'}]},
+                    'ReferenceData': {'ReferenceItem': {'Key': 'Occasion', 'Value': payload.get('Occasion')}}
+                }
+            }
+            timer = threading.Timer(self.options.callback_delay, deliver, args=(self.options, payload, result))
+            timer.daemon = True
+            timer.start()
+
+    def _throttled(self) -> bool:
+        """Whether the request goes over the configured TPS."""
+        if self.options.tps <= 0:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            if now - self._window[0] >= 1:
+                self._window[0], self._window[1] = now, 0
+            self._window[1] += 1
+            return self._window[1] > self.options.tps
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.options.counters[name] = self.options.counters.get(name, 0) + 1
+
+    def _reply(self, body: dict, status: int = 200) -> None:
+        delay = self.options.latency + random.uniform(-self.options.jitter, self.options.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass  # keep the benchmark output readable
+
+
+def send_callback(options: StubOptions, payload: Dict[str, Any], response: Dict[str, str]) -> None:
+    """Delivers the result of a B2B request to its ResultURL, like Daraja does."""
+    failed = random.random() < options.callback_failure_rate
+    deliver(options, payload, {
+        'Result': {
+            'ResultType': 0,
+            'ResultCode': 2001 if failed else 0,
+            'ResultDesc': 'The initiator information is invalid.' if failed
+            else 'The service request is processed successfully.',
+            'OriginatorConversationID': response['OriginatorConversationID'],
+            'ConversationID': response['ConversationID'],
+            'TransactionID': uuid.uuid4().hex[:10].upper()
+        }
+    })
+
+
+def deliver(options: StubOptions, payload: Dict[str, Any], result: Dict[str, Any]) -> None:
+    """Posts a result to the ResultURL of the request."""
+    try:
+        requests.post(payload['ResultURL'], json=result, timeout=10)
+        key = 'callbacks'
+    except (KeyError, requests.RequestException):
+        key = 'callback_errors'
+    with DarajaStubHandler._lock:
+        options.counters[key] = options.counters.get(key, 0) + 1
+
+
+def start_stub(host: str = '127.0.0.1', port: int = 0,
+               options: StubOptions = None) -> Tuple[ThreadingHTTPServer, str]:
+    """Starts the stub in a background thread, returns the server and its base URL."""
+    handler = type('ConfiguredDarajaStubHandler', (DarajaStubHandler,), {'options': options or StubOptions()})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://{host}:{server.server_address[1]}'
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='+/- seconds of latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of rejected B2B requests')
+    parser.add_argument('--tps', type=float, default=0.0, help='B2B requests per second before throttling')
+    parser.add_argument('--callback-delay', type=float, default=-1.0,
+                        help='seconds before the result callback is sent (negative to disable)')
+    parser.add_argument('--callback-failure-rate', type=float, default=0.0)
+    args = parser.parse_args(argv)
+    options = StubOptions(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, tps=args.tps,
+                          callback_delay=args.callback_delay, callback_failure_rate=args.callback_failure_rate)
+    server, base_url = start_stub(port=args.port, options=options)
+    print(f'Daraja stub listening on {base_url}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+        print(json.dumps(options.counters))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,181 @@
+"""Load test of the full payment flow against the local Daraja stub.
+
+Serves the app in-process (or targets `--url`), drives `/payment/initiate` with
+`--concurrency` clients, lets the stub deliver the result callbacks to
+`/payment/confirm`, and reports latency percentiles, throughput and DB commits.
+
+    $ python -m benchmarks.load_test --requests 2000 --concurrency 32 --latency 0.1
+    $ python -m benchmarks.load_test --replay payloads.jsonl --json --max-p95 250
+
+`--replay` reads one JSON payload per line: `{"Amount": .., "pnr": ..}` lines are
+sent to `/payment/initiate`, `{"Result": {..}}` lines to `/payment/confirm`.
+"""
+import argparse
+import json
+import logging
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+from typing import Any, Dict, Iterator, List, Tuple
+import requests
+from benchmarks.daraja_stub import StubOptions, start_stub
+
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=1000, help='number of payments (ignored with --replay)')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--replay', help='a file with one JSON payload per line')
+    parser.add_argument('--url', help='base URL of an already running app, e.g. http://127.0.0.1:5000/api/v1.0')
+    parser.add_argument('--database-uri', help='defaults to a temporary SQLite database')
+    parser.add_argument('--latency', type=float, default=0.05, help='Daraja stub latency, in seconds')
+    parser.add_argument('--jitter', type=float, default=0.01)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--tps', type=float, default=0.0, help='Daraja stub throttling threshold')
+    parser.add_argument('--daraja-tps', type=float, default=1000, help="the app's own DARAJA_TPS limit")
+    parser.add_argument('--callback-delay', type=float, default=0.5, help='negative to disable the callbacks')
+    parser.add_argument('--drain', type=float, default=5.0, help='seconds to wait for the last callbacks')
+    parser.add_argument('--log-level', default='CRITICAL', help="the app's log level (default: quiet)")
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    parser.add_argument('--max-p95', type=float, help='exit with an error if the p95 latency (ms) is higher')
+    parser.add_argument('--min-rps', type=float, help='exit with an error if the throughput is lower')
+    return parser.parse_args(argv)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def payloads(args: argparse.Namespace) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """Yields (route, payload) pairs, from the replay file or generated."""
+    if not args.replay:
+        for _ in range(args.requests):
+            yield 'payment/initiate', {'Amount': '100', 'pnr': uuid.uuid4().hex}
+        return
+    with open(args.replay) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            payload = json.loads(line)
+            if 'Result' in payload:
+                yield 'payment/confirm', payload
+            elif 'pnr' in payload or 'Amount' in payload:
+                yield 'payment/initiate', payload
+
+
+def serve_app(args: argparse.Namespace, stub_url: str) -> Tuple[str, Any, Counter]:
+    """Serves the app in-process, returns its base URL, the server and the DB commit counter."""
+    port, workdir = free_port(), tempfile.mkdtemp(prefix='mpesa-b2b-load-')
+    # the config is read from the environment when it's imported
+    os.environ['SQLALCHEMY_DATABASE_URI_TEST'] = args.database_uri or f"sqlite:///{workdir}/load.db"
+    os.environ['B2B_BASE_URL'] = stub_url
+    os.environ['BASE_URL'] = f'http://127.0.0.1:{port}/api/v1.0'
+    os.environ['DARAJA_TPS'] = os.environ['DARAJA_BURST'] = str(int(args.daraja_tps))
+    from Crypto.PublicKey import RSA
+    from sqlalchemy import event
+    from werkzeug.serving import make_server
+    from src import create_app, db
+    from src.api_1_0.helpers.credential import credential_provider
+
+    app = create_app('testing')
+    app.logger.setLevel(args.log_level)
+    logging.getLogger('werkzeug').setLevel(args.log_level)
+    certificate = os.path.join(workdir, 'key.cer')
+    with open(certificate, 'wb') as f:
+        f.write(RSA.generate(2048).publickey().export_key())
+    credential_provider.certificate_path = certificate
+    commits = Counter()
+    with app.app_context():
+        db.create_all()
+        event.listen(db.engine, 'commit', lambda conn: commits.update(['commits']))
+    server = make_server('127.0.0.1', port, app, threaded=True)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return os.environ['BASE_URL'], server, commits
+
+
+def percentile(timings: List[float], p: float) -> float:
+    return timings[min(len(timings) - 1, int(round(p / 100 * len(timings) + 0.5)) - 1)] if timings else 0.0
+
+
+def main(argv: List[str] = None) -> int:
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    options = StubOptions(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, tps=args.tps,
+                          callback_delay=args.callback_delay)
+    stub, stub_url = start_stub(options=options)
+    server, commits = None, Counter()
+    if args.url:
+        base_url = args.url
+    else:
+        base_url, server, commits = serve_app(args, stub_url)
+
+    session = requests.Session()
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency))
+
+    def send(item: Tuple[str, Dict[str, Any]]) -> Tuple[str, int, float]:
+        route, payload = item
+        start = time.perf_counter()
+        try:
+            status = session.post(f'{base_url}/{route}', json=payload, timeout=60).status_code
+        except requests.RequestException:
+            status = 0
+        return route, status, (time.perf_counter() - start) * 1000
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        results = list(executor.map(send, payloads(args)))
+    elapsed = time.perf_counter() - started
+    if args.callback_delay >= 0 and not args.replay:
+        time.sleep(min(args.drain, args.callback_delay + 1))
+
+    timings = sorted(t for route, _, t in results if route == 'payment/initiate')
+    report = {
+        'requests': len(results),
+        'concurrency': args.concurrency,
+        'seconds': round(elapsed, 3),
+        'rps': round(len(results) / elapsed, 1) if elapsed else 0.0,
+        'latency_ms': {
+            'p50': round(percentile(timings, 50), 2),
+            'p95': round(percentile(timings, 95), 2),
+            'p99': round(percentile(timings, 99), 2),
+            'max': round(timings[-1], 2) if timings else 0.0,
+            'mean': round(statistics.mean(timings), 2) if timings else 0.0
+        },
+        'status_codes': dict(Counter(f'{route} {status}' for route, status, _ in results)),
+        'db_commits': commits['commits'] if server else None,
+        'daraja_stub': dict(options.counters)
+    }
+    if server:
+        server.shutdown()
+    stub.shutdown()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(f"{report['requests']} requests, concurrency {args.concurrency}, {report['seconds']}s "
+              f"-> {report['rps']} req/s")
+        print('initiate latency (ms): ' + ' | '.join(f'{k} {v}' for k, v in report['latency_ms'].items()))
+        print(f"status codes: {report['status_codes']}")
+        print(f"DB commits: {report['db_commits']} | Daraja stub: {report['daraja_stub']}")
+
+    failed = []
+    if args.max_p95 is not None and report['latency_ms']['p95'] > args.max_p95:
+        failed.append(f"p95 {report['latency_ms']['p95']}ms > {args.max_p95}ms")
+    if args.min_rps is not None and report['rps'] < args.min_rps:
+        failed.append(f"{report['rps']} req/s < {args.min_rps} req/s")
+    if failed:
+        print('Performance regression: ' + ', '.join(failed), file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -15,13 +15,152 @@ class Config:
     DEBUG = False
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SQLALCHEMY_ENGINE_OPTIONS = {'pool_size': 10, 'pool_recycle': 299}
+    # read replicas (comma separated URIs) for the lookups and listings that tolerate replication lag,
+    # a PNR written by a worker is read from the primary for DB_READ_YOUR_WRITES_WINDOW seconds after
+    SQLALCHEMY_REPLICA_URIS = tuple(uri for uri in os.environ.get('SQLALCHEMY_REPLICA_URIS', '').split(',') if uri)
+    DB_READ_YOUR_WRITES_WINDOW = float(os.environ.get('DB_READ_YOUR_WRITES_WINDOW', 5))
     CERTIFICATE = CERTIFICATE_PATH
     TIME_ZONE = 'Africa/Nairobi'
+    # Daraja B2B details, all required (checked at startup, see `Settings`)
+    B2B_BASE_URL = os.environ.get('B2B_BASE_URL')
+    B2B_ACCESS_KEY = os.environ.get('B2B_ACCESS_KEY')
+    B2B_CONSUMER_SECRET = os.environ.get('B2B_CONSUMER_SECRET')
+    B2B_INITIATOR = os.environ.get('B2B_INITIATOR')
+    B2B_INITIATOR_PASSWORD = os.environ.get('B2B_INITIATOR_PASSWORD')
+    B2B_COMMAND_ID = os.environ.get('B2B_COMMAND_ID')
+    B2B_SHORT_CODE = os.environ.get('B2B_SHORT_CODE')
+    PAY_TAX_CODE = os.environ.get('PAY_TAX_CODE')
+    SENDER_IDENTIFIER_TYPE = os.environ.get('SENDER_IDENTIFIER_TYPE')
+    RECIEVER_IDENTIFIER_TYPE = os.environ.get('RECIEVER_IDENTIFIER_TYPE')
+    BASE_URL = os.environ.get('BASE_URL')  # where Daraja sends the results, e.g. https://example.com/api/v1.0
+    # the other shortcodes (tenants) served, a JSON file of config overrides per tenant (see `TenantRegistry`)
+    B2B_TENANTS_FILE = os.environ.get('B2B_TENANTS_FILE')
     TIME_FORMAT = '%Y%m%d%H%M%S'
     # Daraja/MPESA Status Codes
     MPESA_B2B_SUCCESS_CODE = '0'
     MPESA_B2B_FAILURE_CODE = '1'
     GENERIC_FAILURE_CODE = '999'
+    MPESA_INVALID_TOKEN_CODE = '404.001.03'
+    MPESA_THROTTLING_CODES = ('500.003.02', '429.001.01')  # spike arrest / quota violations
+    # Daraja OAuth access token caching
+    ACCESS_TOKEN_REFRESH_MARGIN = int(os.environ.get('ACCESS_TOKEN_REFRESH_MARGIN', 300))  # seconds
+    # set to a file path to share the token across (gunicorn) workers
+    ACCESS_TOKEN_CACHE_FILE = os.environ.get('ACCESS_TOKEN_CACHE_FILE')
+    # SecurityCredential caching, the certificate is re-checked (for rotation) every N seconds
+    CERTIFICATE_CHECK_INTERVAL = int(os.environ.get('CERTIFICATE_CHECK_INTERVAL', 60))
+    PRELOAD_SECURITY_CREDENTIAL = False
+    # what each gunicorn worker sets up before serving its first request (see gunicorn.conf.py)
+    WARMUP_DB_CONNECTIONS = int(os.environ.get('WARMUP_DB_CONNECTIONS', 2))  # at most the pool size
+    WARMUP_DARAJA_SECRETS = os.environ.get('WARMUP_DARAJA_SECRETS', 'true').lower() == 'true'  # token and credential
+    # HTTP client used for all Daraja calls (timeouts are in seconds)
+    HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 5))
+    HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 30))
+    HTTP_POOL_CONNECTIONS = int(os.environ.get('HTTP_POOL_CONNECTIONS', 4))  # number of hosts to keep pools for
+    HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', 10))  # connections kept alive per host
+    HTTP_MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', 2))
+    HTTP_RETRY_BACKOFF_FACTOR = float(os.environ.get('HTTP_RETRY_BACKOFF_FACTOR', 0.3))
+    # circuit breaker around the Daraja APIs (OAuth and B2B, each with its own circuit)
+    CIRCUIT_BREAKER_FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_BREAKER_FAILURE_THRESHOLD', 5))
+    CIRCUIT_BREAKER_RESET_TIMEOUT = float(os.environ.get('CIRCUIT_BREAKER_RESET_TIMEOUT', 30))  # seconds
+    # (adaptive) rate limit of B2B requests, per process, i.e. split Daraja's TPS across workers
+    DARAJA_TPS = float(os.environ.get('DARAJA_TPS', 10))
+    DARAJA_BURST = int(os.environ.get('DARAJA_BURST', 10))
+    DARAJA_MIN_TPS = float(os.environ.get('DARAJA_MIN_TPS', 1))
+    DARAJA_TPS_RECOVERY_STEP = float(os.environ.get('DARAJA_TPS_RECOVERY_STEP', 0.5))  # TPS regained per second
+    DARAJA_MAX_WAIT = float(os.environ.get('DARAJA_MAX_WAIT', 2))  # seconds a request may wait for its turn
+    # in-flight Daraja requests per process, for the ASGI app (see asgi.py)
+    ASYNC_HTTP_MAX_CONNECTIONS = int(os.environ.get('ASYNC_HTTP_MAX_CONNECTIONS', 500))
+    # write-behind persistence of B2B records
+    PERSISTENCE_QUEUE_SIZE = int(os.environ.get('PERSISTENCE_QUEUE_SIZE', 1000))
+    PERSISTENCE_BATCH_SIZE = int(os.environ.get('PERSISTENCE_BATCH_SIZE', 100))  # rows per INSERT/commit
+    PERSISTENCE_FLUSH_INTERVAL = float(os.environ.get('PERSISTENCE_FLUSH_INTERVAL', 0.5))  # seconds
+    PERSISTENCE_ENQUEUE_TIMEOUT = float(os.environ.get('PERSISTENCE_ENQUEUE_TIMEOUT', 1))  # seconds
+    # duplicate PNR guard, set PNR_GUARD_SQLITE_PATH to share reservations across workers
+    RECENT_PNR_CACHE_SIZE = int(os.environ.get('RECENT_PNR_CACHE_SIZE', 10000))
+    PNR_GUARD_SQLITE_PATH = os.environ.get('PNR_GUARD_SQLITE_PATH')
+    PNR_RESERVATION_TTL = int(os.environ.get('PNR_RESERVATION_TTL', 300))  # seconds
+    PNR_COMPLETED_TTL = int(os.environ.get('PNR_COMPLETED_TTL', 3600))  # seconds
+    # outbox mode: payments are saved as QUEUED and sent to Daraja by a background dispatcher
+    OUTBOX_MODE = os.environ.get('OUTBOX_MODE', 'false').lower() == 'true'
+    OUTBOX_POLL_INTERVAL = float(os.environ.get('OUTBOX_POLL_INTERVAL', 1))  # seconds
+    OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', 50))
+    OUTBOX_CONCURRENCY = int(os.environ.get('OUTBOX_CONCURRENCY', 4))  # concurrent Daraja calls
+    OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', 5))
+    OUTBOX_BACKOFF_BASE = float(os.environ.get('OUTBOX_BACKOFF_BASE', 2))  # seconds, grows exponentially
+    OUTBOX_BACKOFF_MAX = float(os.environ.get('OUTBOX_BACKOFF_MAX', 300))  # seconds
+    OUTBOX_LEASE = float(os.environ.get('OUTBOX_LEASE', 120))  # seconds a claimed payment is reserved for
+    # batch payment initiation (see /payment/initiate/batch)
+    BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 1000))
+    BATCH_MAX_CONCURRENCY = int(os.environ.get('BATCH_MAX_CONCURRENCY', 8))  # concurrent Daraja calls
+    # batched processing of Daraja result callbacks
+    CALLBACK_WORKERS = int(os.environ.get('CALLBACK_WORKERS', 2))
+    CALLBACK_QUEUE_SIZE = int(os.environ.get('CALLBACK_QUEUE_SIZE', 5000))
+    CALLBACK_BATCH_SIZE = int(os.environ.get('CALLBACK_BATCH_SIZE', 200))
+    CALLBACK_BATCH_WINDOW = float(os.environ.get('CALLBACK_BATCH_WINDOW', 0.2))  # seconds
+    CALLBACK_ENQUEUE_TIMEOUT = float(os.environ.get('CALLBACK_ENQUEUE_TIMEOUT', 1))  # seconds
+    # redelivered callbacks, acknowledged without being applied again
+    CALLBACK_DEDUP_SIZE = int(os.environ.get('CALLBACK_DEDUP_SIZE', 100000))  # queued results remembered
+    CALLBACK_DEDUP_TTL = float(os.environ.get('CALLBACK_DEDUP_TTL', 3600))  # seconds
+    CALLBACK_FINAL_CACHE_SIZE = int(os.environ.get('CALLBACK_FINAL_CACHE_SIZE', 100000))  # final payments remembered
+    CALLBACK_FINAL_CACHE_TTL = float(os.environ.get('CALLBACK_FINAL_CACHE_TTL', 3600))  # seconds
+    # set CALLBACK_JOURNAL_DIR to keep the raw callbacks (NDJSON), see `flask callbacks replay`
+    CALLBACK_JOURNAL_DIR = os.environ.get('CALLBACK_JOURNAL_DIR')
+    CALLBACK_JOURNAL_BUFFER_SIZE = int(os.environ.get('CALLBACK_JOURNAL_BUFFER_SIZE', 65536))  # bytes
+    # transactions API (see /transactions)
+    TRANSACTIONS_PAGE_SIZE = int(os.environ.get('TRANSACTIONS_PAGE_SIZE', 100))
+    TRANSACTIONS_MAX_PAGE_SIZE = int(os.environ.get('TRANSACTIONS_MAX_PAGE_SIZE', 1000))
+    TRANSACTIONS_EXPORT_YIELD_PER = int(os.environ.get('TRANSACTIONS_EXPORT_YIELD_PER', 1000))  # rows per fetch
+    # reconciliation of the PENDING payments whose result never came, with Daraja's Transaction Status API,
+    # those without conversation IDs are flagged as UNKNOWN instead (see `flask payments`)
+    RECONCILER_ENABLED = os.environ.get('RECONCILER_ENABLED', 'false').lower() == 'true'
+    RECONCILER_INTERVAL = float(os.environ.get('RECONCILER_INTERVAL', 300))  # seconds between passes
+    RECONCILER_STALE_AFTER = float(os.environ.get('RECONCILER_STALE_AFTER', 600))  # seconds without a result
+    RECONCILER_RETRY_INTERVAL = float(os.environ.get('RECONCILER_RETRY_INTERVAL', 1800))  # seconds between queries
+    RECONCILER_PAGE_SIZE = int(os.environ.get('RECONCILER_PAGE_SIZE', 500))  # payments claimed per transaction
+    RECONCILER_CONCURRENCY = int(os.environ.get('RECONCILER_CONCURRENCY', 4))  # concurrent Daraja calls
+    # webhooks, the final status of the payments initiated with a `callback_url` is pushed to it
+    WEBHOOKS_ENABLED = os.environ.get('WEBHOOKS_ENABLED', 'false').lower() == 'true'
+    WEBHOOK_POLL_INTERVAL = float(os.environ.get('WEBHOOK_POLL_INTERVAL', 1))  # seconds
+    WEBHOOK_BATCH_SIZE = int(os.environ.get('WEBHOOK_BATCH_SIZE', 200))  # deliveries claimed at once
+    WEBHOOK_MAX_BATCH = int(os.environ.get('WEBHOOK_MAX_BATCH', 50))  # notifications coalesced into one POST
+    WEBHOOK_CONCURRENCY = int(os.environ.get('WEBHOOK_CONCURRENCY', 4))  # concurrent POSTs (and pooled connections)
+    WEBHOOK_POOL_CONNECTIONS = int(os.environ.get('WEBHOOK_POOL_CONNECTIONS', 20))  # number of hosts to keep pools for
+    WEBHOOK_TIMEOUT = float(os.environ.get('WEBHOOK_TIMEOUT', 10))  # seconds to wait for a client's response
+    WEBHOOK_MAX_ATTEMPTS = int(os.environ.get('WEBHOOK_MAX_ATTEMPTS', 8))
+    WEBHOOK_BACKOFF_BASE = float(os.environ.get('WEBHOOK_BACKOFF_BASE', 2))  # seconds, grows exponentially
+    WEBHOOK_BACKOFF_MAX = float(os.environ.get('WEBHOOK_BACKOFF_MAX', 3600))  # seconds
+    WEBHOOK_LEASE = float(os.environ.get('WEBHOOK_LEASE', 60))  # seconds a claimed delivery is reserved for
+    # the only hosts (`.example.com` for its subdomains) a `callback_url` may point to, any public one if empty
+    WEBHOOK_ALLOWED_HOSTS = tuple(
+        host.strip().lower() for host in os.environ.get('WEBHOOK_ALLOWED_HOSTS', '').split(',') if host.strip())
+    # archival of the final (SUCCESS/FAILED) payments to 'mpesa_b2b_transactions_archive', see `flask archive run`
+    ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', 180))
+    ARCHIVE_CHUNK_SIZE = int(os.environ.get('ARCHIVE_CHUNK_SIZE', 1000))  # payments moved per transaction
+    ARCHIVE_CHUNK_PAUSE = float(os.environ.get('ARCHIVE_CHUNK_PAUSE', 0.1))  # seconds between chunks
+    # Bloom filter of the archived PNRs, so that the duplicate PNR check rarely queries the archive, shared by
+    # the workers (and the hosts), relative to the instance folder; empty to look every PNR up in the archive table
+    ARCHIVE_PNR_INDEX_PATH = os.environ.get('ARCHIVE_PNR_INDEX_PATH', 'archived-pnrs.bloom')
+    ARCHIVE_PNR_INDEX_CAPACITY = int(os.environ.get('ARCHIVE_PNR_INDEX_CAPACITY', 10000000))
+    ARCHIVE_PNR_INDEX_ERROR_RATE = float(os.environ.get('ARCHIVE_PNR_INDEX_ERROR_RATE', 0.001))
+    ARCHIVE_PNR_INDEX_RELOAD_INTERVAL = float(os.environ.get('ARCHIVE_PNR_INDEX_RELOAD_INTERVAL', 5))  # seconds
+    # logging, the records are written by a background thread (dropped if LOG_QUEUE_SIZE are waiting)
+    LOG_LEVEL = os.environ.get('LOG_LEVEL')  # defaults to DEBUG in debug mode, to the root logger's level otherwise
+    LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')  # 'json' or 'text'
+    LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+    # share of the requests whose records below WARNING are logged, and per route overrides,
+    # e.g. LOG_SAMPLE_RATES='api.confirm=0.1,api.health=0'
+    LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', 1))
+    LOG_SAMPLE_RATES = {route: float(rate) for route, rate in (
+        item.split('=') for item in os.environ.get('LOG_SAMPLE_RATES', '').split(',') if item)}
+    LOG_REDACTED_KEYS = tuple(os.environ.get('LOG_REDACTED_KEYS', 'SecurityCredential,Authorization').split(','))
+    # Prometheus metrics (see /metrics), set METRICS_DIR to aggregate them across (gunicorn) workers
+    METRICS_DIR = os.environ.get('METRICS_DIR')
+    METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))  # seconds
+    # on-demand sampling profiler of the worker serving /metrics/profile, off by default
+    PROFILER_ENABLED = os.environ.get('PROFILER_ENABLED', 'false').lower() == 'true'
+    PROFILER_INTERVAL = float(os.environ.get('PROFILER_INTERVAL', 0.005))  # seconds between samples
+    PROFILER_MAX_DURATION = float(os.environ.get('PROFILER_MAX_DURATION', 300))  # seconds
+    PROFILER_OUTPUT_DIR = os.environ.get('PROFILER_OUTPUT_DIR', '/tmp')
 
     @staticmethod
     def init_app(app):
@@ -40,6 +179,7 @@ class DevelopmentConfig(Config):
 
 class ProductionConfig(Config):
     SQLALCHEMY_DATABASE_URI = os.environ.get('SQLALCHEMY_DATABASE_URI')
+    PRELOAD_SECURITY_CREDENTIAL = True
 
 
 config = {
@@ -0,0 +1,56 @@
+"""gunicorn settings of the WSGI app, driven by the environment.
+
+    $ gunicorn -c gunicorn.conf.py wsgi:app
+    $ GUNICORN_WORKER_CLASS=gevent GUNICORN_WORKERS=2 gunicorn -c gunicorn.conf.py wsgi:app
+
+The payment flow mostly waits on Daraja and the database, so the default worker class is
+gthread (GUNICORN_THREADS requests at a time per worker); gevent needs the `gevent` package.
+The app is preloaded in the master (imported once, its pages shared with the workers), and
+each worker drops the DB connections inherited from the master, then opens its own and fetches
+the Daraja secrets before serving its first request (see `warm_up`).
+"""
+import os
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')  # sync, gthread or gevent
+if worker_class == 'gevent':
+    # before the preloaded app imports socket, ssl and threading
+    from gevent import monkey
+    monkey.patch_all()
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('GUNICORN_WORKERS', 4))
+# concurrent requests per worker, keep them within the DB pool (SQLALCHEMY_ENGINE_OPTIONS' pool_size + max_overflow)
+threads = int(os.environ.get('GUNICORN_THREADS', 8)) if worker_class == 'gthread' else 1
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))  # gevent only
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+# recycle the workers now and then (jittered, so that they don't all restart at once), 0 to disable
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 0))
+loglevel = os.environ.get('GUNICORN_LOG_LEVEL', 'info')
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG')  # e.g. '-' for stdout, off by default
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'true').lower() == 'true'
+
+
+def when_ready(server):
+    """Drops the master's DB connections (if preloading opened any), the workers mustn't share them."""
+    if preload_app:
+        from src.api_1_0.helpers.warmup import dispose_engines
+        from wsgi import app
+        dispose_engines(app)
+
+
+def post_fork(server, worker):
+    """Warms the worker up before it serves its first request."""
+    from src.api_1_0.helpers.warmup import dispose_engines, warm_up
+    from wsgi import app
+    # the pool was copied from the master: forget its connections, without closing the master's sockets
+    dispose_engines(app, close=False)
+    warm_up(app)
+
+
+def child_exit(server, worker):
+    """Folds the metrics of the exited worker into the retired workers' totals (see `Metrics.retire`)."""
+    from src.api_1_0.helpers.metrics import Metrics
+    Metrics.retire(os.environ.get('METRICS_DIR'), worker.pid)
@@ -0,0 +1,45 @@
+"""Add the QUEUED status and the outbox columns to 'mpesa_b2b_transactions'.
+
+Revision ID: 3f1a2b7c9d10
+Revises: 9e3638803885
+Create Date: 2026-10-18 09:12:41.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1a2b7c9d10'
+down_revision = '9e3638803885'
+branch_labels = None
+depends_on = None
+
+old_status = sa.Enum('PENDING', 'SUCCESS', 'FAILED', name='statusenum')
+new_status = sa.Enum('PENDING', 'SUCCESS', 'FAILED', 'QUEUED', name='statusenum')
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute("ALTER TYPE statusenum ADD VALUE IF NOT EXISTS 'QUEUED'")
+    with op.batch_alter_table('mpesa_b2b_transactions', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('attempts', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('next_attempt_on', sa.DateTime(), nullable=True))
+        batch_op.alter_column('status', existing_type=old_status, type_=new_status, existing_nullable=True)
+        batch_op.alter_column('originator_conversation_id', existing_type=sa.String(length=100), nullable=True)
+        batch_op.alter_column('conversation_id', existing_type=sa.String(length=100), nullable=True)
+        batch_op.create_index('ix_mpesa_b2b_transactions_status_next_attempt_on', ['status', 'next_attempt_on'],
+                              unique=False)
+
+
+def downgrade():
+    # rows still in the outbox were never sent, there is nothing to keep
+    op.execute("DELETE FROM mpesa_b2b_transactions WHERE status = 'QUEUED'")
+    with op.batch_alter_table('mpesa_b2b_transactions', schema=None) as batch_op:
+        batch_op.drop_index('ix_mpesa_b2b_transactions_status_next_attempt_on')
+        batch_op.alter_column('conversation_id', existing_type=sa.String(length=100), nullable=False)
+        batch_op.alter_column('originator_conversation_id', existing_type=sa.String(length=100), nullable=False)
+        if op.get_bind().dialect.name != 'postgresql':
+            batch_op.alter_column('status', existing_type=new_status, type_=old_status, existing_nullable=True)
+        batch_op.drop_column('next_attempt_on')
+        batch_op.drop_column('attempts')
@@ -0,0 +1,48 @@
+"""Add the 'callback_url' column, and the 'mpesa_b2b_webhook_deliveries' table.
+
+Revision ID: 4b9d2e6a0f73
+Revises: e7f3a1c58d92
+Create Date: 2026-10-18 17:31:08.640215
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4b9d2e6a0f73'
+down_revision = 'e7f3a1c58d92'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    for table in ('mpesa_b2b_transactions', 'mpesa_b2b_transactions_archive'):
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.add_column(sa.Column('callback_url', sa.String(length=2048), nullable=True))
+    op.create_table(
+        'mpesa_b2b_webhook_deliveries',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('url', sa.String(length=2048), nullable=False),
+        sa.Column('pnr', sa.String(length=100), nullable=False),
+        sa.Column('payload', sa.Text(), nullable=False),
+        sa.Column('attempts', sa.Integer(), server_default='0', nullable=False),
+        sa.Column('next_attempt_on', sa.DateTime(), server_default=sa.text('(CURRENT_TIMESTAMP)'), nullable=False),
+        sa.Column('created_on', sa.DateTime(), server_default=sa.text('(CURRENT_TIMESTAMP)'), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('mpesa_b2b_webhook_deliveries', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_mpesa_b2b_webhook_deliveries_pnr'), ['pnr'], unique=False)
+        batch_op.create_index(batch_op.f('ix_mpesa_b2b_webhook_deliveries_next_attempt_on'), ['next_attempt_on'],
+                              unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('mpesa_b2b_webhook_deliveries', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_mpesa_b2b_webhook_deliveries_next_attempt_on'))
+        batch_op.drop_index(batch_op.f('ix_mpesa_b2b_webhook_deliveries_pnr'))
+
+    op.drop_table('mpesa_b2b_webhook_deliveries')
+    for table in ('mpesa_b2b_transactions_archive', 'mpesa_b2b_transactions'):
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.drop_column('callback_url')
@@ -0,0 +1,29 @@
+"""Add the conversation pair and (status, created_on) indexes to 'mpesa_b2b_transactions'.
+
+Revision ID: 5c8e1d2f4a37
+Revises: 3f1a2b7c9d10
+Create Date: 2026-10-18 14:03:27.512930
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '5c8e1d2f4a37'
+down_revision = '3f1a2b7c9d10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('mpesa_b2b_transactions', schema=None) as batch_op:
+        batch_op.create_index('ix_mpesa_b2b_transactions_conversation_pair',
+                              ['conversation_id', 'originator_conversation_id', 'status'], unique=False)
+        batch_op.create_index('ix_mpesa_b2b_transactions_status_created_on', ['status', 'created_on'],
+                              unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('mpesa_b2b_transactions', schema=None) as batch_op:
+        batch_op.drop_index('ix_mpesa_b2b_transactions_status_created_on')
+        batch_op.drop_index('ix_mpesa_b2b_transactions_conversation_pair')
@@ -0,0 +1,36 @@
+"""Add the result columns (receipt, result code, ...) to 'mpesa_b2b_transactions'.
+
+Revision ID: 8b4d6f0e2c51
+Revises: 5c8e1d2f4a37
+Create Date: 2026-10-18 15:21:08.730412
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b4d6f0e2c51'
+down_revision = '5c8e1d2f4a37'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('mpesa_b2b_transactions', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('result_code', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('result_description', sa.String(length=255), nullable=True))
+        batch_op.add_column(sa.Column('receipt', sa.String(length=32), nullable=True))
+        batch_op.add_column(sa.Column('transaction_amount', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('completed_on', sa.DateTime(), nullable=True))
+        batch_op.create_index(batch_op.f('ix_mpesa_b2b_transactions_receipt'), ['receipt'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('mpesa_b2b_transactions', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_mpesa_b2b_transactions_receipt'))
+        batch_op.drop_column('completed_on')
+        batch_op.drop_column('transaction_amount')
+        batch_op.drop_column('receipt')
+        batch_op.drop_column('result_description')
+        batch_op.drop_column('result_code')
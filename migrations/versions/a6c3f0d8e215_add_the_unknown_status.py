@@ -0,0 +1,35 @@
+"""Add the UNKNOWN status to 'mpesa_b2b_transactions'.
+
+Revision ID: a6c3f0d8e215
+Revises: 4b9d2e6a0f73
+Create Date: 2026-10-19 10:04:52.310877
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a6c3f0d8e215'
+down_revision = '4b9d2e6a0f73'
+branch_labels = None
+depends_on = None
+
+old_status = sa.Enum('PENDING', 'SUCCESS', 'FAILED', 'QUEUED', name='statusenum')
+new_status = sa.Enum('PENDING', 'SUCCESS', 'FAILED', 'QUEUED', 'UNKNOWN', name='statusenum')
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute("ALTER TYPE statusenum ADD VALUE IF NOT EXISTS 'UNKNOWN'")
+    else:
+        with op.batch_alter_table('mpesa_b2b_transactions', schema=None) as batch_op:
+            batch_op.alter_column('status', existing_type=old_status, type_=new_status, existing_nullable=True)
+
+
+def downgrade():
+    # the payments of unknown outcome go back to the state they were flagged in
+    op.execute("UPDATE mpesa_b2b_transactions SET status = 'PENDING' WHERE status = 'UNKNOWN'")
+    if op.get_bind().dialect.name != 'postgresql':
+        with op.batch_alter_table('mpesa_b2b_transactions', schema=None) as batch_op:
+            batch_op.alter_column('status', existing_type=new_status, type_=old_status, existing_nullable=True)
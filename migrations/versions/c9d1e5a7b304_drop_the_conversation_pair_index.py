@@ -0,0 +1,28 @@
+"""Drop the conversation pair index of 'mpesa_b2b_transactions'.
+
+The unique index of 'conversation_id' already serves the callbacks' lookup.
+
+Revision ID: c9d1e5a7b304
+Revises: a6c3f0d8e215
+Create Date: 2026-10-19 11:26:40.184512
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'c9d1e5a7b304'
+down_revision = 'a6c3f0d8e215'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('mpesa_b2b_transactions', schema=None) as batch_op:
+        batch_op.drop_index('ix_mpesa_b2b_transactions_conversation_pair')
+
+
+def downgrade():
+    with op.batch_alter_table('mpesa_b2b_transactions', schema=None) as batch_op:
+        batch_op.create_index('ix_mpesa_b2b_transactions_conversation_pair',
+                              ['conversation_id', 'originator_conversation_id', 'status'], unique=False)
@@ -0,0 +1,67 @@
+"""Add the 'mpesa_b2b_transactions_archive' table, for the archived final payments.
+
+Revision ID: d2a7c4e9b160
+Revises: 8b4d6f0e2c51
+Create Date: 2026-10-18 16:02:44.118903
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'd2a7c4e9b160'
+down_revision = '8b4d6f0e2c51'
+branch_labels = None
+depends_on = None
+
+# the members of 'statusenum' at this revision
+STATUSES = ('PENDING', 'SUCCESS', 'FAILED', 'QUEUED')
+
+
+def status_type():
+    """The type of the status column, Postgres' 'statusenum' type is shared with 'mpesa_b2b_transactions'."""
+    if op.get_bind().dialect.name == 'postgresql':
+        return postgresql.ENUM(*STATUSES, name='statusenum', create_type=False)
+    return sa.Enum(*STATUSES, name='statusenum')
+
+
+def upgrade():
+    op.create_table(
+        'mpesa_b2b_transactions_archive',
+        sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('amount', sa.Integer(), nullable=True),
+        sa.Column('pnr', sa.String(length=100), nullable=False),
+        sa.Column('originator_conversation_id', sa.String(length=100), nullable=True),
+        sa.Column('conversation_id', sa.String(length=100), nullable=True),
+        sa.Column('status', status_type(), nullable=False),
+        sa.Column('result_code', sa.Integer(), nullable=True),
+        sa.Column('result_description', sa.String(length=255), nullable=True),
+        sa.Column('receipt', sa.String(length=32), nullable=True),
+        sa.Column('transaction_amount', sa.Integer(), nullable=True),
+        sa.Column('completed_on', sa.DateTime(), nullable=True),
+        sa.Column('attempts', sa.Integer(), server_default='0', nullable=False),
+        sa.Column('next_attempt_on', sa.DateTime(), nullable=True),
+        sa.Column('created_on', sa.DateTime(), nullable=False),
+        sa.Column('updated_on', sa.DateTime(), nullable=False),
+        sa.Column('archived_on', sa.DateTime(), server_default=sa.text('(CURRENT_TIMESTAMP)'), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    with op.batch_alter_table('mpesa_b2b_transactions_archive', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_mpesa_b2b_transactions_archive_pnr'), ['pnr'], unique=True)
+        batch_op.create_index(batch_op.f('ix_mpesa_b2b_transactions_archive_conversation_id'), ['conversation_id'],
+                              unique=False)
+        batch_op.create_index(batch_op.f('ix_mpesa_b2b_transactions_archive_receipt'), ['receipt'], unique=False)
+        batch_op.create_index(batch_op.f('ix_mpesa_b2b_transactions_archive_created_on'), ['created_on'],
+                              unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('mpesa_b2b_transactions_archive', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_mpesa_b2b_transactions_archive_created_on'))
+        batch_op.drop_index(batch_op.f('ix_mpesa_b2b_transactions_archive_receipt'))
+        batch_op.drop_index(batch_op.f('ix_mpesa_b2b_transactions_archive_conversation_id'))
+        batch_op.drop_index(batch_op.f('ix_mpesa_b2b_transactions_archive_pnr'))
+
+    op.drop_table('mpesa_b2b_transactions_archive')
@@ -0,0 +1,28 @@
+"""Add the 'tenant' column to 'mpesa_b2b_transactions' and its archive.
+
+Revision ID: e7f3a1c58d92
+Revises: d2a7c4e9b160
+Create Date: 2026-10-18 16:47:12.502318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7f3a1c58d92'
+down_revision = 'd2a7c4e9b160'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    for table in ('mpesa_b2b_transactions', 'mpesa_b2b_transactions_archive'):
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.add_column(sa.Column('tenant', sa.String(length=32), server_default='default', nullable=False))
+
+
+def downgrade():
+    for table in ('mpesa_b2b_transactions_archive', 'mpesa_b2b_transactions'):
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.drop_column('tenant')
@@ -0,0 +1,35 @@
+"""Add the UNKNOWN status to 'mpesa_b2b_transactions_archive'.
+
+Its status column has the members of 'mpesa_b2b_transactions' (the 'statusenum' type itself on Postgres,
+which already has UNKNOWN).
+
+Revision ID: f3b7d1a9c642
+Revises: c9d1e5a7b304
+Create Date: 2026-10-19 14:12:05.927341
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3b7d1a9c642'
+down_revision = 'c9d1e5a7b304'
+branch_labels = None
+depends_on = None
+
+old_status = sa.Enum('PENDING', 'SUCCESS', 'FAILED', 'QUEUED', name='statusenum')
+new_status = sa.Enum('PENDING', 'SUCCESS', 'FAILED', 'QUEUED', 'UNKNOWN', name='statusenum')
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        with op.batch_alter_table('mpesa_b2b_transactions_archive', schema=None) as batch_op:
+            batch_op.alter_column('status', existing_type=old_status, type_=new_status, existing_nullable=False)
+
+
+def downgrade():
+    # only final payments are archived, none is UNKNOWN
+    if op.get_bind().dialect.name != 'postgresql':
+        with op.batch_alter_table('mpesa_b2b_transactions_archive', schema=None) as batch_op:
+            batch_op.alter_column('status', existing_type=new_status, type_=old_status, existing_nullable=False)
@@ -1,33 +1,80 @@
-from flask import Flask, request
+from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from config.default import config
+from src.replicas import RoutingSession, db_router
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 
-def create_app(config_name):
-    """Create an application instance."""
+def create_app(config_name, require_daraja=True):
+    """Create an application instance.
+
+    Without `require_daraja` (e.g. for the `flask` CLI commands), missing Daraja B2B settings
+    are only logged, and no payment can be sent; the security credential isn't preloaded either.
+    """
     app = Flask(__name__)
     app.config.from_object(config[config_name])
     config[config_name].init_app(app)
+    # the read replicas are engine binds, they must be known before the engines are created
+    db_router.init_app(app)
     db.init_app(app)
 
-    @app.before_request
-    def log_request_info():
-        """Log the request."""
-        app.logger.debug('***** Start [REQUEST] *****')
-        app.logger.debug(f'[Headers]:\n{request.headers}')
-        app.logger.debug(f'[Body]:\n{request.get_data(as_text=True)}')
-        app.logger.debug('***** End [REQUEST] *****')
-
-    @app.after_request
-    def log_response_info(response):
-        """Log the response."""
-        app.logger.debug(f'***** [RESPONSE] *****:\n{response.get_data(as_text=True)}')
-        return response
+    from .api_1_0.helpers.exceptions import ConfigurationError
+    from .api_1_0.helpers.settings import load_settings
+    from .api_1_0.helpers.logs import log_pipeline
+    from .api_1_0.helpers.metrics import metrics
+    from .api_1_0.helpers.profiler import profiler
+    from .api_1_0.helpers.access_token import token_manager
+    from .api_1_0.helpers.credential import credential_provider
+    from .api_1_0.helpers.transport import transport
+    from .api_1_0.helpers.tenants import tenants
+    from .api_1_0.helpers.idempotency import pnr_guard
+    from .api_1_0.helpers.resilience import oauth_breaker, rate_limiter, remittax_breaker, \
+        transaction_status_breaker
+    from .api_1_0.helpers.persistence import persistence_worker
+    from .api_1_0.helpers.mpesa import MPESA
+    from .api_1_0.helpers.callbacks import callback_journal, callback_processor
+    from .api_1_0.helpers.outbox import outbox_dispatcher
+    from .api_1_0.helpers.webhooks import webhook_dispatcher
+    from .api_1_0.helpers.reconciler import reconciler
+    from .api_1_0.helpers.archive import archive_index, archiver
+    # the Daraja B2B settings, fails fast if some are missing
+    try:
+        load_settings(app)
+    except ConfigurationError as e:
+        if require_daraja:
+            raise
+        app.logger.warning('The Daraja B2B settings are incomplete, no payment can be sent ~>\n\t%s', e)
+    if not require_daraja:
+        # nor is the certificate needed, until a payment is sent
+        app.config['PRELOAD_SECURITY_CREDENTIAL'] = False
+    # logs the requests, and writes every log record from a background thread
+    log_pipeline.init_app(app)
+    metrics.init_app(app)
+    profiler.init_app(app)
+    transport.init_app(app)
+    remittax_breaker.init_app(app)
+    oauth_breaker.init_app(app)
+    transaction_status_breaker.init_app(app)
+    rate_limiter.init_app(app)
+    token_manager.init_app(app, fetch=MPESA.fetch_access_token)
+    credential_provider.init_app(app)
+    # the shortcode profiles, the default one uses the clients above
+    if 'mpesa_b2b_settings' in app.extensions:
+        tenants.init_app(app, fetch=MPESA.fetch_access_token)
+    pnr_guard.init_app(app)
+    persistence_worker.init_app(app)
+    callback_processor.init_app(app)
+    callback_journal.init_app(app)
+    outbox_dispatcher.init_app(app)
+    webhook_dispatcher.init_app(app)
+    reconciler.init_app(app)
+    archive_index.init_app(app)
+    archiver.init_app(app)
 
     # register blueprints
-    from .api_1_0 import error_bp, api_bp
+    from .api_1_0 import error_bp, api_bp, metrics_bp
     app.register_blueprint(error_bp)
+    app.register_blueprint(metrics_bp)
     app.register_blueprint(api_bp, url_prefix='/api/v1.0')
     return app
@@ -0,0 +1,91 @@
+import logging
+import os
+from quart import Quart, request
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from config.default import config
+
+# the async driver to use for each (sync) driver of `SQLALCHEMY_DATABASE_URI`
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'sqlite+pysqlite': 'sqlite+aiosqlite',
+    'mysql': 'mysql+aiomysql',
+    'mysql+pymysql': 'mysql+aiomysql',
+    'postgresql': 'postgresql+asyncpg',
+    'postgresql+psycopg2': 'postgresql+asyncpg',
+}
+
+
+class AsyncDatabase:
+    """Holds the async SQLAlchemy engine of the ASGI application."""
+
+    def __init__(self):
+        """Initializes the AsyncDatabase class."""
+        self.engine = None
+
+    def init_app(self, app: Quart) -> None:
+        """Creates the engine, it's disposed of when the app stops serving."""
+        self.engine = self.create_engine(app)
+
+        @app.after_serving
+        async def dispose_engine():
+            await self.engine.dispose()
+
+    @staticmethod
+    def create_engine(app: Quart) -> AsyncEngine:
+        """Creates an async engine for the app's `SQLALCHEMY_DATABASE_URI`."""
+        url = make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+        url = url.set(drivername=ASYNC_DRIVERS.get(url.drivername, url.drivername))
+        if url.drivername.startswith('sqlite') and url.database and url.database != ':memory:' \
+                and not os.path.isabs(url.database):
+            # like Flask-SQLAlchemy, relative SQLite paths live in the instance folder
+            os.makedirs(app.instance_path, exist_ok=True)
+            url = url.set(database=os.path.join(app.instance_path, url.database))
+        return create_async_engine(url, **app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+
+
+async_db = AsyncDatabase()
+
+
+def create_async_app(config_name):
+    """Create an (ASGI) application instance, serving the same API as `create_app`."""
+    app = Quart(__name__)
+    app.config.from_object(config[config_name])
+    config[config_name].init_app(app)
+    async_db.init_app(app)
+
+    from src.api_1_0.helpers.settings import load_settings
+    from src.api_1_0.helpers.archive import archive_index
+    from src.api_1_0.helpers.credential import credential_provider
+    from src.api_1_0.helpers.idempotency import pnr_guard
+    from src.api_1_0.helpers.logs import log_pipeline
+    from src.api_1_0.helpers.mpesa import MPESA
+    from src.api_1_0.helpers.resilience import oauth_breaker, rate_limiter, remittax_breaker
+    from src.api_1_0.helpers.tenants import tenants
+    from .helpers import async_transport, async_token_manager
+    from .mpesa import AsyncMPESA
+    load_settings(app)
+    # the records are written by the pipeline's thread, not on the event loop
+    log_pipeline.install(app)
+    # the async Daraja calls go through the same breakers and limiter as the sync ones
+    remittax_breaker.init_app(app)
+    oauth_breaker.init_app(app)
+    rate_limiter.init_app(app)
+    async_transport.init_app(app)
+    async_token_manager.init_app(app, fetch=AsyncMPESA.fetch_access_token)
+    credential_provider.init_app(app)
+    tenants.init_app(app, fetch=MPESA.fetch_access_token)
+    pnr_guard.init_app(app)
+    archive_index.init_app(app)
+
+    @app.before_request
+    async def log_request_info():
+        """Log the request."""
+        if app.logger.isEnabledFor(logging.DEBUG):
+            app.logger.debug('Request %s %s', request.method, request.path,
+                             extra=dict(headers=dict(request.headers), body=await request.get_data(as_text=True)))
+
+    # register blueprints
+    from .routes import aio_api_bp
+    app.register_blueprint(aio_api_bp, url_prefix='/api/v1.0')
+    return app
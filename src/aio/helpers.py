@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Tuple
+import httpx
+from quart import Quart
+
+
+class AsyncTransport:
+    """A pooled, keep-alive async HTTP client shared by all Daraja calls of the ASGI app."""
+
+    def __init__(self):
+        """Initializes the AsyncTransport class."""
+        self.client = None
+
+    def init_app(self, app: Quart) -> None:
+        """Opens the client when the app starts serving, and closes it when it stops."""
+
+        @app.before_serving
+        async def open_client():
+            self.client = httpx.AsyncClient(
+                timeout=httpx.Timeout(app.config['HTTP_READ_TIMEOUT'], connect=app.config['HTTP_CONNECT_TIMEOUT']),
+                limits=httpx.Limits(max_connections=app.config['ASYNC_HTTP_MAX_CONNECTIONS'],
+                                    max_keepalive_connections=app.config['HTTP_POOL_MAXSIZE']),
+                # like the sync transport, only connection errors are retried
+                transport=httpx.AsyncHTTPTransport(retries=app.config['HTTP_MAX_RETRIES'])
+            )
+
+        @app.after_serving
+        async def close_client():
+            await self.client.aclose()
+
+    async def get(self, url: str, **kwargs: Any) -> httpx.Response:
+        """Sends a GET request."""
+        return await self.client.get(url, **kwargs)
+
+    async def post(self, url: str, **kwargs: Any) -> httpx.Response:
+        """Sends a POST request."""
+        return await self.client.post(url, **kwargs)
+
+
+class AsyncTokenManager:
+    """Caches the Daraja OAuth access token of the ASGI app, see `TokenManager`."""
+
+    def __init__(self, fetch: Callable[[], Awaitable[Tuple[str, int]]] = None):
+        """Initializes the AsyncTokenManager class."""
+        self.fetch = fetch
+        self.refresh_margin = 300
+        self._token = None
+        self._expires_at = 0.0
+        self._lock = None
+        self._refresh_task = None
+        self.logger = logging.getLogger(__name__)
+
+    def init_app(self, app: Quart, fetch: Callable[[], Awaitable[Tuple[str, int]]] = None) -> None:
+        """Configures the manager from the application config."""
+        self.refresh_margin = app.config.get('ACCESS_TOKEN_REFRESH_MARGIN', self.refresh_margin)
+        self.logger = app.logger
+        if fetch is not None:
+            self.fetch = fetch
+        self.invalidate()
+
+    async def get_token(self) -> str:
+        """Returns a valid access token, refreshing it when needed."""
+        now, token, expires_at = time.time(), self._token, self._expires_at
+        if token and now < expires_at - self.refresh_margin:
+            return token
+        if self._lock is None:
+            # created lazily, so that it's bound to the serving event loop
+            self._lock = asyncio.Lock()
+        if token and now < expires_at:
+            # still valid, refresh in the background (if nobody else is already doing it)
+            if not self._lock.locked() and (self._refresh_task is None or self._refresh_task.done()):
+                self._refresh_task = asyncio.create_task(self._background_refresh())
+            return token
+        async with self._lock:
+            # another caller may have refreshed the token while we were waiting
+            if not self._token or time.time() >= self._expires_at:
+                await self._refresh()
+            return self._token
+
+    def invalidate(self) -> None:
+        """Drops the cached token, e.g. when Daraja rejects it."""
+        self._token, self._expires_at = None, 0.0
+
+    async def _background_refresh(self) -> None:
+        """Refreshes the token, keeping the current one if it fails."""
+        async with self._lock:
+            try:
+                await self._refresh()
+            except Exception as e:
+                # nobody awaits the task, an error would only be logged as never retrieved
+                self.logger.error('Failed to refresh the access token in the background ~>\n\t%s', e)
+
+    async def _refresh(self) -> None:
+        """Fetches a new token."""
+        token, expires_in = await self.fetch()
+        self._token, self._expires_at = token, time.time() + int(expires_in)
+
+
+# the ASGI app's transport and token manager, configured in `create_async_app`
+async_transport = AsyncTransport()
+async_token_manager = AsyncTokenManager()
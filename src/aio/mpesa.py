@@ -0,0 +1,205 @@
+from typing import Any, Awaitable, Callable, Dict, Tuple
+import httpx
+from quart import current_app
+from sqlalchemy import delete, update
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from src.aio import async_db
+from src.aio.helpers import async_token_manager, async_transport
+from src.api_1_0.helpers.archive import archive_index
+from src.api_1_0.helpers.exceptions import CircuitOpenError, RateLimitedError
+from src.api_1_0.helpers.idempotency import pnr_guard
+from src.api_1_0.helpers.mpesa import MPESA
+from src.api_1_0.helpers.persistence import ON_CONFLICT_DIALECTS, is_duplicate, reserve_statement
+from src.api_1_0.helpers.resilience import CircuitBreaker, oauth_breaker, rate_limiter, remittax_breaker
+from src.api_1_0.helpers.settings import get_settings
+from src.api_1_0.models.b2b import B2B, StatusEnum
+
+
+class AsyncMPESA(MPESA):
+    """The non-blocking counterpart of the MPESA class, used by the ASGI app."""
+
+    async def initiate_b2b(self) -> Tuple[dict, bool]:
+        """Initiates a B2B payment, saved (its PNR reserved) before it's sent, like `MPESA.initiate_b2b`."""
+        current_app.logger.info('PNR: %s | Initiating B2B payment...', self.data['pnr'])
+        if not pnr_guard.reserve(self.data['pnr']):
+            return self._duplicate_response()
+        settled = False  # whether the PNR is now taken for good
+        try:
+            try:
+                reserved = await self._reserve_payment()
+                # then the archived PNRs, after the INSERT like `MPESA.initiate_b2b`; the Bloom filter's
+                # few page reads don't hold the event loop up for long
+                archived = False
+                if reserved:
+                    async with async_db.engine.connect() as conn:
+                        archived = await conn.run_sync(
+                            lambda sync_conn: archive_index.archived([self.data['pnr']], connection=sync_conn))
+            except SQLAlchemyError as e:
+                current_app.logger.error('PNR: %s | Failed to save B2B payment ~>\n\t%s', self.data['pnr'], e)
+                return self._failure_response()
+            if archived:
+                await self._release_payment()
+            if not reserved or archived:
+                # a concurrent request (of any worker or host) got the PNR, or it was archived
+                settled = True
+                return self._duplicate_response()
+            response, err = await self._send_b2b()
+            settled = not err
+            return response, err
+        finally:
+            if settled:
+                pnr_guard.complete(self.data['pnr'])
+            else:
+                pnr_guard.release(self.data['pnr'])
+
+    async def _reserve_payment(self) -> bool:
+        """Saves the payment as PENDING unless its PNR is taken, returns False if it is (see `reserve_payment`)."""
+        dialect = async_db.engine.dialect.name
+        payment = dict(amount=self.data['amount'], pnr=self.data['pnr'], status=StatusEnum.PENDING)
+        try:
+            async with async_db.engine.begin() as conn:
+                result = await conn.execute(reserve_statement(dialect, payment))
+        except IntegrityError as e:
+            if not is_duplicate(e, dialect):
+                raise
+            return False
+        return dialect not in ON_CONFLICT_DIALECTS or result.rowcount == 1
+
+    async def _release_payment(self) -> None:
+        """Drops the reservation of a payment that Daraja rejected, so that its PNR can be used again."""
+        try:
+            async with async_db.engine.begin() as conn:
+                await conn.execute(delete(B2B).where(B2B.pnr == self.data['pnr'], B2B.status == StatusEnum.PENDING,
+                                                     B2B.originator_conversation_id.is_(None)))
+        except SQLAlchemyError as e:
+            current_app.logger.error('PNR: %s | Failed to release the PNR ~>\n\t%s', self.data['pnr'], e)
+
+    async def _send_b2b(self) -> Tuple[dict, bool]:
+        """Sends the (saved) B2B request to Daraja."""
+        response, err, rejected, sending = dict(), '', False, False
+        try:
+            # keep under Daraja's TPS like `MPESA._request_b2b`, waiting on the event loop
+            if not await rate_limiter.acquire_async():
+                raise RateLimitedError('Too many B2B requests, try again later.')
+            endpoint = get_settings().remittax_url
+            headers = {
+                'Content-Type': 'application/json',
+                'Authorization': 'Bearer {}'.format(await async_token_manager.get_token())
+            }
+            payload = self._build_b2b_payload()  # this may throw an error
+            current_app.logger.debug('PNR: %s | with payload ~>\n\t%s', self.data['pnr'], payload)
+            sending = True
+            response = (await AsyncMPESA._guarded_async(remittax_breaker, async_transport.post,
+                                                        url=endpoint, json=payload, headers=headers)).json()
+            current_app.logger.info('PNR: %s | B2B API response ~>\n\t%s', self.data['pnr'], response)
+            if response.get('errorCode') == current_app.config['MPESA_INVALID_TOKEN_CODE']:
+                async_token_manager.invalidate()
+        except (FileNotFoundError, ValueError, httpx.HTTPError, CircuitOpenError, RateLimitedError) as e:
+            current_app.logger.error('PNR: %s | An error occurred while initiating B2B payment ~>\n\t%s',
+                                     self.data['pnr'], e)
+            err = f'An error occurred while initiating B2B payment: {e}'
+            # like `MPESA._request_b2b`, only a request that never reached Daraja was definitely rejected
+            rejected = not sending or isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout, CircuitOpenError))
+        if response.get('errorCode'):
+            rejected = True
+        if err or response.get('errorCode') or \
+                'ConversationID' not in response.keys() or \
+                'OriginatorConversationID' not in response.keys():
+            if not rejected:
+                # Daraja may have accepted it, the PNR stays taken (see `Reconciler.flag_unknown`)
+                current_app.logger.error('PNR: %s | Unknown outcome of the B2B payment', self.data['pnr'])
+                return self._unknown_response()
+            current_app.logger.error('PNR: %s | Failed to initiate B2B payment', self.data['pnr'])
+            await self._release_payment()
+            return self._failure_response()
+        current_app.logger.info('PNR: %s | B2B payment initiated successfully', self.data['pnr'])
+        # no thread (or queue) needed, the update doesn't block the event loop
+        await self._create_b2b_payment(response['OriginatorConversationID'], response['ConversationID'])
+        self.response['status_code'] = current_app.config['MPESA_B2B_SUCCESS_CODE']
+        self.response['status_message'] = 'B2B payment initiated successfully.'
+        return self.response, False
+
+    def _duplicate_response(self) -> Tuple[dict, bool]:
+        """Formulates the response for a PNR that was already used."""
+        current_app.logger.error('PNR: %s | A similar B2B payment already exists.', self.data['pnr'])
+        self.response['status_code'] = current_app.config['GENERIC_FAILURE_CODE']
+        self.response['status_message'] = 'A similar B2B payment already exists.'
+        return self.response, True
+
+    def _failure_response(self) -> Tuple[dict, bool]:
+        """Formulates the response for a payment that couldn't be initiated."""
+        self.response['status_code'] = current_app.config['GENERIC_FAILURE_CODE']
+        self.response['status_message'] = 'Failed to initiate B2B payment.'
+        return self.response, True
+
+    def _unknown_response(self) -> Tuple[dict, bool]:
+        """Formulates the response for a payment that Daraja may have accepted."""
+        self.response['status_code'] = current_app.config['GENERIC_FAILURE_CODE']
+        self.response['status_message'] = 'B2B payment outcome unknown, it is being confirmed.'
+        return self.response, True
+
+    async def _create_b2b_payment(self, originator_conversation_id: str, conversation_id: str) -> None:
+        """Records the conversation IDs of the (saved) B2B payment."""
+        try:
+            async with async_db.engine.begin() as conn:
+                await conn.execute(
+                    update(B2B)
+                    .where(B2B.pnr == self.data['pnr'], B2B.originator_conversation_id.is_(None))
+                    .values(originator_conversation_id=originator_conversation_id, conversation_id=conversation_id)
+                )
+            current_app.logger.info('PNR: %s | B2B payment record saved successfully.', self.data['pnr'])
+        except SQLAlchemyError as e:
+            # the payment is flagged as UNKNOWN by the reconciler, for an operator to settle
+            current_app.logger.error('PNR: %s | Failed to save B2B payment record ~>\n\t%s', self.data['pnr'], e)
+
+    @staticmethod
+    async def update_b2b_payment(ctx: Any, req: Dict) -> None:
+        """Updates the B2B payment record (its status and `RESULT_COLUMNS`), PENDING records only."""
+        async with async_db.engine.begin() as conn:
+            updated = (await conn.execute(
+                update(B2B)
+                .where(B2B.conversation_id == req.get('ConversationID', '-1'))
+                .where(B2B.originator_conversation_id == req.get('OriginatorConversationID', '-1'))
+                .where(B2B.status == StatusEnum.PENDING)
+                .values(status=StatusEnum.SUCCESS if req.get('ResultCode') == 0 else StatusEnum.FAILED,
+                        **MPESA.result_details(req))
+            )).rowcount
+        if updated:
+            ctx.logger.info('ConversationID: %s | B2B payment record updated successfully.', req.get('ConversationID'))
+        else:
+            ctx.logger.error('ConversationID: %s | Transaction record not found or already in a final state.',
+                             req.get('ConversationID'))
+
+    @staticmethod
+    async def fetch_access_token() -> Tuple[str, int]:
+        """Fetches a new access token, and its lifetime in seconds, from the OAuth API."""
+        settings = get_settings()
+        try:
+            response = (await AsyncMPESA._guarded_async(oauth_breaker, async_transport.get, url=settings.oauth_url,
+                                                        auth=(settings.access_key, settings.consumer_secret))).json()
+            return response['access_token'], int(response.get('expires_in', 3599))
+        except (httpx.HTTPError, KeyError, ValueError, CircuitOpenError) as e:
+            raise ValueError(f"Failed to generate access token: {e}")
+
+    @staticmethod
+    async def _guarded_async(breaker: CircuitBreaker, send: Callable[..., Awaitable[httpx.Response]],
+                             **kwargs: Any) -> httpx.Response:
+        """Sends a Daraja request through its circuit breaker, see `MPESA._guarded`.
+
+        The breakers and the limiter are the sync app's, their locks are only held for a few
+        attribute updates, so they don't block the event loop.
+        """
+        breaker.before_call()
+        try:
+            response = await send(**kwargs)
+        except httpx.HTTPError:
+            breaker.record_failure()
+            raise
+        if MPESA._is_throttled(response, rate_limiter.throttling_codes):
+            rate_limiter.throttled()
+            breaker.record_success()
+        elif response.status_code >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        return response
@@ -0,0 +1,56 @@
+import pytz
+from datetime import datetime
+from typing import Dict, Any
+from quart import Blueprint, request, current_app
+from src.aio.mpesa import AsyncMPESA
+from src.api_1_0.helpers.tenants import DEFAULT_TENANT
+from src.api_1_0.helpers.validator import Validator
+
+aio_api_bp = Blueprint('aio_api', __name__)
+
+
+@aio_api_bp.route('/payment/initiate', methods=['POST'])
+async def index():
+    """Handle the initiation of a payment"""
+    data, error_message = Validator.validate(await request.get_json(silent=True))
+    if not error_message and data.get('tenant', DEFAULT_TENANT) != DEFAULT_TENANT:
+        # the async clients (access token, transport) are the default tenant's
+        error_message = '<tenant> is not supported by the async app.'
+    elif not error_message and data.get('callback_url') is not None:
+        error_message = '<callback_url> is not supported by the async app.'
+    if error_message:
+        current_app.logger.warning('Invalid request payload: %s', error_message)
+        return {'error': error_message}, 400
+    response, error = await AsyncMPESA(data).initiate_b2b()
+    status_code = 400 if error else 201
+    return response, status_code
+
+
+@aio_api_bp.route('payment/confirm', methods=['POST'])
+async def confirm(req: Dict[str, Any] = None):
+    """Handle the confirmation of a payment"""
+    data = await request.get_json(silent=True) if not req else req
+    tpt = datetime.now(pytz.timezone(current_app.config['TIME_ZONE'])) \
+        .strftime(current_app.config['TIME_FORMAT'])
+    response = {
+        'ResultCode': current_app.config['MPESA_B2B_FAILURE_CODE'],
+        'ResultDesc': 'Confirmation payload received successfully.',
+        'ThirdPartyTransID': tpt
+    }
+    if not data or not data.get('Result'):
+        current_app.logger.warning('Invalid request payload', extra=dict(payload=data))
+        response['ResultCode'] = current_app.config['GENERIC_FAILURE_CODE']
+        response['ResultDesc'] = 'Invalid request payload.'
+        return response, 400
+    if data['Result']['ResultCode'] == current_app.config['MPESA_B2B_SUCCESS_CODE']:
+        response['ResultCode'] = current_app.config['MPESA_B2B_SUCCESS_CODE']
+    # update the record once we've replied, it's awaited on shutdown
+    current_app.add_background_task(AsyncMPESA.update_b2b_payment, current_app._get_current_object(),
+                                    data['Result'])
+    return response
+
+
+@aio_api_bp.route('payment/timeout', methods=['POST'])
+async def timeout():
+    # same payload as `confirm()`, see `src.api_1_0.routes.main.timeout`
+    return await confirm(await request.get_json(silent=True))
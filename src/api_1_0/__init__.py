@@ -1,7 +1,8 @@
 from flask import Blueprint
 
-# Create a Blueprint object named 'api' and 'error'
+# Create a Blueprint object named 'api', 'error' and 'metrics'
 api_bp = Blueprint('api', __name__)
 error_bp = Blueprint('error', __name__)
+metrics_bp = Blueprint('metrics', __name__)
 
-from .routes import main, error
+from .routes import main, error, metrics, transactions
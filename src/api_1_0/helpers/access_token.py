@@ -0,0 +1,112 @@
+import json
+import logging
+import os
+import time
+from threading import Lock, Thread
+from typing import Any, Callable, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+
+class TokenManager:
+    """Caches the Daraja OAuth access token and refreshes it before it expires.
+
+    Callers wait on a single refresh instead of each hitting the OAuth API, and
+    the token can be shared across (gunicorn) workers through a cache file.
+    """
+
+    def __init__(self, fetch: Callable[[], Tuple[str, int]] = None):
+        """Initializes the TokenManager class."""
+        self.fetch = fetch
+        self.refresh_margin = 300
+        self.cache_file = None
+        self.logger = logging.getLogger(__name__)
+        self._token = None
+        self._expires_at = 0.0
+        self._lock = Lock()
+
+    def init_app(self, app: Any, fetch: Callable[[], Tuple[str, int]] = None) -> None:
+        """Configures the manager from the application config."""
+        self.refresh_margin = app.config.get('ACCESS_TOKEN_REFRESH_MARGIN', self.refresh_margin)
+        self.cache_file = app.config.get('ACCESS_TOKEN_CACHE_FILE')
+        self.logger = getattr(app, 'logger', self.logger)
+        if fetch is not None:
+            self.fetch = fetch
+        self.invalidate()
+
+    def get_token(self) -> str:
+        """Returns a valid access token, refreshing it when needed."""
+        now, token, expires_at = time.time(), self._token, self._expires_at
+        if token and now < expires_at - self.refresh_margin:
+            return token
+        if token and now < expires_at:
+            # still valid, refresh in the background (if nobody else is already doing it)
+            if self._lock.acquire(blocking=False):
+                Thread(target=self._background_refresh, daemon=True).start()
+            return token
+        with self._lock:
+            # another caller may have refreshed the token while we were waiting
+            if not self._token or time.time() >= self._expires_at:
+                self._refresh()
+            return self._token
+
+    def invalidate(self) -> None:
+        """Drops the cached token, e.g. when Daraja rejects it."""
+        self._token, self._expires_at = None, 0.0
+
+    def _background_refresh(self) -> None:
+        """Refreshes the token and releases the lock acquired by the caller."""
+        try:
+            self._refresh()
+        except Exception as e:
+            # the current token is still valid, the next caller will try again
+            self.logger.warning('Failed to refresh the access token in the background ~>\n\t%s', e)
+        finally:
+            self._lock.release()
+
+    def _refresh(self) -> None:
+        """Fetches a new token, going through the shared cache file if configured."""
+        if not self.cache_file:
+            self._store(*self.fetch())
+            return
+        with open(f'{self.cache_file}.lock', 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                shared = self._read_shared()
+                if shared and time.time() < shared[1] - self.refresh_margin:
+                    # another worker already refreshed the token
+                    self._token, self._expires_at = shared
+                    return
+                self._store(*self.fetch())
+                self._write_shared()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _store(self, token: str, expires_in: int) -> None:
+        """Stores a freshly fetched token."""
+        self._token, self._expires_at = token, time.time() + int(expires_in)
+
+    def _read_shared(self) -> Optional[Tuple[str, float]]:
+        """Reads the token shared by the other workers (if any)."""
+        try:
+            with open(self.cache_file, 'r') as f:
+                data = json.load(f)
+            return data['access_token'], float(data['expires_at'])
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _write_shared(self) -> None:
+        """Atomically writes the current token to the shared cache file."""
+        tmp = f'{self.cache_file}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'access_token': self._token, 'expires_at': self._expires_at}, f)
+        os.replace(tmp, self.cache_file)
+
+
+# the process-wide token manager, configured in `create_app`
+token_manager = TokenManager()
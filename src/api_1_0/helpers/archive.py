@@ -0,0 +1,313 @@
+import hashlib
+import math
+import mmap
+import os
+import struct
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+from threading import Lock
+from typing import Any, Iterable, Iterator, List, Optional, Set
+import click
+from flask.cli import AppGroup
+from sqlalchemy import delete, insert, select
+from src import db, db_router
+from src.api_1_0.helpers.clock import utcnow
+from src.api_1_0.helpers.metrics import metrics
+from src.api_1_0.models.b2b import B2B, B2BArchive, StatusEnum
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+# the states a payment never leaves, only those are archived
+FINAL_STATUSES = (StatusEnum.SUCCESS, StatusEnum.FAILED)
+# the columns copied to the archive, in `mpesa_b2b_transactions`' order
+ARCHIVED_COLUMNS = tuple(column.key for column in B2B.__table__.columns)
+
+
+class BloomFilter:
+    """A Bloom filter of strings, kept in a memory-mapped file.
+
+    Lookups only touch the pages of the bits they test, so the filter is never read in full,
+    and the workers mapping the file share its pages (and see its new bits) through the page cache.
+    """
+    HEADER = struct.Struct('<8sQI')  # magic, number of bits, number of hashes
+    MAGIC = b'B2BBLOOM'
+
+    def __init__(self, path: str, writable: bool = False):
+        """Opens an existing filter, raises a ValueError if the file isn't one."""
+        self.path = path
+        with open(path, 'r+b' if writable else 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+            self.inode = os.fstat(f.fileno()).st_ino
+        magic, self.bits, self.hashes = BloomFilter.HEADER.unpack_from(self._map)
+        if magic != BloomFilter.MAGIC or len(self._map) < BloomFilter.HEADER.size + math.ceil(self.bits / 8):
+            self._map.close()
+            raise ValueError(f'{path} is not a Bloom filter.')
+
+    @classmethod
+    def create(cls, path: str, capacity: int, error_rate: float) -> 'BloomFilter':
+        """Creates an empty filter, sized for `capacity` values at `error_rate` false positives."""
+        bits = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        hashes = max(1, round(bits / capacity * math.log(2)))
+        with open(path, 'wb') as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, bits, hashes))
+            # a sparse file, the untouched pages of the bit array don't take any disk space
+            f.truncate(cls.HEADER.size + math.ceil(bits / 8))
+        return cls(path, writable=True)
+
+    def _positions(self, value: str) -> Iterator[int]:
+        """Yields the bits of the value (double hashing of a single digest)."""
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.hashes):
+            yield (first + i * second) % self.bits
+
+    def add(self, value: str) -> None:
+        """Adds the value to the filter."""
+        for position in self._positions(value):
+            offset = BloomFilter.HEADER.size + (position >> 3)
+            self._map[offset] |= 1 << (position & 7)
+
+    def __contains__(self, value: str) -> bool:
+        """Whether the value may have been added (never False for a value that was)."""
+        return all(self._map[BloomFilter.HEADER.size + (position >> 3)] & (1 << (position & 7))
+                   for position in self._positions(value))
+
+    def flush(self) -> None:
+        """Writes the new bits to the file."""
+        self._map.flush()
+
+    def close(self) -> None:
+        self._map.close()
+
+
+class ArchiveIndex:
+    """Tells which PNRs were archived, for the duplicate PNR check.
+
+    A Bloom filter of the archived PNRs (ARCHIVE_PNR_INDEX_PATH) rules most PNRs out without
+    touching the archive table, the others are confirmed with one (indexed) query. Until there's
+    a filter, the archive table is checked for being empty every `reload_interval` seconds; without
+    a path, every PNR is looked up in the archive table.
+    """
+
+    def __init__(self):
+        """Initializes the ArchiveIndex class."""
+        self.path = None
+        self.capacity = 10000000
+        self.error_rate = 0.001
+        self.reload_interval = 5.0
+        self._filter = None
+        self._checked_at = 0.0
+        self._empty = None  # whether the archive table is empty, once known
+        self._empty_checked_at = 0.0
+        self._lock = Lock()
+
+    def init_app(self, app: Any) -> None:
+        """Configures the index."""
+        self.close()
+        path = app.config.get('ARCHIVE_PNR_INDEX_PATH')
+        if path and not os.path.isabs(path):
+            # like Flask-SQLAlchemy's SQLite paths, relative ones live in the instance folder
+            os.makedirs(app.instance_path, exist_ok=True)
+            path = os.path.join(app.instance_path, path)
+        self.path = path or None
+        self.capacity = app.config.get('ARCHIVE_PNR_INDEX_CAPACITY', self.capacity)
+        self.error_rate = app.config.get('ARCHIVE_PNR_INDEX_ERROR_RATE', self.error_rate)
+        self.reload_interval = app.config.get('ARCHIVE_PNR_INDEX_RELOAD_INTERVAL', self.reload_interval)
+
+    def archived(self, pnrs: Iterable[str], connection: Any = None) -> Set[str]:
+        """Returns the PNRs that were archived.
+
+        They're looked up on the (sync) `connection` if given, e.g. the async app's
+        (see `AsyncConnection.run_sync`), through the session otherwise.
+        """
+        bloom = self._current()
+        pnrs = set(pnrs)
+        if bloom is None and self.path and self._nothing_archived(connection):
+            # the filter is created by the first archive run
+            candidates = set()
+        else:
+            candidates = pnrs if bloom is None else {pnr for pnr in pnrs if pnr in bloom}
+        metrics.inc('mpesa_b2b_archive_lookups_total', len(pnrs) - len(candidates), outcome='skipped')
+        if not candidates:
+            return set()
+        metrics.inc('mpesa_b2b_archive_lookups_total', len(candidates), outcome='queried')
+        query = select(B2BArchive.pnr).where(B2BArchive.pnr.in_(candidates))
+        if connection is not None:
+            return set(connection.scalars(query))
+        # the archived payments are months old, a lagging replica knows them just as well
+        with db_router.replica():
+            return set(db.session.scalars(query))
+
+    def _nothing_archived(self, connection: Any = None) -> bool:
+        """Whether the archive table is empty, checked every `reload_interval` seconds until it isn't."""
+        now = time.monotonic()
+        if self._empty is not False and now - self._empty_checked_at >= self.reload_interval:
+            query = select(B2BArchive.id).limit(1)
+            row = connection.scalar(query) if connection is not None else db.session.scalar(query)
+            self._empty, self._empty_checked_at = row is None, now
+        return bool(self._empty)
+
+    def add(self, pnrs: Iterable[str]) -> None:
+        """Adds the PNRs to the filter (creating it if needed), before they're archived."""
+        if not self.path:
+            return
+        bloom = self._writable()
+        try:
+            for pnr in pnrs:
+                bloom.add(pnr)
+            bloom.flush()
+        finally:
+            bloom.close()
+
+    def rebuild(self, yield_per: int = 10000) -> int:
+        """Rebuilds the filter from the archive table (e.g. to resize it), returns the number of PNRs."""
+        count = db.session.scalar(select(db.func.count()).select_from(B2BArchive))
+        path = f'{self.path}.tmp'
+        bloom = BloomFilter.create(path, max(self.capacity, count * 2), self.error_rate)
+        try:
+            rows = db.session.execute(select(B2BArchive.pnr).execution_options(stream_results=True,
+                                                                               yield_per=yield_per))
+            for pnr, in rows:
+                bloom.add(pnr)
+            bloom.flush()
+        finally:
+            bloom.close()
+        # the workers switch to the new file within `reload_interval`
+        os.replace(path, self.path)
+        return count
+
+    @contextmanager
+    def locked(self) -> Iterator[None]:
+        """Keeps the other processes from changing the filter in the meantime."""
+        if not self.path or fcntl is None:
+            yield
+            return
+        with open(f'{self.path}.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._filter is not None:
+                self._filter.close()
+            self._filter, self._checked_at = None, 0.0
+            self._empty, self._empty_checked_at = None, 0.0
+
+    def _current(self) -> Optional[BloomFilter]:
+        """Returns the filter mapped by this process, reopened if it was rebuilt (None if there's none)."""
+        if not self.path:
+            return None
+        now = time.monotonic()
+        if now - self._checked_at < self.reload_interval:
+            return self._filter
+        with self._lock:
+            if now - self._checked_at >= self.reload_interval:
+                try:
+                    inode = os.stat(self.path).st_ino
+                    if self._filter is None or self._filter.inode != inode:
+                        # the old map is closed once the threads still using it are done with it
+                        self._filter = BloomFilter(self.path)
+                except (OSError, ValueError):
+                    # no filter yet (nothing was archived), or a broken one: look every PNR up
+                    self._filter = None
+                self._checked_at = now
+            return self._filter
+
+    def _writable(self) -> BloomFilter:
+        try:
+            return BloomFilter(self.path, writable=True)
+        except FileNotFoundError:
+            return BloomFilter.create(self.path, self.capacity, self.error_rate)
+
+
+class Archiver:
+    """Moves the final (SUCCESS/FAILED) payments older than `after_days` to the archive table.
+
+    The payments are moved in chunks of `chunk_size`, each in its own short transaction
+    (copy, then delete by primary key), with a pause in between so that the hot table's
+    writers aren't held up. Their PNRs are added to the archive index before they leave
+    the hot table, so that the duplicate PNR check never misses them.
+    """
+
+    def __init__(self):
+        """Initializes the Archiver class."""
+        self.after_days = 180
+        self.chunk_size = 1000
+        self.chunk_pause = 0.1
+
+    def init_app(self, app: Any) -> None:
+        """Configures the archiver, and registers its `flask archive` commands."""
+        self.after_days = app.config.get('ARCHIVE_AFTER_DAYS', self.after_days)
+        self.chunk_size = app.config.get('ARCHIVE_CHUNK_SIZE', self.chunk_size)
+        self.chunk_pause = app.config.get('ARCHIVE_CHUNK_PAUSE', self.chunk_pause)
+        app.cli.add_command(archive_cli)
+
+    def archive(self, after_days: int = None, limit: int = None) -> int:
+        """Archives the payments (at most `limit`), returns the number of archived payments."""
+        cutoff = utcnow() - timedelta(days=self.after_days if after_days is None else after_days)
+        archived = 0
+        with archive_index.locked():
+            while limit is None or archived < limit:
+                chunk = self._chunk(cutoff, self.chunk_size if limit is None else min(self.chunk_size,
+                                                                                       limit - archived))
+                if not chunk:
+                    break
+                archived += len(chunk)
+                time.sleep(self.chunk_pause)
+        return archived
+
+    def _chunk(self, cutoff: Any, size: int) -> List[int]:
+        """Archives one chunk, returns the IDs of its payments."""
+        rows = db.session.execute(
+            select(B2B.id, B2B.pnr)
+            .where(B2B.status.in_(FINAL_STATUSES), B2B.created_on < cutoff)
+            .order_by(B2B.created_on, B2B.id)
+            .limit(size)
+        ).all()
+        if not rows:
+            db.session.rollback()
+            return []
+        ids = [row.id for row in rows]
+        try:
+            archive_index.add(row.pnr for row in rows)
+            db.session.execute(insert(B2BArchive).from_select(
+                ARCHIVED_COLUMNS, select(*(getattr(B2B, key) for key in ARCHIVED_COLUMNS)).where(B2B.id.in_(ids))))
+            db.session.execute(delete(B2B).where(B2B.id.in_(ids)).execution_options(synchronize_session=False))
+            db.session.commit()
+        except Exception:
+            # the PNRs left in the filter are mere false positives
+            db.session.rollback()
+            raise
+        metrics.inc('mpesa_b2b_archived_total', len(ids))
+        return ids
+
+
+# the process-wide archive index and archiver, configured in `create_app`
+archive_index = ArchiveIndex()
+archiver = Archiver()
+
+archive_cli = AppGroup('archive', help='Archives the final B2B payments.')
+
+
+@archive_cli.command('run')
+@click.option('--after-days', type=int, help='Age of the payments to archive (ARCHIVE_AFTER_DAYS by default).')
+@click.option('--limit', type=int, help='Maximum number of payments to archive.')
+def archive_command(after_days: Optional[int], limit: Optional[int]) -> None:
+    """Moves the old final payments to the archive table."""
+    click.echo(f'Archived {archiver.archive(after_days, limit)} B2B payment(s).')
+
+
+@archive_cli.command('rebuild-index')
+def rebuild_index_command() -> None:
+    """Rebuilds the Bloom filter of the archived PNRs."""
+    if not archive_index.path:
+        raise click.UsageError('ARCHIVE_PNR_INDEX_PATH is not set.')
+    with archive_index.locked():
+        click.echo(f'Indexed {archive_index.rebuild()} archived PNR(s).')
@@ -0,0 +1,64 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from flask import current_app
+from src.api_1_0.helpers.mpesa import MPESA
+from src.api_1_0.helpers.tenants import Tenant, tenants
+from src.api_1_0.helpers.validator import Validator
+from src.api_1_0.models.b2b import B2B
+
+
+class BatchInitiator:
+    """Initiates a batch of B2B payments, with a bounded number of concurrent Daraja calls."""
+
+    def __init__(self, items: List[Any]):
+        """Initializes the BatchInitiator class."""
+        self.items = items
+
+    def run(self) -> Iterator[Dict[str, Any]]:
+        """Yields a result per item, in the order they finish."""
+        app = current_app._get_current_object()
+        payments = dict()  # index -> validated payment
+        for index, item in enumerate(self.items):
+            data, error_message = Validator.validate(item if isinstance(item, dict) else None)
+            if error_message:
+                yield dict(index=index, status=400, error=error_message)
+            else:
+                payments[index] = data
+        if not payments:
+            return
+        # a single query for all the PNRs, instead of one per payment (the archived ones are told by
+        # the archive index, after each payment's INSERT)
+        pnrs = {str(data['pnr']) for data in payments.values()}
+        existing = {pnr for pnr, in B2B.query.with_entities(B2B.pnr).filter(B2B.pnr.in_(pnrs))}
+        secrets = dict()  # tenant -> (access token, security credential), shared by the tenant's payments
+        with ThreadPoolExecutor(max_workers=app.config['BATCH_MAX_CONCURRENCY']) as executor:
+            futures = dict()
+            for index, data in payments.items():
+                tenant = tenants.get(data.get('tenant'))
+                if tenant.name not in secrets:
+                    secrets[tenant.name] = BatchInitiator._shared_secrets(tenant)
+                access_token, credential = secrets[tenant.name]
+                mpesa = MPESA(data, access_token=access_token, security_credential=credential)
+                if str(data['pnr']) in existing:
+                    yield dict(index=index, status=400, **mpesa._duplicate_response()[0])
+                    continue
+                futures[executor.submit(BatchInitiator._initiate, app, mpesa)] = index
+            for future in as_completed(futures):
+                response, error = future.result()
+                yield dict(index=futures[future], status=400 if error else 201, **response)
+
+    @staticmethod
+    def _initiate(app: Any, mpesa: MPESA) -> Tuple[dict, bool]:
+        """Initiates one payment, on a pool thread."""
+        with app.app_context():
+            return mpesa.initiate_b2b()
+
+    @staticmethod
+    def _shared_secrets(tenant: Tenant) -> Tuple[Optional[str], Optional[str]]:
+        """Fetches the tenant's access token and security credential once for the whole batch."""
+        try:
+            return MPESA.generate_access_token(tenant), MPESA.security_credential(tenant)
+        except (FileNotFoundError, ValueError) as e:
+            # each payment will try (and report) on its own
+            current_app.logger.error('Failed to prepare the B2B batch ~>\n\t%s', e)
+            return None, None
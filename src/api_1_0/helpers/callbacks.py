@@ -0,0 +1,326 @@
+import atexit
+import json
+import os
+import queue
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from threading import Lock, Thread
+from typing import Any, Dict, Hashable, Iterator, List, Optional, Tuple
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from src.api_1_0.helpers.metrics import metrics
+from src.api_1_0.helpers.mpesa import MPESA
+from src.api_1_0.helpers.reconciler import Reconciler
+from src.api_1_0.models.b2b import B2B
+
+# tells a worker thread to flush what it has and exit
+_STOP = object()
+
+
+class TTLCache:
+    """A bounded set of keys, each forgotten `ttl` seconds after it was added (the oldest first when full)."""
+
+    def __init__(self, max_size: int, ttl: float):
+        """Initializes the TTLCache class."""
+        self.max_size = max_size
+        self.ttl = ttl
+        self._expires_at = OrderedDict()  # key -> expiry, in insertion (i.e. expiry) order
+        self._lock = Lock()
+
+    def add(self, key: Hashable) -> bool:
+        """Adds the key, returns False if it was already there."""
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            if key in self._expires_at:
+                return False
+            self._expires_at[key] = now + self.ttl
+            while len(self._expires_at) > self.max_size:
+                self._expires_at.popitem(last=False)
+            return True
+
+    def discard(self, key: Hashable) -> None:
+        with self._lock:
+            self._expires_at.pop(key, None)
+
+    def __contains__(self, key: Hashable) -> bool:
+        expires_at = self._expires_at.get(key)
+        return expires_at is not None and expires_at > time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._expires_at)
+
+    def _expire(self, now: float) -> None:
+        while self._expires_at:
+            key, expires_at = next(iter(self._expires_at.items()))
+            if expires_at > now:
+                break
+            del self._expires_at[key]
+
+
+class CallbackJournal:
+    """Appends the raw Daraja callbacks to NDJSON files, for audit and replay (`flask callbacks replay`).
+
+    Each process writes its own file per day, `callbacks-<YYYYMMDD>-<pid>.ndjson` in `directory`, through
+    a `buffer_size` write buffer that's flushed after each batch of callbacks (and when the process stops).
+    """
+
+    def __init__(self):
+        """Initializes the CallbackJournal class."""
+        self.directory = None
+        self.buffer_size = 65536
+        self._file = None
+        self._path = None
+        self._lock = Lock()
+        atexit.register(self.close)
+
+    def init_app(self, app: Any) -> None:
+        """Configures the journal (off unless CALLBACK_JOURNAL_DIR is set), and registers its commands."""
+        self.close()
+        self.directory = app.config.get('CALLBACK_JOURNAL_DIR')
+        self.buffer_size = app.config.get('CALLBACK_JOURNAL_BUFFER_SIZE', self.buffer_size)
+        app.cli.add_command(callbacks_cli)
+
+    def append(self, route: str, payload: Any) -> None:
+        """Buffers a callback as it was received."""
+        if not self.directory:
+            return
+        now = datetime.now(timezone.utc)
+        line = json.dumps(dict(received_at=now.isoformat(), route=route, payload=payload)) + '\n'
+        path = os.path.join(self.directory, f'callbacks-{now:%Y%m%d}-{os.getpid()}.ndjson')
+        with self._lock:
+            if path != self._path:
+                # a new day, or a forked (gunicorn) worker
+                self._close()
+                os.makedirs(self.directory, exist_ok=True)
+                self._file, self._path = open(path, 'a', buffering=self.buffer_size), path
+            self._file.write(line)
+
+    def flush(self) -> None:
+        """Writes the buffered callbacks to the file."""
+        with self._lock:
+            if self._file is not None and self._path.endswith(f'-{os.getpid()}.ndjson'):
+                self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._close()
+
+    def _close(self) -> None:
+        if self._file is not None and self._path.endswith(f'-{os.getpid()}.ndjson'):
+            self._file.close()
+        self._file, self._path = None, None
+
+    @staticmethod
+    def read(path: str) -> Iterator[Tuple[str, Any]]:
+        """Yields the (route, payload) of the callbacks of a journal file."""
+        with open(path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    yield entry['route'], entry['payload']
+
+
+class CallbackProcessor:
+    """Applies Daraja result callbacks in batches, with a bounded pool of worker threads.
+
+    Daraja redelivers results: a result already queued (same ConversationID, OriginatorConversationID
+    and ResultCode) or of a payment known to be in a final state is acknowledged without being queued.
+    """
+
+    def __init__(self):
+        """Initializes the CallbackProcessor class."""
+        self.app = None
+        self.workers = 2
+        self.batch_size = 200
+        self.batch_window = 0.2
+        self.enqueue_timeout = 1.0
+        self.queue = queue.Queue(maxsize=5000)
+        # the results queued (or being applied), and the payments known to be in a final state
+        self.seen = TTLCache(100000, 3600)
+        self.final = TTLCache(100000, 3600)
+        self._threads = []
+        self._pid = None
+        self._lock = Lock()
+        self._busy = 0
+        # counters, see `stats()`
+        self.received = 0
+        self.processed = 0
+        self.updated = 0
+        self.batches = 0
+        self.inline = 0
+        self.failed = 0
+        self.duplicates = 0
+        atexit.register(self.stop)
+
+    def init_app(self, app: Any) -> None:
+        """Configures the processor from the application config."""
+        self.stop()
+        self.app = app
+        self.workers = app.config.get('CALLBACK_WORKERS', self.workers)
+        self.batch_size = app.config.get('CALLBACK_BATCH_SIZE', self.batch_size)
+        self.batch_window = app.config.get('CALLBACK_BATCH_WINDOW', self.batch_window)
+        self.enqueue_timeout = app.config.get('CALLBACK_ENQUEUE_TIMEOUT', self.enqueue_timeout)
+        self.queue = queue.Queue(maxsize=app.config.get('CALLBACK_QUEUE_SIZE', 5000))
+        self.seen = TTLCache(app.config.get('CALLBACK_DEDUP_SIZE', 100000), app.config.get('CALLBACK_DEDUP_TTL', 3600))
+        self.final = TTLCache(app.config.get('CALLBACK_FINAL_CACHE_SIZE', 100000),
+                              app.config.get('CALLBACK_FINAL_CACHE_TTL', 3600))
+
+    def submit(self, result: Dict[str, Any]) -> bool:
+        """Queues a callback `Result` to be applied, returns False if it's a duplicate (and was dropped).
+
+        When the queue stays full for `enqueue_timeout` seconds the result is
+        applied on the caller's thread, so a callback is never dropped.
+        """
+        with self._lock:
+            self.received += 1
+        if CallbackProcessor._pair(result) in self.final or not self.seen.add(CallbackProcessor._key(result)):
+            with self._lock:
+                self.duplicates += 1
+            metrics.inc('mpesa_b2b_callbacks_total', outcome='duplicate')
+            return False
+        self._ensure_started()
+        try:
+            self.queue.put(result, timeout=self.enqueue_timeout)
+        except queue.Full:
+            self.app.logger.warning('ConversationID: %s | Callback queue is full, processing inline...',
+                                    result.get('ConversationID'))
+            with self._lock:
+                self.inline += 1
+            self._process([result])
+        return True
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the queue depth and processing counters of this process."""
+        return dict(
+            queue_depth=self.queue.qsize(),
+            queue_size=self.queue.maxsize,
+            workers=self.workers,
+            busy_workers=self._busy,
+            received=self.received,
+            processed=self.processed,
+            updated=self.updated,
+            batches=self.batches,
+            processed_inline=self.inline,
+            failed=self.failed,
+            duplicates=self.duplicates,
+            dedup_cache_size=len(self.seen),
+            final_cache_size=len(self.final)
+        )
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """Drains the queue and stops the worker threads."""
+        if self._pid == os.getpid():
+            alive = [thread for thread in self._threads if thread.is_alive()]
+            for _ in alive:
+                self.queue.put(_STOP)
+            for thread in alive:
+                thread.join(timeout)
+        self._threads, self._pid = [], None
+
+    def _ensure_started(self) -> None:
+        """Starts the worker threads of the current process (gunicorn forks after import),
+        and replaces those that died."""
+        if self._pid != os.getpid() or not all(thread.is_alive() for thread in self._threads):
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._threads, self._pid = [None] * self.workers, os.getpid()
+                for i, thread in enumerate(self._threads):
+                    if thread is None or not thread.is_alive():
+                        if thread is not None:
+                            self.app.logger.error('Callback worker %s died, restarting it.', thread.name)
+                        self._threads[i] = Thread(target=self._run, name=f'b2b-callbacks-{i}', daemon=True)
+                        self._threads[i].start()
+
+    def _run(self) -> None:
+        """Collects callbacks over a short window (or until the batch is full), then applies them."""
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is _STOP:
+                break
+            batch, deadline = [item], time.monotonic() + self.batch_window
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._process(batch)
+
+    def _process(self, batch: List[Dict[str, Any]]) -> None:
+        """Applies a batch of callbacks."""
+        with self._lock:
+            self._busy += 1
+        updated, failed, finalized = 0, 0, set()
+        try:
+            updated = MPESA.update_b2b_payments(self.app, batch, finalized)
+        except Exception as e:
+            # not only DB errors, a malformed callback mustn't take the worker thread down
+            failed = len(batch)
+            self.app.logger.error('Failed to apply a batch of %s callback(s) ~>\n\t%s', len(batch), e)
+            metrics.inc('mpesa_b2b_callbacks_total', failed, outcome='failed')
+        finally:
+            for pair in finalized:
+                self.final.add(pair)
+            for result in batch:
+                if CallbackProcessor._pair(result) not in finalized:
+                    # e.g. the payment isn't saved yet, let a redelivery try again
+                    self.seen.discard(CallbackProcessor._key(result))
+            callback_journal.flush()
+            with self._lock:
+                self._busy -= 1
+                self.batches += 1
+                self.processed += len(batch)
+                self.updated += updated
+                self.failed += failed
+
+    @staticmethod
+    def _pair(result: Dict[str, Any]) -> Tuple[Optional[str], Optional[str]]:
+        return result.get('ConversationID', '-1'), result.get('OriginatorConversationID', '-1')
+
+    @staticmethod
+    def _key(result: Dict[str, Any]) -> Tuple[Optional[str], Optional[str], str]:
+        return result.get('ConversationID', '-1'), result.get('OriginatorConversationID', '-1'), \
+            str(result.get('ResultCode'))
+
+
+# the process-wide callback processor and journal, configured in `create_app`
+callback_processor = CallbackProcessor()
+callback_journal = CallbackJournal()
+
+callbacks_cli = AppGroup('callbacks', help='Manages the Daraja result callbacks.')
+
+
+@callbacks_cli.command('replay')
+@click.argument('paths', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('--batch-size', type=int, default=200, help='Results applied per transaction.')
+def replay_command(paths: Tuple[str, ...], batch_size: int) -> None:
+    """Applies the callbacks of journal files again (results already applied are left as they are)."""
+    app = current_app._get_current_object()
+    batch, updated, count = [], 0, 0
+    for path in paths:
+        for route, payload in CallbackJournal.read(path):
+            result = payload.get('Result') if isinstance(payload, dict) else None
+            if not isinstance(result, dict) or route.endswith('/payment/status/timeout'):
+                continue
+            if route.endswith('/payment/status/result'):
+                result = Reconciler.payment_result(result)
+                if result is not None and not result['ConversationID']:
+                    result['ConversationID'] = B2B.query.with_entities(B2B.conversation_id) \
+                        .filter_by(originator_conversation_id=result['OriginatorConversationID']).scalar()
+            if result is None:
+                continue
+            batch.append(result)
+            count += 1
+            if len(batch) >= batch_size:
+                updated += MPESA.update_b2b_payments(app, batch)
+                batch = []
+    if batch:
+        updated += MPESA.update_b2b_payments(app, batch)
+    click.echo(f'Replayed {count} callback(s), {updated} B2B payment record(s) updated.')
@@ -0,0 +1,6 @@
+from datetime import datetime, timezone
+
+
+def utcnow() -> datetime:
+    """Returns the current (naive) UTC time, as stored in the DateTime columns."""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
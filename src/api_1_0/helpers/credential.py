@@ -0,0 +1,65 @@
+import base64
+import os
+import time
+from threading import Lock
+from typing import Any, Tuple
+from Crypto.PublicKey import RSA
+from Crypto.Cipher import PKCS1_v1_5
+
+
+class CredentialProvider:
+    """Computes the B2B SecurityCredential once and caches it until the certificate changes."""
+
+    def __init__(self, password: str = None, certificate_path: str = None):
+        """Initializes the CredentialProvider class."""
+        self.password = password
+        self.certificate_path = certificate_path
+        # how often (in seconds) the certificate is checked for changes, i.e. rotation
+        self.check_interval = 60
+        self._credential = None
+        self._signature = None  # (mtime, size) of the certificate used for the cached credential
+        self._checked_at = 0.0
+        self._lock = Lock()
+
+    def init_app(self, app: Any, password: str = None) -> None:
+        """Configures the provider from the application config."""
+        self.password = password if password is not None else app.config.get('B2B_INITIATOR_PASSWORD')
+        self.certificate_path = app.config['CERTIFICATE']
+        self.check_interval = app.config.get('CERTIFICATE_CHECK_INTERVAL', self.check_interval)
+        self._credential, self._signature, self._checked_at = None, None, 0.0
+        if app.config.get('PRELOAD_SECURITY_CREDENTIAL'):
+            self.get_credential()
+
+    def get_credential(self) -> str:
+        """Returns the (cached) encrypted initiator password."""
+        if self._credential and time.monotonic() - self._checked_at < self.check_interval:
+            return self._credential
+        with self._lock:
+            signature = self._stat()
+            if self._credential is None or signature != self._signature:
+                self._credential = CredentialProvider.encrypt(self.password, self._load_key())
+                self._signature = signature
+            self._checked_at = time.monotonic()
+            return self._credential
+
+    def _stat(self) -> Tuple[float, int]:
+        """Returns the modification time and size of the certificate."""
+        try:
+            stat = os.stat(self.certificate_path)
+        except (OSError, TypeError):
+            raise FileNotFoundError(f"Certificate file not found at: {self.certificate_path}")
+        return stat.st_mtime, stat.st_size
+
+    def _load_key(self) -> Any:
+        """Reads and parses the certificate."""
+        with open(self.certificate_path, 'r') as certificate:
+            return RSA.importKey(certificate.read())
+
+    @staticmethod
+    def encrypt(password: str, key: Any) -> str:
+        """Encrypts the password using the public key provided."""
+        return base64.b64encode(PKCS1_v1_5.new(key).encrypt(password.encode())).decode()
+
+
+# the process-wide credential provider, configured in `create_app`
+credential_provider = CredentialProvider()
@@ -1,2 +1,14 @@
 class ValidationError(Exception):
     pass
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class RateLimitedError(Exception):
+    pass
+
+
+class ConfigurationError(Exception):
+    pass
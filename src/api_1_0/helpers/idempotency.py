@@ -0,0 +1,133 @@
+import sqlite3
+import time
+from collections import OrderedDict
+from threading import Lock, local
+from typing import Any
+
+
+class SQLiteReservations:
+    """PNR reservations shared by the workers of a host, through a local SQLite file."""
+
+    def __init__(self, path: str, reservation_ttl: float, completed_ttl: float):
+        """Initializes the SQLiteReservations class."""
+        self.path = path
+        # an in-flight reservation left behind by a dead worker expires after `reservation_ttl`
+        self.reservation_ttl = reservation_ttl
+        self.completed_ttl = completed_ttl
+        self._local = local()
+        with self._connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS pnr_reservations '
+                         '(pnr TEXT PRIMARY KEY, expires_at REAL NOT NULL)')
+
+    def _connection(self) -> sqlite3.Connection:
+        """Returns the connection of the current thread."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def reserve(self, pnr: str) -> bool:
+        """Atomically reserves the PNR, returns False if it's already reserved."""
+        conn, now = self._connection(), time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('DELETE FROM pnr_reservations WHERE pnr = ? AND expires_at < ?', (pnr, now))
+            reserved = conn.execute('INSERT OR IGNORE INTO pnr_reservations (pnr, expires_at) VALUES (?, ?)',
+                                    (pnr, now + self.reservation_ttl)).rowcount == 1
+            conn.execute('COMMIT')
+        except sqlite3.Error:
+            conn.execute('ROLLBACK')
+            raise
+        return reserved
+
+    def complete(self, pnr: str) -> None:
+        """Keeps the PNR reserved for a while after the payment was initiated."""
+        self._connection().execute('UPDATE pnr_reservations SET expires_at = ? WHERE pnr = ?',
+                                   (time.time() + self.completed_ttl, pnr))
+
+    def release(self, pnr: str) -> None:
+        """Drops the reservation."""
+        self._connection().execute('DELETE FROM pnr_reservations WHERE pnr = ?', (pnr,))
+
+    def prune(self) -> None:
+        """Drops the expired reservations."""
+        self._connection().execute('DELETE FROM pnr_reservations WHERE expires_at < ?', (time.time(),))
+
+
+class PNRGuard:
+    """Rejects duplicate PNRs before they reach the database or Daraja.
+
+    Tracks the PNRs in flight in this process plus an LRU of recently initiated ones,
+    and optionally shares reservations with the other workers through a SQLite file.
+    """
+
+    def __init__(self, max_recent: int = 10000):
+        """Initializes the PNRGuard class."""
+        self.max_recent = max_recent
+        self.shared = None
+        self._in_flight = set()
+        self._recent = OrderedDict()
+        self._lock = Lock()
+        self._reservations = 0
+
+    def init_app(self, app: Any) -> None:
+        """Configures the guard from the application config."""
+        self.max_recent = app.config.get('RECENT_PNR_CACHE_SIZE', self.max_recent)
+        self._in_flight, self._recent = set(), OrderedDict()
+        path = app.config.get('PNR_GUARD_SQLITE_PATH')
+        self.shared = SQLiteReservations(
+            path,
+            app.config.get('PNR_RESERVATION_TTL', 300),
+            app.config.get('PNR_COMPLETED_TTL', 3600)
+        ) if path else None
+
+    def reserve(self, pnr: str) -> bool:
+        """Reserves the PNR for a payment, returns False if it's a duplicate."""
+        with self._lock:
+            if pnr in self._in_flight or pnr in self._recent:
+                return False
+            self._in_flight.add(pnr)
+            self._reservations += 1
+            prune = self._reservations % 1000 == 0
+        if self.shared is not None:
+            try:
+                if prune:
+                    self.shared.prune()
+                if not self.shared.reserve(pnr):
+                    with self._lock:
+                        self._in_flight.discard(pnr)
+                    return False
+            except sqlite3.Error:
+                # never let the shared guard take payments down, the DB check still applies
+                pass
+        return True
+
+    def complete(self, pnr: str) -> None:
+        """Marks the PNR as used, duplicates are rejected from memory from now on."""
+        with self._lock:
+            self._in_flight.discard(pnr)
+            self._recent[pnr] = True
+            self._recent.move_to_end(pnr)
+            while len(self._recent) > self.max_recent:
+                self._recent.popitem(last=False)
+        self._shared('complete', pnr)
+
+    def release(self, pnr: str) -> None:
+        """Releases the PNR of a payment that wasn't initiated."""
+        with self._lock:
+            self._in_flight.discard(pnr)
+        self._shared('release', pnr)
+
+    def _shared(self, method: str, pnr: str) -> None:
+        """Forwards a call to the shared reservations (if any)."""
+        if self.shared is not None:
+            try:
+                getattr(self.shared, method)(pnr)
+            except sqlite3.Error:
+                pass
+
+
+# the process-wide PNR guard, configured in `create_app`
+pnr_guard = PNRGuard()
@@ -0,0 +1,181 @@
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import random
+import re
+import time
+from logging.handlers import QueueHandler, QueueListener
+from threading import Lock
+from typing import Any, Dict, Iterable
+from flask import g, has_request_context, request
+
+# the attributes of every LogRecord, anything else was passed with `extra=`
+_RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+REDACTED = '***'
+
+
+def redact(value: Any, keys: frozenset) -> Any:
+    """Returns a copy of the value, without the values of the (nested) keys to redact."""
+    if isinstance(value, dict):
+        return {k: REDACTED if k in keys else redact(v, keys) for k, v in value.items()}
+    if isinstance(value, (list, tuple)) and type(value) in (list, tuple):
+        return type(value)(redact(v, keys) for v in value)
+    return value
+
+
+class StructuredFormatter(logging.Formatter):
+    """Formats records as JSON lines (or text), with their `extra` fields and secrets redacted."""
+
+    def __init__(self, redacted_keys: Iterable[str], json_lines: bool = True):
+        """Initializes the StructuredFormatter class."""
+        super().__init__('[%(asctime)s] %(levelname)s in %(module)s: %(message)s')
+        self.redacted_keys = frozenset(redacted_keys)
+        self.json_lines = json_lines
+        # for secrets already rendered in a message, e.g. "{'SecurityCredential': '...'}"
+        self._pattern = re.compile(r"""(['"]?\b(?:%s)['"]?\s*[:=]\s*)(['"])(?:(?!\2).)*\2""" %
+                                   '|'.join(map(re.escape, self.redacted_keys)))
+
+    def format(self, record: logging.LogRecord) -> str:
+        record = copy.copy(record)
+        if record.args:
+            record.args = redact(record.args, self.redacted_keys)
+        message = self._pattern.sub(rf'\1\2{REDACTED}\2', record.getMessage())
+        fields = {k: redact(v, self.redacted_keys) for k, v in vars(record).items() if k not in _RECORD_ATTRIBUTES}
+        if not self.json_lines:
+            record.msg, record.args = message + (f' {json.dumps(fields, default=str)}' if fields else ''), None
+            return super().format(record)
+        entry = dict(time=self.formatTime(record), level=record.levelname, logger=record.name, message=message)
+        entry.update(fields)
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class _QueueHandler(QueueHandler):
+    """Hands the records over to the pipeline's queue, leaving the formatting to its listener thread."""
+
+    def __init__(self, pipeline: 'LogPipeline'):
+        super().__init__(None)
+        self.pipeline = pipeline
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # only snapshot the arguments that may be changed by the caller in the meantime
+        record = copy.copy(record)
+        if isinstance(record.args, dict):
+            record.args = copy.copy(record.args)
+        elif record.args:
+            record.args = tuple(copy.copy(a) if isinstance(a, (dict, list)) else a for a in record.args)
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        self.pipeline.put(record)
+
+
+class _QueueListener(QueueListener):
+    def enqueue_sentinel(self) -> None:
+        # wait for room, rather than failing to stop when the queue is full
+        self.queue.put(self._sentinel)
+
+
+class LogPipeline:
+    """Writes the app's log records from a background thread, and logs each request in one line.
+
+    Request threads only put records on a bounded queue (records are dropped rather than
+    blocking when it's full); below WARNING, only a sample of the requests (per route) is logged.
+    """
+
+    def __init__(self):
+        """Initializes the LogPipeline class."""
+        self.app = None
+        self.queue_size = 10000
+        self.sample_rate = 1.0
+        self.sample_rates = dict()  # endpoint -> share of the requests to log
+        self.handlers = []
+        self.queue = None
+        self.dropped = 0
+        self._listener = None
+        self._pid = None
+        self._lock = Lock()
+        atexit.register(self.stop)
+
+    def init_app(self, app: Any) -> None:
+        """Moves the app's log handlers behind the queue, and registers the request hooks."""
+        self.install(app)
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+
+    def install(self, app: Any) -> None:
+        """Moves the app's log handlers behind the queue, e.g. the (Quart) app whose requests it can't hook into."""
+        self.stop()
+        self.app = app
+        self.queue_size = app.config.get('LOG_QUEUE_SIZE', self.queue_size)
+        self.sample_rate = app.config.get('LOG_SAMPLE_RATE', self.sample_rate)
+        self.sample_rates = app.config.get('LOG_SAMPLE_RATES', self.sample_rates)
+        if app.config.get('LOG_LEVEL'):
+            app.logger.setLevel(app.config['LOG_LEVEL'])
+        formatter = StructuredFormatter(app.config.get('LOG_REDACTED_KEYS', ('SecurityCredential',)),
+                                        json_lines=app.config.get('LOG_FORMAT', 'json') == 'json')
+        self.handlers = [h for h in app.logger.handlers if not isinstance(h, _QueueHandler)]
+        for handler in self.handlers:
+            handler.setFormatter(formatter)
+        handler = _QueueHandler(self)
+        handler.addFilter(self.sample)
+        app.logger.handlers = [handler]
+
+    def put(self, record: logging.LogRecord) -> None:
+        """Queues a record, without ever blocking the caller."""
+        self._ensure_started()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self) -> None:
+        """Writes the queued records, and stops the listener thread."""
+        if self._listener is not None and self._pid == os.getpid():
+            self._listener.stop()
+        self._listener, self._pid = None, None
+
+    def sample(self, record: logging.LogRecord) -> bool:
+        """Drops the records below WARNING of the requests left out of the sample."""
+        return record.levelno >= logging.WARNING or not has_request_context() or g.get('log_sampled', True)
+
+    def before_request(self) -> None:
+        """Decides whether the request is logged, and logs its body (in debug)."""
+        g.log_started = time.perf_counter()
+        g.log_sampled = random.random() < self.sample_rates.get(request.endpoint, self.sample_rate)
+        if self.app.logger.isEnabledFor(logging.DEBUG):
+            self.app.logger.debug('Request %s %s', request.method, request.path,
+                                  extra=dict(headers=dict(request.headers), body=request.get_data(as_text=True)))
+
+    def after_request(self, response: Any) -> Any:
+        """Logs the request in one line, and the response body (in debug)."""
+        if self.app.logger.isEnabledFor(logging.INFO):
+            duration = (time.perf_counter() - g.get('log_started', time.perf_counter())) * 1000
+            self.app.logger.info('%s %s %s', request.method, request.path, response.status_code,
+                                 extra=dict(route=request.endpoint, status=response.status_code,
+                                            duration_ms=round(duration, 2)))
+        if self.app.logger.isEnabledFor(logging.DEBUG) and not response.is_streamed:
+            self.app.logger.debug('Response %s', response.status_code, extra=dict(body=response.get_data(as_text=True)))
+        return response
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the state of the queue."""
+        return dict(queue_depth=self.queue.qsize() if self.queue else 0, dropped=self.dropped)
+
+    def _ensure_started(self) -> None:
+        """Starts the listener thread of the current process (gunicorn forks after import)."""
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self.queue = queue.Queue(maxsize=self.queue_size)
+                    self._listener = _QueueListener(self.queue, *self.handlers, respect_handler_level=True)
+                    self._listener.start()
+                    self._pid = os.getpid()
+
+
+# the process-wide log pipeline, configured in `create_app`
+log_pipeline = LogPipeline()
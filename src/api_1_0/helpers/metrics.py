@@ -0,0 +1,230 @@
+import atexit
+import bisect
+import glob
+import json
+import os
+import time
+import uuid
+from contextlib import contextmanager
+from threading import Lock, Thread
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+# histogram buckets, in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# the histogram of the time spent in each phase, labelled with the operation and the phase
+PHASE_SECONDS = 'mpesa_b2b_phase_seconds'
+
+# the file (in `METRICS_DIR`) holding the totals of the workers that exited
+RETIRED_FILE = 'retired.json'
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Metrics:
+    """Low-overhead counters and histograms, exposed in the Prometheus text format.
+
+    Each (gunicorn) worker keeps its own metrics in memory; when `METRICS_DIR` is set,
+    workers periodically dump them there so that `/metrics` can aggregate all of them.
+    The file of a worker that exited is folded into the totals of the retired workers
+    (see `retire`), so that counters never go backwards and the directory doesn't grow.
+    """
+
+    def __init__(self):
+        """Initializes the Metrics class."""
+        self.directory = None
+        self.flush_interval = 5.0
+        self._counters = dict()  # (name, labels) -> value
+        self._histograms = dict()  # (name, labels) -> [bucket counts..., +Inf count, sum]
+        self._help = dict()
+        self._lock = Lock()
+        self._thread = None
+        self._pid = None
+        self._worker = None  # (pid, a random token), told apart from a later process with the same pid
+
+    def init_app(self, app: Any) -> None:
+        """Configures the metrics from the application config."""
+        self.directory = app.config.get('METRICS_DIR')
+        self.flush_interval = app.config.get('METRICS_FLUSH_INTERVAL', self.flush_interval)
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        """Increments a counter."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+        self._ensure_flushing()
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        """Records an observation (in seconds) in a histogram."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+            histogram[bisect.bisect_left(BUCKETS, value)] += 1
+            histogram[-1] += value
+        self._ensure_flushing()
+
+    @contextmanager
+    def timer(self, name: str, **labels: str) -> Iterator[None]:
+        """Times the block, in a histogram."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def describe(self, name: str, description: str) -> None:
+        """Sets the help text of a metric."""
+        self._help[name] = description
+
+    def snapshot(self) -> Dict[str, List]:
+        """Returns the metrics of this process, in a JSON-friendly form."""
+        with self._lock:
+            return {
+                'counters': [[name, list(labels), value] for (name, labels), value in self._counters.items()],
+                'histograms': [[name, list(labels), list(h)] for (name, labels), h in self._histograms.items()]
+            }
+
+    @staticmethod
+    def merge(snapshots: Iterable[Dict[str, List]]) -> Tuple[Dict[Tuple[str, Labels], float],
+                                                              Dict[Tuple[str, Labels], List[float]]]:
+        """Sums the snapshots up, returns their counters and histograms by (name, labels)."""
+        counters, histograms = dict(), dict()
+        for snapshot in snapshots:
+            for name, labels, value in snapshot['counters']:
+                key = (name, tuple(tuple(label) for label in labels))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, values in snapshot['histograms']:
+                key = (name, tuple(tuple(label) for label in labels))
+                merged = histograms.setdefault(key, [0] * len(values))
+                for i, value in enumerate(values):
+                    merged[i] += value
+        return counters, histograms
+
+    def render(self) -> str:
+        """Renders the metrics of every worker in the Prometheus text format."""
+        counters, histograms = Metrics.merge(self._snapshots())
+        lines = []
+        for metric_type, metrics in (('counter', counters), ('histogram', histograms)):
+            for name in sorted({name for name, _ in metrics}):
+                if name in self._help:
+                    lines.append(f'# HELP {name} {self._help[name]}')
+                lines.append(f'# TYPE {name} {metric_type}')
+                for (metric, labels), value in sorted(metrics.items()):
+                    if metric != name:
+                        continue
+                    if metric_type == 'counter':
+                        lines.append(f'{name}{Metrics._labels(labels)} {value}')
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(BUCKETS + ('+Inf',), value[:-1]):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{Metrics._labels(labels + (("le", str(bound)),))} {cumulative}')
+                    lines.append(f'{name}_sum{Metrics._labels(labels)} {value[-1]}')
+                    lines.append(f'{name}_count{Metrics._labels(labels)} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+    def flush(self) -> None:
+        """Dumps the metrics of this process to the metrics directory."""
+        if not self.directory:
+            return
+        if self._worker is None or self._worker[0] != os.getpid():
+            self._worker = (os.getpid(), uuid.uuid4().hex)
+        Metrics._dump(os.path.join(self.directory, f'{os.getpid()}.json'),
+                      dict(self.snapshot(), worker='{}-{}'.format(*self._worker)))
+
+    @staticmethod
+    def retire(directory: Optional[str], pid: int) -> None:
+        """Folds the metrics file of an exited worker into the retired workers' totals, and removes it.
+
+        Called by the gunicorn master (see `child_exit` in gunicorn.conf.py), one worker at a time.
+        """
+        path = os.path.join(directory or '', f'{pid}.json')
+        if not directory or not os.path.exists(path):
+            return
+        retired, worker = Metrics._load(os.path.join(directory, RETIRED_FILE)), Metrics._load(path)
+        if worker is None:
+            os.remove(path)
+            return
+        retired = retired or dict(counters=[], histograms=[], folded=[])
+        counters, histograms = Metrics.merge([retired, worker])
+        # the folded files are skipped by `render` until they're removed (by the next call at the latest)
+        folded = [worker_id for worker_id in retired['folded']
+                  if os.path.exists(os.path.join(directory, '{}.json'.format(worker_id.split('-')[0])))]
+        Metrics._dump(os.path.join(directory, RETIRED_FILE), dict(
+            counters=[[name, list(labels), value] for (name, labels), value in counters.items()],
+            histograms=[[name, list(labels), values] for (name, labels), values in histograms.items()],
+            folded=folded + [worker.get('worker', str(pid))]
+        ))
+        os.remove(path)
+
+    def _snapshots(self) -> List[Dict[str, List]]:
+        """Returns the snapshots of every worker, this one being up to date."""
+        if not self.directory:
+            return [self.snapshot()]
+        self.flush()
+        retired_path = os.path.join(self.directory, RETIRED_FILE)
+        snapshots = [Metrics._load(path) for path in glob.glob(os.path.join(self.directory, '*.json'))
+                     if path != retired_path]
+        # read last: a worker file gone in the meantime was folded into it, one still read is skipped
+        retired = Metrics._load(retired_path) or dict(counters=[], histograms=[], folded=[])
+        folded = set(retired['folded'])
+        return [retired] + [snapshot for snapshot in snapshots
+                            if snapshot is not None and snapshot.get('worker') not in folded]
+
+    @staticmethod
+    def _load(path: str) -> Optional[Dict[str, List]]:
+        """Reads a snapshot, None if it's gone (or being written, on platforms without atomic replaces)."""
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _dump(path: str, snapshot: Dict[str, Any]) -> None:
+        """Writes a snapshot atomically."""
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(f'{path}.tmp', path)
+
+    def _ensure_flushing(self) -> None:
+        """Starts the flushing thread of the current process (if there is a metrics directory)."""
+        if self.directory and self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._pid = os.getpid()
+                    self._thread = Thread(target=self._flush_periodically, name='b2b-metrics', daemon=True)
+                    self._thread.start()
+                    # the last metrics of a worker exiting (gracefully) are kept too
+                    atexit.register(self.flush)
+
+    def _flush_periodically(self) -> None:
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError:
+                pass
+
+    @staticmethod
+    def _labels(labels: Labels) -> str:
+        if not labels:
+            return ''
+        escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in labels)
+        return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + '}'
+
+
+# the process-wide metrics, configured in `create_app`
+metrics = Metrics()
+metrics.describe(PHASE_SECONDS, 'Time spent in each phase of the B2B payment flow.')
+metrics.describe('mpesa_b2b_payments_total', 'Outcome of B2B payment initiations.')
+metrics.describe('mpesa_b2b_upstream_errors_total', 'Error codes returned by the Daraja B2B API.')
+metrics.describe('mpesa_b2b_callbacks_total', 'Outcome of Daraja result callbacks.')
+metrics.describe('mpesa_b2b_archived_total', 'B2B payments moved to the archive table.')
+metrics.describe('mpesa_b2b_archive_lookups_total', 'Archived PNR checks, skipped (Bloom filter) or queried.')
+metrics.describe('mpesa_b2b_unknown_payments_total', 'B2B payments of unknown outcome, left to an operator.')
+metrics.describe('mpesa_b2b_webhooks_total', 'Webhook notifications delivered, retried or given up on.')
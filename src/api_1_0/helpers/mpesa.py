@@ -1,123 +1,431 @@
 import base64
 import os
+from datetime import datetime
 import requests
-from threading import Thread
-from typing import Any, Tuple, Dict
+from typing import Any, Callable, Tuple, Dict, List, Optional, Set
 from flask import current_app
 from Crypto.PublicKey import RSA
 from Crypto.Cipher import PKCS1_v1_5
 from requests.auth import HTTPBasicAuth
-from src import db
+from urllib3.exceptions import NewConnectionError
+from sqlalchemy import and_, case, select, tuple_, update
+from sqlalchemy.exc import SQLAlchemyError
+from src import db, db_router
+from src.api_1_0.helpers.archive import archive_index
+from src.api_1_0.helpers.exceptions import CircuitOpenError, RateLimitedError
+from src.api_1_0.helpers.idempotency import pnr_guard
+from src.api_1_0.helpers.metrics import PHASE_SECONDS, metrics
+from src.api_1_0.helpers.persistence import persistence_worker, release_payment, reserve_payment
+from src.api_1_0.helpers.resilience import CircuitBreaker, RateLimiter, oauth_breaker, rate_limiter, \
+    remittax_breaker, transaction_status_breaker
+from src.api_1_0.helpers.tenants import Tenant, tenants
+from src.api_1_0.helpers.webhooks import WebhookDispatcher, webhook_dispatcher
 from src.api_1_0.models.b2b import B2B, StatusEnum
 
+# the columns set from a payment's result, see `MPESA.result_details`
+RESULT_COLUMNS = ('result_code', 'result_description', 'receipt', 'transaction_amount', 'completed_on')
+
 
 class MPESA:
     """A class that handles all MPESA related transactions."""
 
-    def __init__(self, req: dict):
-        """Initializes the MPESA class."""
+    def __init__(self, req: dict, access_token: str = None, security_credential: str = None):
+        """Initializes the MPESA class.
+
+        A batch of payments can share an access token and security credential, fetched once upfront.
+        The payment is made from the shortcode of its `tenant` (the default one if it has none).
+        """
         self.data = req
+        self.access_token = access_token
+        self.credential = security_credential
         # final response template to be returned to the client
         self.response = dict(status_message='', status_code='', account_reference=self.data['pnr'])
 
+    @property
+    def tenant(self) -> Tenant:
+        """The tenant of the payment, raises a ValueError if it's unknown."""
+        tenant = tenants.get(self.data.get('tenant'))
+        if tenant is None:
+            raise ValueError(f"Unknown tenant: {self.data.get('tenant')}")
+        return tenant
+
     def initiate_b2b(self) -> Tuple[dict, bool]:
         """Initiates a B2B payment."""
-        with current_app.app_context():
-            current_app.logger.info(f"PNR: {self.data['pnr']} | Initiating B2B payment...")
-            record = B2B.query.filter_by(pnr=self.data['pnr']).first()
-            if record is None:
-                response, err = dict(), ''
+        with current_app.app_context(), metrics.timer(PHASE_SECONDS, operation='initiate_b2b', phase='total'):
+            current_app.logger.info('PNR: %s | Initiating B2B payment...', self.data['pnr'])
+            # reserve the PNR before anything else, so that retries of the same PNR
+            # are rejected without a DB round trip while this one is in flight
+            with metrics.timer(PHASE_SECONDS, operation='initiate_b2b', phase='pnr_guard'):
+                reserved = pnr_guard.reserve(self.data['pnr'])
+            if not reserved:
+                return self._duplicate_response()
+            settled = False  # whether the PNR is now taken for good
+            try:
+                # the payment is saved (QUEUED for the outbox dispatcher, or PENDING until Daraja
+                # accepts it) by a single INSERT, which also tells whether the PNR is taken
+                outbox = current_app.config['OUTBOX_MODE']
+                status = StatusEnum.QUEUED if outbox else StatusEnum.PENDING
                 try:
-                    endpoint = '{}/mpesa/b2b/v1/remittax'.format(os.environ.get('B2B_BASE_URL'))
-                    headers = {
-                        'Content-Type': 'application/json',
-                        'Authorization': 'Bearer {}'.format(MPESA.generate_access_token())
-                    }
-                    payload = self._build_b2b_payload(current_app.config['CERTIFICATE'])  # this may throw an error
-                    current_app.logger.debug(f"PNR: {self.data['pnr']} | with payload ~>\n\t{payload}")
-                    response = requests.post(url=endpoint, json=payload, headers=headers)
-                    # Not liking this as we need to check for the returned status code
-                    # but the daraja API returns a 200 status code even when the request fails,
-                    # so we have to check for the errorCode in the response body
-                    response = response.json()
-                    current_app.logger.info(f"PNR: {self.data['pnr']} | B2B API response ~>\n\t{response}")
-                except (FileNotFoundError, ValueError, requests.ConnectTimeout, requests.RequestException) as e:
-                    current_app.logger.error(f"PNR: {self.data['pnr']} | An error occurred "
-                                             f"while initiating B2B payment ~>\n\t{e}")
-                    err = f'An error occurred while initiating B2B payment: {e}'
-                if err or response.get('errorCode') or \
-                        'ConversationID' not in response.keys() or \
-                        'OriginatorConversationID' not in response.keys():  # is this even needed?
-                    current_app.logger.error(f"PNR: {self.data['pnr']} | Failed to initiate B2B payment")
-                    self.response['status_code'] = current_app.config['GENERIC_FAILURE_CODE']
-                    self.response['status_message'] = 'Failed to initiate B2B payment.'
-                    return self.response, True
-                current_app.logger.info(f"PNR: {self.data['pnr']} | B2B payment initiated successfully")
-                # save the B2B payment record by spawning a new thread
-                Thread(
-                    target=self._create_b2b_payment,
-                    args=(current_app._get_current_object(), response['OriginatorConversationID'],
-                          response['ConversationID'])
-                ).start()
-                # formulate a success response message
-                self.response['status_code'] = current_app.config['MPESA_B2B_SUCCESS_CODE']
-                self.response['status_message'] = 'B2B payment initiated successfully.'
-                return self.response, False
-            # formulate a generic failure response
-            current_app.logger.error(f"PNR: {self.data['pnr']} | A similar B2B payment already exists.")
-            self.response['status_code'] = current_app.config['GENERIC_FAILURE_CODE']
-            self.response['status_message'] = 'A similar B2B payment already exists.'
-            return self.response, True
-
-    def _build_b2b_payload(self, certificate_path: str) -> Dict[str, str]:
+                    with metrics.timer(PHASE_SECONDS, operation='initiate_b2b', phase='pnr_reserve'):
+                        saved = reserve_payment(dict(amount=self.data['amount'], pnr=self.data['pnr'],
+                                                     tenant=self.tenant.name,
+                                                     callback_url=self.data.get('callback_url'), status=status))
+                    # then the archive, in memory unless the Bloom filter has the PNR (see `ArchiveIndex`);
+                    # checked after the INSERT, the archiver can't move the PNR out of the way in between
+                    with metrics.timer(PHASE_SECONDS, operation='initiate_b2b', phase='pnr_lookup'):
+                        archived = saved and bool(archive_index.archived([self.data['pnr']]))
+                    if archived:
+                        release_payment(self.data['pnr'], status)
+                except SQLAlchemyError as e:
+                    current_app.logger.error('PNR: %s | Failed to save B2B payment ~>\n\t%s', self.data['pnr'], e)
+                    return self._failure_response()
+                if not saved or archived:
+                    settled = True
+                    return self._duplicate_response()
+                # the replicas may not have the payment yet, its reads go to the primary for a while
+                db_router.pin(self.data['pnr'])
+                if outbox:
+                    response, err = self._queue_b2b()
+                else:
+                    response, err = self._send_b2b()
+                settled = not err
+                return response, err
+            finally:
+                if settled:
+                    pnr_guard.complete(self.data['pnr'])
+                else:
+                    # the payment wasn't initiated, the client may try again
+                    pnr_guard.release(self.data['pnr'])
+
+    def _send_b2b(self) -> Tuple[dict, bool]:
+        """Sends the (saved) B2B payment to Daraja, and records its conversation IDs if it was accepted."""
+        response, rejected = self._request_b2b()
+        if response is None and not rejected:
+            # Daraja may have accepted it: the PNR stays taken, and the payment is flagged for an operator
+            # to settle if its conversation IDs never come (see `Reconciler.flag_unknown`)
+            return self._unknown_response()
+        if response is None:
+            try:
+                release_payment(self.data['pnr'])
+            except SQLAlchemyError as e:
+                current_app.logger.error('PNR: %s | Failed to release the PNR ~>\n\t%s', self.data['pnr'], e)
+            return self._failure_response()
+        # record the conversation IDs, in the background
+        self._create_b2b_payment(response['OriginatorConversationID'], response['ConversationID'])
+        metrics.inc('mpesa_b2b_payments_total', outcome='initiated')
+        # formulate a success response message
+        self.response['status_code'] = current_app.config['MPESA_B2B_SUCCESS_CODE']
+        self.response['status_message'] = 'B2B payment initiated successfully.'
+        return self.response, False
+
+    def _queue_b2b(self) -> Tuple[dict, bool]:
+        """Responds for a payment saved to the outbox, it's sent to Daraja by the outbox dispatcher."""
+        current_app.logger.info('PNR: %s | B2B payment queued successfully', self.data['pnr'])
+        metrics.inc('mpesa_b2b_payments_total', outcome='queued')
+        self.response['status_code'] = current_app.config['MPESA_B2B_SUCCESS_CODE']
+        self.response['status_message'] = 'B2B payment queued successfully.'
+        return self.response, False
+
+    def _failure_response(self) -> Tuple[dict, bool]:
+        """Formulates the response for a payment that couldn't be initiated."""
+        metrics.inc('mpesa_b2b_payments_total', outcome='failed')
+        self.response['status_code'] = current_app.config['GENERIC_FAILURE_CODE']
+        self.response['status_message'] = 'Failed to initiate B2B payment.'
+        return self.response, True
+
+    def _unknown_response(self) -> Tuple[dict, bool]:
+        """Formulates the response for a payment that Daraja may have accepted."""
+        metrics.inc('mpesa_b2b_payments_total', outcome='unknown')
+        self.response['status_code'] = current_app.config['GENERIC_FAILURE_CODE']
+        self.response['status_message'] = 'B2B payment outcome unknown, it is being confirmed.'
+        return self.response, True
+
+    def _request_b2b(self) -> Tuple[Optional[Dict[str, Any]], bool]:
+        """Calls the B2B API, returns its response if the request was accepted (None otherwise),
+        and whether it was definitely rejected.
+
+        A request that never reached Daraja, or that Daraja answered with an `errorCode`, was rejected
+        and can be sent again. Any other failure (e.g. a read timeout, or a 5xx response) is ambiguous:
+        Daraja may have accepted the payment, so sending it again risks paying twice.
+        """
+        response, err, rejected, sending = dict(), '', False, False
+        try:
+            # keep under Daraja's TPS, failing fast rather than queueing up for too long
+            with metrics.timer(PHASE_SECONDS, operation='initiate_b2b', phase='rate_limit'):
+                acquired = self.tenant.rate_limiter.acquire()
+            if not acquired:
+                raise RateLimitedError('Too many B2B requests, try again later.')
+            endpoint = self.tenant.settings.remittax_url
+            with metrics.timer(PHASE_SECONDS, operation='initiate_b2b', phase='access_token'):
+                access_token = self.access_token or MPESA.generate_access_token(self.tenant)
+            headers = {
+                'Content-Type': 'application/json',
+                'Authorization': 'Bearer {}'.format(access_token)
+            }
+            payload = self._build_b2b_payload()  # this may throw an error
+            current_app.logger.debug('PNR: %s | with payload ~>\n\t%s', self.data['pnr'], payload)
+            with metrics.timer(PHASE_SECONDS, operation='initiate_b2b', phase='daraja_request'):
+                sending = True
+                response = MPESA._guarded(remittax_breaker, self.tenant.transport.post, self.tenant.rate_limiter,
+                                          url=endpoint, json=payload, headers=headers)
+                # Not liking this as we need to check for the returned status code
+                # but the daraja API returns a 200 status code even when the request fails,
+                # so we have to check for the errorCode in the response body
+                response = response.json()
+            current_app.logger.info('PNR: %s | B2B API response ~>\n\t%s', self.data['pnr'], response)
+            if response.get('errorCode') == current_app.config['MPESA_INVALID_TOKEN_CODE']:
+                # the cached token was revoked upstream, make sure the next call fetches a new one
+                self.tenant.token_manager.invalidate()
+        except (FileNotFoundError, ValueError, requests.ConnectTimeout, requests.RequestException,
+                CircuitOpenError, RateLimitedError) as e:
+            current_app.logger.error('PNR: %s | An error occurred while initiating B2B payment ~>\n\t%s',
+                                     self.data['pnr'], e)
+            err = f'An error occurred while initiating B2B payment: {e}'
+            rejected = not sending or MPESA._not_sent(e)
+            metrics.inc('mpesa_b2b_upstream_errors_total', code=type(e).__name__)
+        if response.get('errorCode'):
+            rejected = True
+            metrics.inc('mpesa_b2b_upstream_errors_total', code=response['errorCode'])
+        if err or response.get('errorCode') or \
+                'ConversationID' not in response.keys() or \
+                'OriginatorConversationID' not in response.keys():  # is this even needed?
+            current_app.logger.error('PNR: %s | Failed to initiate B2B payment (%s)', self.data['pnr'],
+                                     'rejected' if rejected else 'outcome unknown')
+            return None, rejected
+        current_app.logger.info('PNR: %s | B2B payment initiated successfully', self.data['pnr'])
+        return response, False
+
+    @staticmethod
+    def _not_sent(error: Exception) -> bool:
+        """Whether a Daraja request failed before reaching Daraja (refused, or never attempted)."""
+        if isinstance(error, (CircuitOpenError, RateLimitedError, requests.ConnectTimeout)):
+            return True
+        # the connection couldn't be made (refused, unknown host...), as opposed to dropped once the request was sent
+        reason = getattr(error.args[0], 'reason', None) if error.args else None
+        return isinstance(error, requests.ConnectionError) and isinstance(reason, NewConnectionError)
+
+    @staticmethod
+    def _guarded(breaker: CircuitBreaker, send: Callable[..., requests.Response], limiter: RateLimiter = None,
+                 **kwargs: Any) -> requests.Response:
+        """Sends a Daraja request through its circuit breaker.
+
+        Connection errors and 5xx responses count as failures; throttling responses
+        slow the (tenant's) rate limiter down instead, as Daraja itself is fine. It doesn't
+        need an app context (see `TokenManager`'s background refresh).
+        """
+        limiter = limiter or rate_limiter
+        breaker.before_call()
+        try:
+            response = send(**kwargs)
+        except requests.RequestException:
+            breaker.record_failure()
+            raise
+        if MPESA._is_throttled(response, limiter.throttling_codes):
+            limiter.throttled()
+            breaker.record_success()
+        elif response.status_code >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        return response
+
+    @staticmethod
+    def _is_throttled(response: requests.Response, throttling_codes: Tuple[str, ...]) -> bool:
+        """Whether Daraja rejected the request for going over the allowed TPS."""
+        if response.status_code == 429:
+            return True
+        try:
+            return response.json().get('errorCode') in throttling_codes
+        except (ValueError, AttributeError):
+            return False
+
+    def _duplicate_response(self) -> Tuple[dict, bool]:
+        """Formulates the response for a PNR that was already used."""
+        current_app.logger.error('PNR: %s | A similar B2B payment already exists.', self.data['pnr'])
+        metrics.inc('mpesa_b2b_payments_total', outcome='duplicate_pnr')
+        self.response['status_code'] = current_app.config['GENERIC_FAILURE_CODE']
+        self.response['status_message'] = 'A similar B2B payment already exists.'
+        return self.response, True
+
+    def _build_b2b_payload(self) -> Dict[str, str]:
         """Builds the payload for the B2B request."""
-        return {
-            'Initiator': os.environ.get('B2B_INITIATOR'),
-            'SecurityCredential': MPESA.rsa_encrypt(os.environ.get('B2B_INITIATOR_PASSWORD'), certificate_path),
-            'CommandID': os.environ.get('B2B_COMMAND_ID'),
-            'SenderIdentifierType': os.environ.get('SENDER_IDENTIFIER_TYPE'),
-            'RecieverIdentifierType': os.environ.get('RECIEVER_IDENTIFIER_TYPE'),  # typo in the docs 🤦🏽‍♀️
-            'Amount': self.data['amount'],
-            'PartyA': os.environ.get('B2B_SHORT_CODE'),
-            'PartyB': os.environ.get('PAY_TAX_CODE'),
-            'Remarks': 'B2B payment.',
-            'QueueTimeOutURL': '{}/payment/timeout'.format(os.environ.get('BASE_URL')),
-            'ResultURL': '{}/payment/confirm'.format(os.environ.get('BASE_URL')),
-            'AccountReference': self.data['pnr']
-        }
-
-    def _create_b2b_payment(self, ctx: Any, originator_conversation_id: str, conversation_id: str) -> None:
-        """Saves the B2B payment record."""
-        with ctx.app_context():
-            ctx.logger.info(f"PNR: {self.data['pnr']} | Saving B2B payment record...")
-            record = B2B(
-                amount=self.data['amount'],
+        with metrics.timer(PHASE_SECONDS, operation='initiate_b2b', phase='security_credential'):
+            credential = self.credential or MPESA.security_credential(self.tenant)
+        return self.tenant.settings.b2b_payload(self.data['amount'], self.data['pnr'], credential)
+
+    @staticmethod
+    def request_transaction_status(originator_conversation_id: str, access_token: str = None,
+                                   security_credential: str = None, tenant: Tenant = None) -> Optional[Dict[str, Any]]:
+        """Queries the Transaction Status API about a B2B payment, returns its response if the query was accepted.
+
+        The status itself is delivered later on, to `payment/status/result`.
+        """
+        tenant = tenant or tenants.get()
+        try:
+            if not tenant.rate_limiter.acquire():
+                raise RateLimitedError('Too many Daraja requests, try again later.')
+            headers = {
+                'Content-Type': 'application/json',
+                'Authorization': 'Bearer {}'.format(access_token or MPESA.generate_access_token(tenant))
+            }
+            # the Occasion (echoed in the result) is the payment's OriginatorConversationID
+            payload = tenant.settings.transaction_status_payload(
+                originator_conversation_id, security_credential or MPESA.security_credential(tenant))
+            response = MPESA._guarded(
+                transaction_status_breaker,
+                tenant.transport.post,
+                tenant.rate_limiter,
+                url=tenant.settings.transaction_status_url,
+                json=payload,
+                headers=headers
+            ).json()
+        except (FileNotFoundError, ValueError, requests.RequestException, CircuitOpenError, RateLimitedError) as e:
+            current_app.logger.error('OriginatorConversationID: %s | Failed to query the transaction status ~>\n\t%s',
+                                     originator_conversation_id, e)
+            return None
+        if response.get('errorCode') or str(response.get('ResponseCode')) != '0':
+            current_app.logger.error('OriginatorConversationID: %s | Transaction status query rejected ~>\n\t%s',
+                                     originator_conversation_id, response)
+            return None
+        return response
+
+    def _create_b2b_payment(self, originator_conversation_id: str, conversation_id: str) -> None:
+        """Queues the conversation IDs of the B2B payment to be recorded by the persistence worker."""
+        current_app.logger.info('PNR: %s | Queueing B2B payment record...', self.data['pnr'])
+        with metrics.timer(PHASE_SECONDS, operation='create_b2b_payment', phase='enqueue'):
+            persistence_worker.submit(dict(
                 pnr=self.data['pnr'],
                 originator_conversation_id=originator_conversation_id,
                 conversation_id=conversation_id
-            )
-            db.session.add(record)
-            db.session.commit()
-            ctx.logger.info(f"PNR: {self.data['pnr']} | B2B payment record saved successfully.")
+            ))
 
     @staticmethod
     def update_b2b_payment(ctx: Any, req: Dict) -> None:
         """Updates the B2B payment record."""
+        MPESA.update_b2b_payments(ctx, [req])
+
+    @staticmethod
+    def update_b2b_payments(ctx: Any, results: List[Dict], finalized: Set[Tuple[str, str]] = None) -> int:
+        """Updates the B2B payment records of a batch of results, returns the number of updated records.
+
+        Only PENDING records are moved to a final state, with one SELECT and (at most)
+        one UPDATE per final status for the whole batch, and the webhook notifications of those
+        with a `callback_url` are saved in the same transaction. The (ConversationID, OriginatorConversationID)
+        of the records now known to be in a final state are added to `finalized`, if given.
+        """
         with ctx.app_context():
-            ctx.logger.info(f"ConversationID: {req.get('ConversationID')} | Updating B2B payment record...")
-            record = B2B.query \
-                .filter_by(conversation_id=req.get('ConversationID', '-1')) \
-                .filter_by(originator_conversation_id=req.get('OriginatorConversationID', '-1')) \
-                .order_by(B2B.id.desc()) \
-                .first()
-            if record and record.status == StatusEnum.PENDING:
-                record.status = StatusEnum.SUCCESS if req.get('ResultCode') == 0 else StatusEnum.FAILED
+            statuses = dict()  # (ConversationID, OriginatorConversationID) -> new status
+            details = dict()  # (ConversationID, OriginatorConversationID) -> result columns
+            for req in results:
+                key = (req.get('ConversationID', '-1'), req.get('OriginatorConversationID', '-1'))
+                # the first result delivered for a transaction wins, like it would one at a time
+                if key not in statuses:
+                    statuses[key] = StatusEnum.SUCCESS if req.get('ResultCode') == 0 else StatusEnum.FAILED
+                    details[key] = MPESA.result_details(req)
+            with metrics.timer(PHASE_SECONDS, operation='update_b2b_payment', phase='select'):
+                rows = db.session.execute(
+                    select(B2B.conversation_id, B2B.originator_conversation_id, B2B.status, B2B.pnr, B2B.callback_url)
+                    .where(MPESA._in_pairs(list(statuses.keys())))
+                ).all()
+            pending = {(row[0], row[1]) for row in rows if row[2] == StatusEnum.PENDING}
+            callbacks = {(row[0], row[1]): (row[3], row[4]) for row in rows if row[2] == StatusEnum.PENDING and row[4]}
+            for key in statuses.keys() - pending:
+                ctx.logger.error('ConversationID: %s | Transaction record not found or already in a final state.',
+                                 key[0])
+            if statuses.keys() - pending:
+                metrics.inc('mpesa_b2b_callbacks_total', len(statuses.keys() - pending), outcome='not_found')
+            updated = 0
+            with metrics.timer(PHASE_SECONDS, operation='update_b2b_payment', phase='update'):
+                for status in (StatusEnum.SUCCESS, StatusEnum.FAILED):
+                    keys = [key for key in pending if statuses[key] == status]
+                    if keys:
+                        # each record gets its own result, picked by its (unique) conversation ID
+                        values = {column: case({key[0]: details[key][column] for key in keys},
+                                               value=B2B.conversation_id)
+                                  for column in RESULT_COLUMNS}
+                        count = db.session.execute(
+                            update(B2B)
+                            .where(MPESA._in_pairs(keys))
+                            .where(B2B.status == StatusEnum.PENDING)
+                            .values(status=status, **values)
+                            .execution_options(synchronize_session=False)
+                        ).rowcount
+                        metrics.inc('mpesa_b2b_callbacks_total', count, outcome=status.value.lower())
+                        updated += count
+                webhook_dispatcher.enqueue(
+                    (callbacks[key][1], WebhookDispatcher.notification(callbacks[key][0], statuses[key], details[key]))
+                    for key in pending & callbacks.keys())
+            with metrics.timer(PHASE_SECONDS, operation='update_b2b_payment', phase='commit'):
                 db.session.commit()
-                ctx.logger.info(f"ConversationID: {req.get('ConversationID')} | "
-                                f"B2B payment record updated successfully.")
-            else:
-                ctx.logger.error(f"ConversationID: {req.get('ConversationID')} | Transaction record not "
-                                 f"found or already in a final state.")
+            db_router.pin(*(row[3] for row in rows if (row[0], row[1]) in pending))
+            if finalized is not None:
+                # the others were already final, and the PENDING ones were just updated (here or by another worker)
+                finalized.update((row[0], row[1]) for row in rows)
+            ctx.logger.info('Updated %s B2B payment record(s) out of %s result(s).', updated, len(results))
+            return updated
+
+    @staticmethod
+    def result_parameters(result: Dict[str, Any]) -> Dict[str, Any]:
+        """Returns the `ResultParameters` of a result as a key -> value mapping (empty if they're malformed)."""
+        parameters = result.get('ResultParameters')
+        parameters = parameters.get('ResultParameter') if isinstance(parameters, dict) else None
+        if isinstance(parameters, dict):
+            # a single parameter isn't wrapped in a list
+            parameters = [parameters]
+        if not isinstance(parameters, list):
+            return dict()
+        return {item.get('Key'): item.get('Value') for item in parameters if isinstance(item, dict)}
+
+    @staticmethod
+    def result_details(result: Dict[str, Any]) -> Dict[str, Any]:
+        """Returns the values of the `RESULT_COLUMNS` of a result, None for those that are missing or malformed."""
+        parameters = MPESA.result_parameters(result)
+        amount = parameters.get('TransactionAmount', parameters.get('Amount'))
+        try:
+            amount = int(float(amount)) if amount is not None else None
+        except (TypeError, ValueError):
+            amount = None
+        try:
+            result_code = int(result.get('ResultCode'))
+        except (TypeError, ValueError):
+            result_code = None
+        return dict(
+            result_code=result_code,
+            result_description=MPESA._text(result.get('ResultDesc'), 255),
+            receipt=MPESA._text(parameters.get('TransactionReceipt') or result.get('TransactionID'), 32),
+            transaction_amount=amount,
+            completed_on=MPESA._completed_on(
+                parameters.get('TransactionCompletedDateTime', parameters.get('TransCompletedTime')))
+        )
+
+    @staticmethod
+    def _text(value: Any, length: int) -> Optional[str]:
+        """Returns a (scalar) value as a string cut to the column's length, None if it's empty or not a scalar."""
+        if not isinstance(value, (str, int, float)) or isinstance(value, bool):
+            return None
+        return str(value)[:length] or None
+
+    @staticmethod
+    def _completed_on(value: Any) -> Optional[datetime]:
+        """Parses a completion time, e.g. '19.12.2019 11:45:50' or 20191219114550."""
+        for time_format in ('%d.%m.%Y %H:%M:%S', '%Y%m%d%H%M%S'):
+            try:
+                return datetime.strptime(str(value), time_format)
+            except ValueError:
+                continue
+        return None
+
+    @staticmethod
+    def _in_pairs(keys: List[Tuple[str, str]]) -> Any:
+        """Filters the records by (ConversationID, OriginatorConversationID) pairs."""
+        # a row value IN alone isn't matched to an index by every database (e.g. SQLite)
+        return and_(B2B.conversation_id.in_([key[0] for key in keys]),
+                    tuple_(B2B.conversation_id, B2B.originator_conversation_id).in_(keys))
+
+    @staticmethod
+    def security_credential(tenant: Tenant = None) -> str:
+        """Returns the (cached) encrypted initiator password of the tenant (the default one by default)."""
+        return (tenant or tenants.get()).credential_provider.get_credential()
 
     @staticmethod
     def rsa_encrypt(password: str, certificate_path: str) -> str:
@@ -136,12 +444,22 @@ class MPESA:
             return encryption
 
     @staticmethod
-    def generate_access_token() -> str:
-        """Generates an access token for the B2B request."""
+    def generate_access_token(tenant: Tenant = None) -> str:
+        """Returns a (cached) access token of the tenant (the default one by default) for the B2B request."""
+        return (tenant or tenants.get()).token_manager.get_token()
+
+    @staticmethod
+    def fetch_access_token(tenant: Tenant = None) -> Tuple[str, int]:
+        """Fetches a new access token, and its lifetime in seconds, from the OAuth API."""
+        tenant = tenant or tenants.get()
         try:
-            return requests.get(
-                url='{}/oauth/v1/generate?grant_type=client_credentials'.format(os.environ.get('B2B_BASE_URL')),
-                auth=HTTPBasicAuth(os.environ.get('B2B_ACCESS_KEY'), os.environ.get('B2B_CONSUMER_SECRET'))
-            ).json()['access_token']
-        except (requests.ConnectTimeout, requests.RequestException) as e:
+            response = MPESA._guarded(
+                oauth_breaker,
+                tenant.transport.get,
+                tenant.rate_limiter,
+                url=tenant.settings.oauth_url,
+                auth=HTTPBasicAuth(tenant.settings.access_key, tenant.settings.consumer_secret)
+            ).json()
+            return response['access_token'], int(response.get('expires_in', 3599))
+        except (requests.ConnectTimeout, requests.RequestException, KeyError, ValueError, CircuitOpenError) as e:
             raise ValueError(f"Failed to generate access token: {e}")
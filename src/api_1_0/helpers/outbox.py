@@ -0,0 +1,176 @@
+import atexit
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from threading import Event, Lock, Thread
+from typing import Any, List
+from sqlalchemy import or_, select, update
+from src import db
+from src.api_1_0.helpers.clock import utcnow
+from src.api_1_0.helpers.metrics import metrics
+from src.api_1_0.helpers.mpesa import MPESA
+from src.api_1_0.helpers.webhooks import WebhookDispatcher, webhook_dispatcher
+from src.api_1_0.models.b2b import B2B, StatusEnum
+
+
+class OutboxDispatcher:
+    """Sends the QUEUED B2B payments (the outbox) to Daraja, with retries and bounded concurrency.
+
+    A row is claimed by pushing its `next_attempt_on` past a lease, so that several
+    workers can drain the same outbox. Only the payments Daraja definitely rejected (or
+    never got) are sent again; those whose outcome is unknown (e.g. a read timeout) are
+    flagged UNKNOWN straight away, for an operator to settle (see `Reconciler.resolve`).
+    A worker dying between the Daraja response and the update re-sends the payment once the lease expires.
+    """
+
+    def __init__(self):
+        """Initializes the OutboxDispatcher class."""
+        self.app = None
+        self.poll_interval = 1.0
+        self.batch_size = 50
+        self.concurrency = 4
+        self.max_attempts = 5
+        self.backoff_base = 2.0
+        self.backoff_max = 300.0
+        self.lease = 120.0
+        self._thread = None
+        self._pid = None
+        self._lock = Lock()
+        self._stopping = Event()
+        atexit.register(self.stop)
+
+    def init_app(self, app: Any) -> None:
+        """Configures the dispatcher, it's started with the first request in outbox mode."""
+        self.stop()
+        self.app = app
+        self.poll_interval = app.config.get('OUTBOX_POLL_INTERVAL', self.poll_interval)
+        self.batch_size = app.config.get('OUTBOX_BATCH_SIZE', self.batch_size)
+        self.concurrency = app.config.get('OUTBOX_CONCURRENCY', self.concurrency)
+        self.max_attempts = app.config.get('OUTBOX_MAX_ATTEMPTS', self.max_attempts)
+        self.backoff_base = app.config.get('OUTBOX_BACKOFF_BASE', self.backoff_base)
+        self.backoff_max = app.config.get('OUTBOX_BACKOFF_MAX', self.backoff_max)
+        self.lease = app.config.get('OUTBOX_LEASE', self.lease)
+        if app.config.get('OUTBOX_MODE'):
+            app.before_request(self.ensure_started)
+
+    def ensure_started(self) -> None:
+        """Starts the dispatcher thread of the current process (gunicorn forks after import)."""
+        if self._thread is None or self._pid != os.getpid():
+            with self._lock:
+                if self._thread is None or self._pid != os.getpid():
+                    self._stopping.clear()
+                    self._thread = Thread(target=self._run, name='b2b-outbox', daemon=True)
+                    self._pid = os.getpid()
+                    self._thread.start()
+
+    def stop(self, timeout: float = 30.0) -> None:
+        """Stops the dispatcher, once the payments being sent are done."""
+        self._stopping.set()
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            self._thread.join(timeout)
+        self._thread, self._pid = None, None
+
+    def _run(self) -> None:
+        """Drains the outbox until stopped."""
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            while not self._stopping.is_set():
+                try:
+                    ids = self._claim()
+                    list(executor.map(self._dispatch, ids))
+                except Exception as e:
+                    # the thread must outlive any failure, or the outbox is never drained again
+                    self.app.logger.error('Failed to drain the B2B outbox ~>\n\t%s', e)
+                    ids = []
+                if len(ids) < self.batch_size:
+                    # the outbox is (momentarily) empty, wait for more
+                    self._stopping.wait(self.poll_interval)
+
+    def _claim(self) -> List[int]:
+        """Claims a batch of due QUEUED rows, returns their ids.
+
+        The rows are locked as they're read, skipping those another worker is claiming, so that
+        one UPDATE claims them all (unlike the reconciler's, a claim must never be shared: a payment
+        claimed twice is sent twice).
+        """
+        with self.app.app_context():
+            now = utcnow()
+            due = or_(B2B.next_attempt_on.is_(None), B2B.next_attempt_on <= now)
+            candidates = db.session.scalars(
+                select(B2B.id)
+                .where(B2B.status == StatusEnum.QUEUED, due)
+                .order_by(B2B.next_attempt_on)
+                .limit(self.batch_size)
+                .with_for_update(skip_locked=True)
+            ).all()
+            if not candidates:
+                db.session.rollback()
+                return []
+            claimed = db.session.execute(
+                update(B2B)
+                .where(B2B.id.in_(candidates), B2B.status == StatusEnum.QUEUED, due)
+                .values(next_attempt_on=now + timedelta(seconds=self.lease))
+                .execution_options(synchronize_session=False)
+            ).rowcount
+            if claimed != len(candidates):
+                # some rows changed since they were read (no row locks, e.g. SQLite), there's no telling
+                # which ones are ours: leave them all to the next poll
+                db.session.rollback()
+                return []
+            db.session.commit()
+            return candidates
+
+    def _dispatch(self, row_id: int) -> None:
+        """Dispatches a payment, logging (rather than raising) any failure, it's retried once its lease expires."""
+        try:
+            self.dispatch(row_id)
+        except Exception as e:
+            self.app.logger.error('Row: %s | Failed to dispatch the B2B payment ~>\n\t%s', row_id, e)
+
+    def dispatch(self, row_id: int) -> None:
+        """Sends one outbox payment to Daraja, and records the outcome."""
+        with self.app.app_context():
+            record = db.session.execute(
+                select(B2B.pnr, B2B.amount, B2B.tenant, B2B.callback_url, B2B.attempts)
+                .where(B2B.id == row_id, B2B.status == StatusEnum.QUEUED)
+            ).first()
+            # don't hold a pooled connection (and a transaction) during the Daraja round trip
+            db.session.close()
+            if record is None:
+                self.app.logger.warning('Row: %s | The queued B2B payment is gone, skipping it.', row_id)
+                return
+            response, rejected = MPESA(dict(amount=record.amount, pnr=record.pnr, tenant=record.tenant))._request_b2b()
+            attempts = record.attempts + 1
+            values = dict(attempts=attempts, next_attempt_on=None)
+            if response is not None:
+                values.update(status=StatusEnum.PENDING, conversation_id=response['ConversationID'],
+                              originator_conversation_id=response['OriginatorConversationID'])
+            elif not rejected:
+                # Daraja may have accepted it, sending it again could pay twice; without conversation
+                # IDs it can't be queried either, so it's flagged for an operator right away
+                self.app.logger.error('PNR: %s | Unknown outcome of the B2B payment, to be settled with '
+                                      '`flask payments resolve`.', record.pnr)
+                values.update(status=StatusEnum.UNKNOWN)
+            elif attempts >= self.max_attempts:
+                self.app.logger.error('PNR: %s | Giving up on B2B payment after %s attempts.', record.pnr, attempts)
+                values.update(status=StatusEnum.FAILED)
+            else:
+                values.update(next_attempt_on=utcnow() + timedelta(seconds=self.backoff(attempts)))
+            updated = db.session.execute(
+                update(B2B).where(B2B.id == row_id, B2B.status == StatusEnum.QUEUED).values(**values)
+                .execution_options(synchronize_session=False)
+            ).rowcount
+            if updated and values.get('status') == StatusEnum.FAILED and record.callback_url:
+                webhook_dispatcher.enqueue([(record.callback_url,
+                                             WebhookDispatcher.notification(record.pnr, StatusEnum.FAILED))])
+            db.session.commit()
+            if updated and values.get('status') == StatusEnum.UNKNOWN:
+                metrics.inc('mpesa_b2b_unknown_payments_total')
+
+    def backoff(self, attempts: int) -> float:
+        """Returns the (full jitter) delay before the next attempt, in seconds."""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base ** attempts))
+
+
+# the process-wide outbox dispatcher, configured in `create_app`
+outbox_dispatcher = OutboxDispatcher()
@@ -0,0 +1,188 @@
+import atexit
+import os
+import queue
+import time
+from threading import Lock, Thread
+from typing import Any, Dict, List
+from sqlalchemy import case, delete, insert, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from src import db
+from src.api_1_0.helpers.metrics import PHASE_SECONDS, metrics
+from src.api_1_0.models.b2b import B2B, StatusEnum
+
+# tells the worker thread to flush what it has and exit
+_STOP = object()
+# the dialects whose INSERT can skip a taken PNR (ON CONFLICT DO NOTHING), the others fail on it
+ON_CONFLICT_DIALECTS = {'sqlite': sqlite, 'postgresql': postgresql}
+# MySQL/MariaDB's ER_DUP_ENTRY
+MYSQL_DUPLICATE_ENTRY = 1062
+
+
+def reserve_statement(dialect: str, payment: Dict[str, Any]) -> Any:
+    """Returns the INSERT of the payment, on the dialect.
+
+    It inserts nothing if the PNR is taken (ON CONFLICT DO NOTHING) where the dialect
+    supports it, and fails with a duplicate key error otherwise (see `is_duplicate`).
+    """
+    if dialect in ON_CONFLICT_DIALECTS:
+        return ON_CONFLICT_DIALECTS[dialect].insert(B2B).values(**payment).on_conflict_do_nothing(
+            index_elements=['pnr'])
+    return insert(B2B).values(**payment)
+
+
+def is_duplicate(error: IntegrityError, dialect: str) -> bool:
+    """Whether the INSERT of a payment failed because its PNR is taken."""
+    if dialect in ('mysql', 'mariadb'):
+        # e.g. (1062, "Duplicate entry 'X' for key 'pnr'"), the other integrity errors are actual failures
+        args = getattr(error.orig, 'args', ())
+        return bool(args) and args[0] == MYSQL_DUPLICATE_ENTRY
+    return True
+
+
+def reserve_payment(payment: Dict[str, Any]) -> bool:
+    """Inserts the payment unless its PNR is taken, with a single statement and commit.
+
+    Returns False if the PNR is taken. The database's unique index on `pnr` settles the
+    conflict, so concurrent requests for the same PNR, from any worker or host, can't both get it.
+    Raises a SQLAlchemyError if the payment couldn't be saved.
+    """
+    dialect = db.session.get_bind().dialect.name
+    try:
+        try:
+            result = db.session.execute(reserve_statement(dialect, payment))
+        except IntegrityError as e:
+            if not is_duplicate(e, dialect):
+                raise
+            db.session.rollback()
+            return False
+        db.session.commit()
+    except SQLAlchemyError:
+        db.session.rollback()
+        raise
+    return dialect not in ON_CONFLICT_DIALECTS or result.rowcount == 1
+
+
+def release_payment(pnr: str, status: StatusEnum = StatusEnum.PENDING) -> None:
+    """Drops the reservation of a payment that Daraja didn't accept, so that its PNR can be used again."""
+    try:
+        db.session.execute(
+            delete(B2B)
+            .where(B2B.pnr == pnr, B2B.status == status, B2B.originator_conversation_id.is_(None))
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+    except SQLAlchemyError:
+        db.session.rollback()
+        raise
+
+
+class PersistenceWorker:
+    """Records the conversation IDs of the accepted B2B payments in batches, from a bounded per-process queue.
+
+    The payments themselves are saved (their PNR reserved) before they're sent to Daraja, see `reserve_payment`.
+    """
+
+    def __init__(self):
+        """Initializes the PersistenceWorker class."""
+        self.app = None
+        self.batch_size = 100
+        self.flush_interval = 0.5
+        self.enqueue_timeout = 1.0
+        self.queue = queue.Queue(maxsize=1000)
+        self._thread = None
+        self._pid = None
+        self._lock = Lock()
+        self.commits = 0
+        atexit.register(self.stop)
+
+    def init_app(self, app: Any) -> None:
+        """Configures the worker from the application config."""
+        self.stop()
+        self.app = app
+        self.batch_size = app.config.get('PERSISTENCE_BATCH_SIZE', self.batch_size)
+        self.flush_interval = app.config.get('PERSISTENCE_FLUSH_INTERVAL', self.flush_interval)
+        self.enqueue_timeout = app.config.get('PERSISTENCE_ENQUEUE_TIMEOUT', self.enqueue_timeout)
+        self.queue = queue.Queue(maxsize=app.config.get('PERSISTENCE_QUEUE_SIZE', 1000))
+
+    def submit(self, record: Dict[str, Any]) -> None:
+        """Queues the conversation IDs of a payment (a dict of its pnr, originator_conversation_id and conversation_id).
+
+        When the queue is full the caller is held back for up to `enqueue_timeout` seconds,
+        after which the record is written on the caller's thread, i.e. a record is never dropped.
+        """
+        self._ensure_started()
+        try:
+            self.queue.put(record, timeout=self.enqueue_timeout)
+        except queue.Full:
+            self.app.logger.warning('PNR: %s | Persistence queue is full, saving inline...', record['pnr'])
+            self._flush([record])
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """Drains the queue and stops the worker thread."""
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            self.queue.put(_STOP)
+            self._thread.join(timeout)
+        self._thread, self._pid = None, None
+
+    def _ensure_started(self) -> None:
+        """Starts the worker thread of the current process (gunicorn forks after import)."""
+        if self._thread is None or self._pid != os.getpid():
+            with self._lock:
+                if self._thread is None or self._pid != os.getpid():
+                    self._thread = Thread(target=self._run, name='b2b-persistence', daemon=True)
+                    self._pid = os.getpid()
+                    self._thread.start()
+
+    def _run(self) -> None:
+        """Collects records until the batch is full or the flush interval elapses, then writes them."""
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is _STOP:
+                break
+            batch, deadline = [item], time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._flush(batch)
+
+    def _flush(self, batch: List[Dict[str, Any]]) -> None:
+        """Records the batch with a single UPDATE (keyed by PNR) and commit."""
+        originator_conversation_ids = {record['pnr']: record['originator_conversation_id'] for record in batch}
+        conversation_ids = {record['pnr']: record['conversation_id'] for record in batch}
+        with self.app.app_context():
+            try:
+                with metrics.timer(PHASE_SECONDS, operation='create_b2b_payment', phase='flush'):
+                    db.session.execute(
+                        update(B2B)
+                        .where(B2B.pnr.in_(list(conversation_ids)))
+                        .values(originator_conversation_id=case(originator_conversation_ids, value=B2B.pnr),
+                                conversation_id=case(conversation_ids, value=B2B.pnr))
+                        .execution_options(synchronize_session=False)
+                    )
+                    db.session.commit()
+                self.commits += 1
+                self.app.logger.info('Saved %s B2B payment record(s).', len(batch))
+                return
+            except SQLAlchemyError as e:
+                db.session.rollback()
+                error = e
+        if len(batch) == 1:
+            self.app.logger.error('PNR: %s | Failed to save B2B payment record ~>\n\t%s', batch[0]['pnr'], error)
+            return
+        # don't let one bad record (e.g. a duplicate conversation ID) take the rest of the batch down with it
+        self.app.logger.error('Failed to save a batch of %s B2B payment records, retrying one by one ~>\n\t%s',
+                              len(batch), error)
+        for record in batch:
+            self._flush([record])
+
+
+# the process-wide persistence worker, configured in `create_app`
+persistence_worker = PersistenceWorker()
@@ -0,0 +1,84 @@
+import os
+import sys
+import time
+from collections import Counter
+from threading import Event, Lock, Thread, get_ident
+from typing import Any, Optional
+
+
+class SamplingProfiler:
+    """A sampling profiler of the current (gunicorn) worker, for profiling under real traffic.
+
+    Every `interval` seconds the stacks of all the threads are sampled; the result is
+    written in the collapsed stack format, as read by flamegraph.pl and speedscope.
+    """
+
+    def __init__(self):
+        """Initializes the SamplingProfiler class."""
+        self.enabled = False
+        self.interval = 0.005
+        self.max_duration = 300.0
+        self.output_dir = '/tmp'
+        self.output = None
+        self._thread = None
+        self._stopping = Event()
+        self._lock = Lock()
+
+    def init_app(self, app: Any) -> None:
+        """Configures the profiler from the application config."""
+        self.enabled = app.config.get('PROFILER_ENABLED', self.enabled)
+        self.interval = app.config.get('PROFILER_INTERVAL', self.interval)
+        self.max_duration = app.config.get('PROFILER_MAX_DURATION', self.max_duration)
+        self.output_dir = app.config.get('PROFILER_OUTPUT_DIR', self.output_dir)
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, duration: float) -> Optional[str]:
+        """Profiles this process for `duration` seconds in the background, returns the output file.
+
+        Returns None if a profile is already being taken.
+        """
+        with self._lock:
+            if self.running:
+                return None
+            self._stopping.clear()
+            self.output = os.path.join(self.output_dir, f'profile-{os.getpid()}-{int(time.time())}.txt')
+            duration = min(duration, self.max_duration)
+            self._thread = Thread(target=self._run, args=(duration, self.output), name='b2b-profiler', daemon=True)
+            self._thread.start()
+            return self.output
+
+    def stop(self) -> None:
+        """Stops the profile being taken, it's written right away."""
+        self._stopping.set()
+        if self.running:
+            self._thread.join()
+
+    def _run(self, duration: float, output: str) -> None:
+        """Samples the stacks until the duration elapses, then writes them."""
+        stacks, me = Counter(), get_ident()
+        deadline = time.monotonic() + duration
+        while not self._stopping.is_set() and time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != me:
+                    stacks[SamplingProfiler._collapse(frame)] += 1
+            self._stopping.wait(self.interval)
+        with open(output, 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+    @staticmethod
+    def _collapse(frame: Any) -> str:
+        """Returns the stack of the frame, outermost first, separated by semicolons."""
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f'{code.co_name} ({os.path.basename(code.co_filename)})')
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+
+# the process-wide profiler, configured in `create_app`
+profiler = SamplingProfiler()
@@ -0,0 +1,265 @@
+import atexit
+import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from threading import Event, Lock, Thread
+from typing import Any, Dict, List, Optional, Tuple
+import click
+from flask.cli import AppGroup
+from sqlalchemy import and_, delete, or_, select, update
+from src import db
+from src.api_1_0.helpers.metrics import metrics
+from src.api_1_0.helpers.mpesa import MPESA
+from src.api_1_0.helpers.clock import utcnow
+from src.api_1_0.helpers.tenants import tenants
+from src.api_1_0.helpers.webhooks import WebhookDispatcher, webhook_dispatcher
+from src.api_1_0.models.b2b import B2B, StatusEnum
+
+# the TransactionStatus values of a payment in a final state, any other one is still in progress
+COMPLETED_STATUSES = ('Completed',)
+FAILED_STATUSES = ('Failed', 'Cancelled', 'Declined', 'Expired', 'Reversed')
+
+
+class Reconciler:
+    """Queries Daraja's Transaction Status API about the PENDING payments whose result never came.
+
+    Stale payments are paged through by `created_on` (keyset pagination, one short transaction
+    per page) and claimed by pushing their `next_attempt_on` past `retry_interval`, so that
+    several workers can reconcile at once and a payment isn't queried again until then.
+    The statuses are delivered to `payment/status/result`, and applied like the payments' own results.
+
+    A payment still without conversation IDs after `stale_after` seconds can't be queried: Daraja
+    may have accepted it (e.g. its request timed out), or its IDs were never recorded. It's flagged
+    as UNKNOWN instead, for an operator to settle (see `flask payments`).
+    """
+
+    def __init__(self):
+        """Initializes the Reconciler class."""
+        self.app = None
+        self.interval = 300.0
+        self.stale_after = 600.0
+        self.retry_interval = 1800.0
+        self.page_size = 500
+        self.concurrency = 4
+        self._thread = None
+        self._pid = None
+        self._lock = Lock()
+        self._stopping = Event()
+        atexit.register(self.stop)
+
+    def init_app(self, app: Any) -> None:
+        """Configures the reconciler, it's started with the first request if enabled."""
+        self.stop()
+        self._stopping.clear()
+        self.app = app
+        self.interval = app.config.get('RECONCILER_INTERVAL', self.interval)
+        self.stale_after = app.config.get('RECONCILER_STALE_AFTER', self.stale_after)
+        self.retry_interval = app.config.get('RECONCILER_RETRY_INTERVAL', self.retry_interval)
+        self.page_size = app.config.get('RECONCILER_PAGE_SIZE', self.page_size)
+        self.concurrency = app.config.get('RECONCILER_CONCURRENCY', self.concurrency)
+        if app.config.get('RECONCILER_ENABLED'):
+            app.before_request(self.ensure_started)
+        app.cli.add_command(payments_cli)
+
+    def ensure_started(self) -> None:
+        """Starts the reconciler thread of the current process (gunicorn forks after import)."""
+        if self._thread is None or self._pid != os.getpid():
+            with self._lock:
+                if self._thread is None or self._pid != os.getpid():
+                    self._stopping.clear()
+                    self._thread = Thread(target=self._run, name='b2b-reconciler', daemon=True)
+                    self._pid = os.getpid()
+                    self._thread.start()
+
+    def stop(self, timeout: float = 30.0) -> None:
+        """Stops the reconciler, once the current page is done."""
+        self._stopping.set()
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            self._thread.join(timeout)
+        self._thread, self._pid = None, None
+
+    def _run(self) -> None:
+        """Reconciles every `interval` seconds until stopped."""
+        while not self._stopping.wait(self.interval):
+            try:
+                self.reconcile()
+            except Exception as e:
+                # the thread must outlive any failure, or the payments are never reconciled again
+                self.app.logger.error('Failed to reconcile the stale B2B payments ~>\n\t%s', e)
+
+    def reconcile(self) -> int:
+        """Queries the status of every stale PENDING payment, returns the number of accepted queries."""
+        self.flag_unknown()
+        queried, cursor = 0, None
+        while not self._stopping.is_set():
+            page, cursor = self._claim(cursor)
+            if cursor is None:
+                break
+            if page:
+                queried += self._query(page)
+        if queried:
+            self.app.logger.info('Queried the status of %s stale B2B payment(s).', queried)
+        return queried
+
+    def flag_unknown(self) -> List[str]:
+        """Flags the PENDING payments left without conversation IDs for `stale_after` seconds as UNKNOWN.
+
+        Returns their PNRs, which stay taken until an operator settles the payments (see `resolve`).
+        """
+        with self.app.app_context():
+            stuck = (B2B.status == StatusEnum.PENDING, B2B.originator_conversation_id.is_(None),
+                     B2B.updated_on < utcnow() - timedelta(seconds=self.stale_after))
+            pnrs = db.session.scalars(select(B2B.pnr).where(*stuck).limit(self.page_size)).all()
+            if pnrs:
+                db.session.execute(update(B2B).where(B2B.pnr.in_(pnrs), *stuck).values(status=StatusEnum.UNKNOWN)
+                                   .execution_options(synchronize_session=False))
+            db.session.commit()
+        if pnrs:
+            self.app.logger.error('Flagged %s B2B payment(s) of unknown outcome, to be settled with '
+                                  '`flask payments resolve` ~>\n\t%s', len(pnrs), ', '.join(pnrs))
+            metrics.inc('mpesa_b2b_unknown_payments_total', len(pnrs))
+        return pnrs
+
+    @staticmethod
+    def resolve(pnr: str, status: Optional[StatusEnum], receipt: Optional[str] = None) -> bool:
+        """Settles a payment of unknown outcome, as checked with Safaricom (e.g. on the shortcode's statement).
+
+        A SUCCESS or FAILED payment is final (and its client notified), a `None` status drops the
+        payment instead, when Daraja never got it, so that its PNR can be used again.
+        Returns False if there's no such payment of unknown outcome.
+        """
+        unknown = (B2B.pnr == pnr, B2B.status == StatusEnum.UNKNOWN)
+        if status is None:
+            settled = db.session.execute(delete(B2B).where(*unknown).execution_options(synchronize_session=False))
+        else:
+            callback_url = db.session.scalar(select(B2B.callback_url).where(*unknown))
+            details = dict(result_description='Settled by an operator.', receipt=receipt)
+            settled = db.session.execute(update(B2B).where(*unknown).values(status=status, **details)
+                                         .execution_options(synchronize_session=False))
+            if settled.rowcount and callback_url:
+                webhook_dispatcher.enqueue([(callback_url, WebhookDispatcher.notification(pnr, status, details))])
+        db.session.commit()
+        return bool(settled.rowcount)
+
+    def _claim(self, cursor: Optional[Tuple[datetime, int]]) -> Tuple[List[Tuple[str, str]],
+                                                                        Optional[Tuple[datetime, int]]]:
+        """Claims the stale payments of the page after the cursor.
+
+        Returns their (tenant, originator conversation ID), and the cursor of the next page (None when done).
+        """
+        with self.app.app_context():
+            now = utcnow()
+            due = or_(B2B.next_attempt_on.is_(None), B2B.next_attempt_on <= now)
+            query = (select(B2B.id, B2B.created_on)
+                     .where(B2B.status == StatusEnum.PENDING,
+                            B2B.created_on < now - timedelta(seconds=self.stale_after),
+                            # a payment is saved before it's sent, there's nothing to query until Daraja accepts it
+                            B2B.originator_conversation_id.isnot(None),
+                            # nor until its last query is `retry_interval` old
+                            due)
+                     .order_by(B2B.created_on, B2B.id)
+                     .limit(self.page_size))
+            if cursor is not None:
+                query = query.where(or_(B2B.created_on > cursor[0],
+                                        and_(B2B.created_on == cursor[0], B2B.id > cursor[1])))
+            rows = db.session.execute(query).all()
+            if not rows:
+                db.session.rollback()
+                return [], None
+            ids = [row.id for row in rows]
+            # whole seconds, for the claimed payments to be told by it on any DATETIME precision
+            until = (now + timedelta(seconds=self.retry_interval)).replace(microsecond=0)
+            # another worker may have claimed some of the payments (or their result came) in the meantime
+            db.session.execute(
+                update(B2B)
+                .where(B2B.id.in_(ids), B2B.status == StatusEnum.PENDING, due)
+                .values(next_attempt_on=until)
+                .execution_options(synchronize_session=False)
+            )
+            # workers claiming the same payment within a second both query it, which is harmless
+            claimed = [tuple(row) for row in db.session.execute(
+                select(B2B.tenant, B2B.originator_conversation_id).where(B2B.id.in_(ids), B2B.next_attempt_on == until)
+            )]
+            db.session.commit()
+            return claimed, (rows[-1].created_on, rows[-1].id)
+
+    def _query(self, page: List[Tuple[str, str]]) -> int:
+        """Queries the status of a page of payments, with a bounded number of concurrent Daraja calls."""
+        by_tenant = defaultdict(list)
+        for tenant, originator_conversation_id in page:
+            by_tenant[tenant].append(originator_conversation_id)
+        secrets = dict()  # tenant -> (access token, security credential), shared by the tenant's queries
+        with self.app.app_context():
+            for name in by_tenant:
+                tenant = tenants.get(name)
+                try:
+                    if tenant is None:
+                        raise ValueError(f'Unknown tenant: {name}')
+                    secrets[name] = tenant, MPESA.generate_access_token(tenant), MPESA.security_credential(tenant)
+                except (FileNotFoundError, ValueError) as e:
+                    self.app.logger.error('Failed to prepare the transaction status queries ~>\n\t%s', e)
+
+        def query(item: Tuple[str, str]) -> bool:
+            if item[0] not in secrets:
+                return False
+            tenant, access_token, credential = secrets[item[0]]
+            with self.app.app_context():
+                return MPESA.request_transaction_status(item[1], access_token, credential, tenant=tenant) \
+                    is not None
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            accepted = sum(executor.map(query, page))
+        metrics.inc('mpesa_b2b_reconciler_queries_total', accepted, outcome='accepted')
+        metrics.inc('mpesa_b2b_reconciler_queries_total', len(page) - accepted, outcome='failed')
+        return accepted
+
+    @staticmethod
+    def payment_result(result: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Turns the result of a transaction status query into the result of the payment it's about.
+
+        Returns None if the payment is still in progress (or the query failed).
+        """
+        if str(result.get('ResultCode')) != '0':
+            return None
+        parameters = MPESA.result_parameters(result)
+        status = parameters.get('TransactionStatus')
+        if status not in COMPLETED_STATUSES + FAILED_STATUSES:
+            return None
+        # the query's Occasion is the payment's OriginatorConversationID (see `request_transaction_status`)
+        reference = (result.get('ReferenceData') or {}).get('ReferenceItem') or {}
+        if isinstance(reference, list):
+            reference = next((item for item in reference if item.get('Key') == 'Occasion'), {})
+        return {
+            'ConversationID': parameters.get('ConversationID'),
+            'OriginatorConversationID': parameters.get('OriginatorConversationID') or reference.get('Value'),
+            'ResultCode': 0 if status in COMPLETED_STATUSES else 1,
+            'ResultDesc': f'Transaction status: {status}'
+        }
+
+
+# the process-wide reconciler, configured in `create_app`
+reconciler = Reconciler()
+
+payments_cli = AppGroup('payments', help='Settles the B2B payments of unknown outcome.')
+
+
+@payments_cli.command('unknown')
+def unknown_command() -> None:
+    """Lists the payments of unknown outcome, oldest first."""
+    rows = db.session.execute(select(B2B.pnr, B2B.tenant, B2B.amount, B2B.created_on)
+                              .where(B2B.status == StatusEnum.UNKNOWN).order_by(B2B.created_on)).all()
+    for pnr, tenant, amount, created_on in rows:
+        click.echo(f'{pnr}\t{tenant}\t{amount}\t{created_on.isoformat()}')
+
+
+@payments_cli.command('resolve')
+@click.argument('pnr')
+@click.argument('outcome', type=click.Choice(['success', 'failed', 'not-sent']))
+@click.option('--receipt', help='The M-PESA receipt of the payment.')
+def resolve_command(pnr: str, outcome: str, receipt: Optional[str]) -> None:
+    """Settles a payment of unknown outcome, `not-sent` frees its PNR."""
+    status = None if outcome == 'not-sent' else StatusEnum(outcome.upper())
+    if not Reconciler.resolve(pnr, status, receipt):
+        raise click.UsageError(f'There is no payment of unknown outcome with the PNR {pnr}.')
+    click.echo(f'Settled the B2B payment {pnr}: {outcome}.')
@@ -0,0 +1,166 @@
+import asyncio
+import time
+from threading import Condition, Lock
+from typing import Any, Dict, Optional
+from src.api_1_0.helpers.exceptions import CircuitOpenError
+
+
+class CircuitBreaker:
+    """A closed/open/half-open circuit breaker around an upstream (Daraja) API.
+
+    After `failure_threshold` consecutive failures the circuit opens and calls fail
+    fast for `reset_timeout` seconds; then a single trial call is let through (half-open),
+    which closes the circuit again if it succeeds.
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        """Initializes the CircuitBreaker class."""
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = Lock()
+        self.rejected = 0
+
+    def init_app(self, app: Any) -> None:
+        """Configures the breaker from the application config."""
+        self.failure_threshold = app.config.get('CIRCUIT_BREAKER_FAILURE_THRESHOLD', self.failure_threshold)
+        self.reset_timeout = app.config.get('CIRCUIT_BREAKER_RESET_TIMEOUT', self.reset_timeout)
+        self.reset()
+
+    def before_call(self) -> None:
+        """Raises a CircuitOpenError if the call must not go through."""
+        with self._lock:
+            if self.state == CircuitBreaker.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = CircuitBreaker.HALF_OPEN
+            if self.state == CircuitBreaker.CLOSED:
+                return
+            if self.state == CircuitBreaker.HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return
+            self.rejected += 1
+        raise CircuitOpenError(f'The {self.name} circuit is open, failing fast.')
+
+    def record_success(self) -> None:
+        """Records a successful call, closing the circuit."""
+        with self._lock:
+            self.state, self.failures, self._trial_in_flight = CircuitBreaker.CLOSED, 0, False
+
+    def record_failure(self) -> None:
+        """Records a failed call, opening the circuit if needed."""
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.state == CircuitBreaker.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state, self.opened_at = CircuitBreaker.OPEN, time.monotonic()
+
+    def reset(self) -> None:
+        """Closes the circuit."""
+        with self._lock:
+            self.state, self.failures, self.opened_at, self._trial_in_flight = CircuitBreaker.CLOSED, 0, 0.0, False
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns the state of the breaker."""
+        return dict(state=self.state, consecutive_failures=self.failures, rejected=self.rejected)
+
+
+class RateLimiter:
+    """An adaptive token bucket, keeping us under Daraja's per-shortcode TPS.
+
+    The rate is halved (down to `min_rate`) whenever Daraja throttles us, and then
+    grows back by `recovery_step` TPS per second of calls without throttling.
+    """
+
+    def __init__(self, rate: float = 10.0, burst: int = 10, min_rate: float = 1.0,
+                 recovery_step: float = 0.5, max_wait: float = 2.0):
+        """Initializes the RateLimiter class."""
+        # the Daraja `errorCode`s meaning we went over the TPS, read here so that no app context is needed
+        self.throttling_codes = ('500.003.02', '429.001.01')
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.recovery_step = recovery_step
+        self.max_wait = max_wait
+        self.tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._condition = Condition()
+        self.throttled_count = 0
+        self.rejected = 0
+
+    def init_app(self, app: Any) -> None:
+        """Configures the limiter from the application config."""
+        with self._condition:
+            self.max_rate = self.rate = app.config.get('DARAJA_TPS', self.max_rate)
+            self.burst = app.config.get('DARAJA_BURST', self.burst)
+            self.min_rate = app.config.get('DARAJA_MIN_TPS', self.min_rate)
+            self.recovery_step = app.config.get('DARAJA_TPS_RECOVERY_STEP', self.recovery_step)
+            self.max_wait = app.config.get('DARAJA_MAX_WAIT', self.max_wait)
+            self.throttling_codes = tuple(app.config.get('MPESA_THROTTLING_CODES', self.throttling_codes))
+            self.tokens, self._updated_at = float(self.burst), time.monotonic()
+
+    def acquire(self) -> bool:
+        """Takes a token, waiting up to `max_wait` seconds for one, returns False if none was available."""
+        deadline = time.monotonic() + self.max_wait
+        with self._condition:
+            while True:
+                wait = self._take(deadline)
+                if wait is None:
+                    return True
+                if wait <= 0:
+                    return False
+                self._condition.wait(wait)
+
+    async def acquire_async(self) -> bool:
+        """Like `acquire`, but waits on the event loop (the ASGI app's) rather than blocking it."""
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            with self._condition:
+                wait = self._take(deadline)
+            if wait is None:
+                return True
+            if wait <= 0:
+                return False
+            await asyncio.sleep(wait)
+
+    def _take(self, deadline: float) -> Optional[float]:
+        """Takes a token if one is available (returns None), else returns how long to wait for one (<= 0: give up)."""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return None
+        wait = min((1 - self.tokens) / self.rate, deadline - time.monotonic())
+        if wait <= 0:
+            self.rejected += 1
+        return wait
+
+    def throttled(self) -> None:
+        """Slows down after Daraja throttled a call (multiplicative decrease)."""
+        with self._condition:
+            self._refill()
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0)
+            self.throttled_count += 1
+
+    def _refill(self) -> None:
+        """Adds the tokens earned since the last refill, and recovers the rate (additive increase)."""
+        now = time.monotonic()
+        elapsed, self._updated_at = now - self._updated_at, now
+        self.tokens = min(float(self.burst), self.tokens + elapsed * self.rate)
+        self.rate = min(self.max_rate, self.rate + elapsed * self.recovery_step)
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns the state of the limiter."""
+        return dict(rate=round(self.rate, 2), max_rate=self.max_rate, tokens=round(self.tokens, 2),
+                    throttled=self.throttled_count, rejected=self.rejected)
+
+
+# the process-wide breakers and limiter, configured in `create_app`
+remittax_breaker = CircuitBreaker('remittax')
+oauth_breaker = CircuitBreaker('oauth')
+transaction_status_breaker = CircuitBreaker('transaction_status')
+rate_limiter = RateLimiter()
@@ -0,0 +1,109 @@
+from dataclasses import dataclass, field
+from types import MappingProxyType
+from typing import Any, Dict, Mapping, Optional
+from src.api_1_0.helpers.exceptions import ConfigurationError
+
+
+@dataclass(frozen=True)
+class Settings:
+    """The Daraja B2B settings, read and checked once at startup rather than on every payment.
+
+    The URLs and the static part of the payloads are prebuilt, only the per-payment
+    values are filled in (see `b2b_payload`).
+    """
+    base_url: str
+    b2b_base_url: str
+    access_key: str
+    consumer_secret: str
+    initiator: str
+    initiator_password: str
+    command_id: str
+    sender_identifier_type: str
+    receiver_identifier_type: str
+    short_code: str
+    pay_tax_code: str
+    remittax_url: str = field(init=False)
+    oauth_url: str = field(init=False)
+    transaction_status_url: str = field(init=False)
+    b2b_payload_template: Mapping[str, str] = field(init=False, repr=False)
+    transaction_status_payload_template: Mapping[str, str] = field(init=False, repr=False)
+
+    # the config key of each setting
+    CONFIG_KEYS = MappingProxyType({
+        'base_url': 'BASE_URL',
+        'b2b_base_url': 'B2B_BASE_URL',
+        'access_key': 'B2B_ACCESS_KEY',
+        'consumer_secret': 'B2B_CONSUMER_SECRET',
+        'initiator': 'B2B_INITIATOR',
+        'initiator_password': 'B2B_INITIATOR_PASSWORD',
+        'command_id': 'B2B_COMMAND_ID',
+        'sender_identifier_type': 'SENDER_IDENTIFIER_TYPE',
+        'receiver_identifier_type': 'RECIEVER_IDENTIFIER_TYPE',
+        'short_code': 'B2B_SHORT_CODE',
+        'pay_tax_code': 'PAY_TAX_CODE',
+    })
+
+    def __post_init__(self):
+        set_ = object.__setattr__  # the dataclass is frozen
+        set_(self, 'remittax_url', f'{self.b2b_base_url}/mpesa/b2b/v1/remittax')
+        set_(self, 'oauth_url', f'{self.b2b_base_url}/oauth/v1/generate?grant_type=client_credentials')
+        set_(self, 'transaction_status_url', f'{self.b2b_base_url}/mpesa/transactionstatus/v1/query')
+        set_(self, 'b2b_payload_template', MappingProxyType({
+            'Initiator': self.initiator,
+            'CommandID': self.command_id,
+            'SenderIdentifierType': self.sender_identifier_type,
+            'RecieverIdentifierType': self.receiver_identifier_type,  # typo in the docs 🤦🏽‍♀️
+            'PartyA': self.short_code,
+            'PartyB': self.pay_tax_code,
+            'Remarks': 'B2B payment.',
+            'QueueTimeOutURL': f'{self.base_url}/payment/timeout',
+            'ResultURL': f'{self.base_url}/payment/confirm'
+        }))
+        set_(self, 'transaction_status_payload_template', MappingProxyType({
+            'Initiator': self.initiator,
+            'CommandID': 'TransactionStatusQuery',
+            'TransactionID': '',
+            'PartyA': self.short_code,
+            'IdentifierType': '4',  # organisation shortcode
+            'ResultURL': f'{self.base_url}/payment/status/result',
+            'QueueTimeOutURL': f'{self.base_url}/payment/status/timeout',
+            'Remarks': 'B2B payment reconciliation.'
+        }))
+
+    @classmethod
+    def from_config(cls, config: Mapping[str, Any]) -> 'Settings':
+        """Reads the settings from the app config, raises a ConfigurationError if some are missing."""
+        missing = [key for key in cls.CONFIG_KEYS.values() if not config.get(key)]
+        if missing:
+            raise ConfigurationError(f"Missing Daraja B2B settings: {', '.join(missing)}.")
+        return cls(**{name: str(config[key]) for name, key in cls.CONFIG_KEYS.items()})
+
+    def b2b_payload(self, amount: Any, pnr: Any, security_credential: str) -> Dict[str, Any]:
+        """Returns the payload of a B2B request."""
+        return {**self.b2b_payload_template, 'SecurityCredential': security_credential, 'Amount': amount,
+                'AccountReference': pnr}
+
+    def transaction_status_payload(self, originator_conversation_id: str, security_credential: str) -> Dict[str, Any]:
+        """Returns the payload of a transaction status query."""
+        return {**self.transaction_status_payload_template, 'SecurityCredential': security_credential,
+                'OriginalConversationID': originator_conversation_id, 'Occasion': originator_conversation_id}
+
+
+# the process' settings, loaded by `load_settings`
+_settings: Optional[Settings] = None
+
+
+def load_settings(app: Any) -> Settings:
+    """Loads the settings of the app, failing fast if they're incomplete."""
+    global _settings
+    _settings = Settings.from_config(app.config)
+    app.extensions['mpesa_b2b_settings'] = _settings
+    return _settings
+
+
+def get_settings() -> Settings:
+    """Returns the settings loaded by `create_app` (or `create_async_app`)."""
+    if _settings is None:
+        raise ConfigurationError('The Daraja B2B settings are not loaded, see `create_app`.')
+    return _settings
+
@@ -0,0 +1,108 @@
+import json
+import os
+from functools import partial
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+from src.api_1_0.helpers.access_token import TokenManager, token_manager
+from src.api_1_0.helpers.credential import CredentialProvider, credential_provider
+from src.api_1_0.helpers.exceptions import ConfigurationError
+from src.api_1_0.helpers.resilience import RateLimiter, rate_limiter
+from src.api_1_0.helpers.settings import Settings, get_settings
+from src.api_1_0.helpers.transport import Transport, transport
+
+# the tenant of the payments that don't name one, served by the process-wide clients
+DEFAULT_TENANT = 'default'
+
+
+class Tenant:
+    """A shortcode (paybill) profile, with its own settings, and Daraja clients.
+
+    Each tenant caches its own access token and security credential, keeps its own
+    HTTP connection pool, and has its own rate limit (Daraja's TPS is per shortcode).
+    """
+
+    def __init__(self, name: str, settings: Settings, token_manager: TokenManager,
+                 credential_provider: CredentialProvider, transport: Transport, rate_limiter: RateLimiter):
+        """Initializes the Tenant class."""
+        self.name = name
+        self.settings = settings
+        self.token_manager = token_manager
+        self.credential_provider = credential_provider
+        self.transport = transport
+        self.rate_limiter = rate_limiter
+
+
+class TenantRegistry:
+    """The shortcode profiles served by the process, chosen by the `tenant` field of a payment.
+
+    The default tenant is configured by the app config itself; the others are read from the
+    JSON file at B2B_TENANTS_FILE, a config override (same keys as config/default.py) per tenant, e.g.
+    `{"paybill-2": {"B2B_SHORT_CODE": "600001", "B2B_INITIATOR": "...", "CERTIFICATE": "...", "DARAJA_TPS": 5}}`.
+    """
+
+    def __init__(self):
+        """Initializes the TenantRegistry class."""
+        self._tenants = dict()  # name -> Tenant
+
+    def init_app(self, app: Any, fetch: Callable[['Tenant'], Tuple[str, int]]) -> None:
+        """Builds the tenants, failing fast if one of them is misconfigured.
+
+        `fetch(tenant)` fetches a new access token of the tenant.
+        """
+        for tenant in self._tenants.values():
+            if tenant.name != DEFAULT_TENANT:
+                tenant.transport.close()
+        self._tenants = {DEFAULT_TENANT: Tenant(DEFAULT_TENANT, get_settings(), token_manager, credential_provider,
+                                                transport, rate_limiter)}
+        for name, overrides in TenantRegistry._read(app.config.get('B2B_TENANTS_FILE')).items():
+            config = dict(app.config, **overrides)
+            if 'ACCESS_TOKEN_CACHE_FILE' not in overrides and config.get('ACCESS_TOKEN_CACHE_FILE'):
+                # the tokens of different shortcodes can't be shared
+                config['ACCESS_TOKEN_CACHE_FILE'] = f"{config['ACCESS_TOKEN_CACHE_FILE']}.{name}"
+            if not os.path.isabs(config['CERTIFICATE']):
+                config['CERTIFICATE'] = os.path.join(os.path.dirname(app.config['CERTIFICATE']), config['CERTIFICATE'])
+            try:
+                settings = Settings.from_config(config)
+            except ConfigurationError as e:
+                raise ConfigurationError(f'Tenant {name}: {e}')
+            tenant = Tenant(name, settings, TokenManager(), CredentialProvider(), Transport(), RateLimiter())
+            tenant_app = SimpleNamespace(config=config)
+            tenant.token_manager.init_app(tenant_app, fetch=partial(fetch, tenant))
+            tenant.credential_provider.init_app(tenant_app)
+            tenant.transport.init_app(tenant_app)
+            tenant.rate_limiter.init_app(tenant_app)
+            self._tenants[name] = tenant
+
+    def get(self, name: Optional[str] = None) -> Optional[Tenant]:
+        """Returns the tenant (the default one if no name is given), None if it's unknown."""
+        return self._tenants.get(name or DEFAULT_TENANT)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._tenants
+
+    def __iter__(self) -> Iterator[Tenant]:
+        return iter(self._tenants.values())
+
+    def stats(self) -> Dict[str, Any]:
+        """Returns the state of each tenant's rate limiter."""
+        return {tenant.name: tenant.rate_limiter.stats() for tenant in self}
+
+    @staticmethod
+    def _read(path: Optional[str]) -> Dict[str, Dict[str, Any]]:
+        """Reads the tenants' config overrides."""
+        if not path:
+            return dict()
+        try:
+            with open(path, 'r') as f:
+                tenants = json.load(f)
+        except (OSError, ValueError) as e:
+            raise ConfigurationError(f'Failed to read the tenants at {path}: {e}')
+        if not isinstance(tenants, dict) or not all(isinstance(t, dict) for t in tenants.values()):
+            raise ConfigurationError(f'{path} must map each tenant to its config overrides.')
+        if DEFAULT_TENANT in tenants:
+            raise ConfigurationError(f'{path} cannot override the {DEFAULT_TENANT} tenant.')
+        return tenants
+
+
+# the process-wide tenant registry, configured in `create_app`
+tenants = TenantRegistry()
@@ -0,0 +1,120 @@
+import base64
+import binascii
+import csv
+import io
+import json
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from sqlalchemy import and_, or_, select
+from src import db, db_router
+from src.api_1_0.helpers.exceptions import ValidationError
+from src.api_1_0.models.b2b import B2B, B2BArchive, StatusEnum
+
+# the columns exposed by the transactions API, in the export's order
+COLUMNS = (B2B.id, B2B.pnr, B2B.tenant, B2B.amount, B2B.status, B2B.originator_conversation_id, B2B.conversation_id,
+           B2B.result_code, B2B.result_description, B2B.receipt, B2B.transaction_amount, B2B.completed_on,
+           B2B.created_on, B2B.updated_on)
+FIELDS = tuple(column.key for column in COLUMNS)
+
+
+def serialize(row: Any) -> Dict[str, Any]:
+    """Returns a transaction (a row of `COLUMNS`) as a JSON-friendly dict."""
+    values = dict(zip(FIELDS, row))
+    values['status'] = values['status'].value if values['status'] is not None else None
+    for key in ('completed_on', 'created_on', 'updated_on'):
+        values[key] = values[key].isoformat() if values[key] is not None else None
+    return values
+
+
+class TransactionQuery:
+    """Reads the B2B transactions, filtered by status, tenant and creation date.
+
+    Listing uses keyset pagination on (created_on, id), newest first, so that any page
+    costs the same as the first one; exports stream the rows from a server-side cursor.
+    Both read from a replica, if any (see `db_router`).
+    """
+
+    def __init__(self, args: Dict[str, str]):
+        """Parses the filters, raises a ValidationError if one is invalid."""
+        self.conditions = []
+        if args.get('status'):
+            try:
+                self.conditions.append(B2B.status == StatusEnum(args['status'].upper()))
+            except ValueError:
+                raise ValidationError(f"<status> must be one of {', '.join(s.value for s in StatusEnum)}.")
+        if args.get('tenant'):
+            self.conditions.append(B2B.tenant == args['tenant'])
+        for key, operator in (('created_from', '__ge__'), ('created_to', '__lt__')):
+            if args.get(key):
+                try:
+                    value = datetime.fromisoformat(args[key])
+                except ValueError:
+                    raise ValidationError(f'<{key}> must be an ISO 8601 date or datetime.')
+                self.conditions.append(getattr(B2B.created_on, operator)(value))
+
+    @staticmethod
+    def lookup(reference: str) -> Optional[Dict[str, Any]]:
+        """Returns the transaction with this PNR, (originator) conversation ID or receipt, if any.
+
+        The archived transactions are only looked up by PNR, conversation ID or receipt.
+        It's read from a replica, unless the reference was just written by this worker.
+        """
+        with db_router.replica(reference):
+            row = db.session.execute(
+                select(*COLUMNS).where(or_(B2B.pnr == reference, B2B.conversation_id == reference,
+                                           B2B.originator_conversation_id == reference, B2B.receipt == reference))
+            ).first()
+            if row is None:
+                row = db.session.execute(
+                    select(*(getattr(B2BArchive, key) for key in FIELDS))
+                    .where(or_(B2BArchive.pnr == reference, B2BArchive.conversation_id == reference,
+                               B2BArchive.receipt == reference))
+                ).first()
+        return serialize(row) if row is not None else None
+
+    def page(self, limit: int, cursor: str = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """Returns a page of transactions, and the cursor of the next one (None on the last page)."""
+        query = select(*COLUMNS).where(*self.conditions).order_by(B2B.created_on.desc(), B2B.id.desc())
+        if cursor:
+            created_on, row_id = TransactionQuery.decode_cursor(cursor)
+            query = query.where(or_(B2B.created_on < created_on,
+                                    and_(B2B.created_on == created_on, B2B.id < row_id)))
+        # one more row than asked for tells whether there is a next page
+        with db_router.replica():
+            rows = db.session.execute(query.limit(limit + 1)).all()
+        next_cursor = TransactionQuery.encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+        return [serialize(row) for row in rows[:limit]], next_cursor
+
+    def export(self, export_format: str, yield_per: int = 1000) -> Iterator[str]:
+        """Yields the transactions as CSV or NDJSON, a chunk per `yield_per` rows fetched."""
+        query = select(*COLUMNS).where(*self.conditions).order_by(B2B.created_on, B2B.id)
+        with db_router.replica():
+            rows = db.session.execute(query.execution_options(stream_results=True, yield_per=yield_per))
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=FIELDS)
+        if export_format == 'csv':
+            writer.writeheader()
+            yield buffer.getvalue()
+        for partition in rows.partitions():
+            if export_format == 'ndjson':
+                yield ''.join(json.dumps(serialize(row)) + '\n' for row in partition)
+                continue
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerows(serialize(row) for row in partition)
+            yield buffer.getvalue()
+
+    @staticmethod
+    def encode_cursor(row: Any) -> str:
+        """Returns an opaque cursor pointing after the row."""
+        value = json.dumps([row.created_on.isoformat(), row.id])
+        return base64.urlsafe_b64encode(value.encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+        """Returns the (created_on, id) of the cursor, raises a ValidationError if it's invalid."""
+        try:
+            created_on, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            return datetime.fromisoformat(created_on), int(row_id)
+        except (binascii.Error, TypeError, ValueError):
+            raise ValidationError('<cursor> is invalid.')
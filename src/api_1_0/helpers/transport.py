@@ -0,0 +1,89 @@
+import os
+from threading import Lock
+from typing import Any
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class Transport:
+    """A pooled, keep-alive HTTP client shared by all Daraja calls in a process."""
+
+    # the adapter of the pooled connections, see `WebhookDispatcher` for one connecting to public addresses only
+    adapter_class = HTTPAdapter
+
+    def __init__(self):
+        """Initializes the Transport class."""
+        self.connect_timeout = 5.0
+        self.read_timeout = 30.0
+        self.pool_connections = 4
+        self.pool_maxsize = 10
+        self.max_retries = 2
+        self.backoff_factor = 0.3
+        self._session = None
+        self._pid = None
+        self._lock = Lock()
+
+    def init_app(self, app: Any) -> None:
+        """Configures the transport from the application config."""
+        self.connect_timeout = app.config.get('HTTP_CONNECT_TIMEOUT', self.connect_timeout)
+        self.read_timeout = app.config.get('HTTP_READ_TIMEOUT', self.read_timeout)
+        self.pool_connections = app.config.get('HTTP_POOL_CONNECTIONS', self.pool_connections)
+        self.pool_maxsize = app.config.get('HTTP_POOL_MAXSIZE', self.pool_maxsize)
+        self.max_retries = app.config.get('HTTP_MAX_RETRIES', self.max_retries)
+        self.backoff_factor = app.config.get('HTTP_RETRY_BACKOFF_FACTOR', self.backoff_factor)
+        self.close()
+
+    @property
+    def session(self) -> requests.Session:
+        """Returns the session of the current process, creating it if needed."""
+        # sockets must not be shared with a forked (gunicorn) worker, hence the pid check
+        if self._session is None or self._pid != os.getpid():
+            with self._lock:
+                if self._session is None or self._pid != os.getpid():
+                    self._session, self._pid = self._create_session(), os.getpid()
+        return self._session
+
+    def _create_session(self) -> requests.Session:
+        """Creates a session with a sized connection pool and retry policy."""
+        # connection errors are always safe to retry, but only idempotent requests are
+        # retried after they were sent, we don't want to send a payment twice
+        retry = Retry(
+            total=self.max_retries,
+            connect=self.max_retries,
+            read=self.max_retries,
+            status=self.max_retries,
+            allowed_methods=frozenset(['GET']),
+            status_forcelist=(502, 503, 504),
+            backoff_factor=self.backoff_factor,
+            raise_on_status=False
+        )
+        adapter = self.adapter_class(pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize,
+                                     max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def request(self, method: str, url: str, **kwargs: Any) -> requests.Response:
+        """Sends a request through the pooled session, with the configured timeouts."""
+        kwargs.setdefault('timeout', (self.connect_timeout, self.read_timeout))
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url: str, **kwargs: Any) -> requests.Response:
+        """Sends a GET request."""
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs: Any) -> requests.Response:
+        """Sends a POST request."""
+        return self.request('POST', url, **kwargs)
+
+    def close(self) -> None:
+        """Closes the pooled connections (if any)."""
+        if self._session is not None and self._pid == os.getpid():
+            self._session.close()
+        self._session, self._pid = None, None
+
+
+# the process-wide transport, configured in `create_app`
+transport = Transport()
@@ -1,4 +1,7 @@
 from typing import Tuple, Any
+from flask import current_app
+from src.api_1_0.helpers.tenants import tenants
+from src.api_1_0.helpers.webhooks import is_webhook_url
 
 
 class Validator:
@@ -23,6 +26,13 @@ class Validator:
                     error_message = f"<{key}> cannot be less than or equal to zero."
             except ValueError as _:
                 error_message = f"<{key}> must be a number."
+        if not error_message and request.get('tenant') is not None and request['tenant'] not in tenants:
+            error_message = "<tenant> is unknown."
+        if not error_message and request.get('callback_url') is not None:
+            if not current_app.config.get('WEBHOOKS_ENABLED'):
+                error_message = "<callback_url> is not supported, the webhooks are disabled."
+            elif not is_webhook_url(request['callback_url'], current_app.config.get('WEBHOOK_ALLOWED_HOSTS', ())):
+                error_message = "<callback_url> must be a public (or allowed) http(s) URL."
         if not error_message:
             # convert the amount to an integer, and rename the `Amount` key to `amount`
             # before returning the request
@@ -0,0 +1,61 @@
+from typing import Any, Dict
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from src import db
+from src.api_1_0.helpers.tenants import tenants
+
+
+def dispose_engines(app: Any, close: bool = True) -> None:
+    """Drops the pooled DB connections of the app.
+
+    In a forked (gunicorn) worker, `close=False` leaves the sockets inherited from the
+    master alone, they're the master's to close; the worker then opens its own.
+    """
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=close)
+
+
+def warm_up(app: Any) -> Dict[str, Any]:
+    """Opens WARMUP_DB_CONNECTIONS pooled DB connections and fetches every tenant's access token
+    and security credential, so that the first requests of a worker don't pay for them.
+
+    A failure is only logged, the worker still starts (its first requests do the work instead).
+    Returns what was warmed up.
+    """
+    warmed = dict(db_connections=0, tenants=[])
+    with app.app_context():
+        connections = app.config.get('WARMUP_DB_CONNECTIONS', 0)
+        if connections:
+            try:
+                warmed['db_connections'] = _open_connections(connections)
+            except SQLAlchemyError as e:
+                app.logger.warning('Failed to open the DB connections upfront ~>\n\t%s', e)
+        if app.config.get('WARMUP_DARAJA_SECRETS'):
+            for tenant in tenants:
+                try:
+                    tenant.token_manager.get_token()
+                    tenant.credential_provider.get_credential()
+                    warmed['tenants'].append(tenant.name)
+                except (FileNotFoundError, ValueError) as e:
+                    app.logger.warning('Tenant: %s | Failed to fetch the Daraja secrets upfront ~>\n\t%s',
+                                       tenant.name, e)
+    app.logger.info('Warmed up %s DB connection(s), and the Daraja secrets of %s tenant(s).',
+                    warmed['db_connections'], len(warmed['tenants']))
+    return warmed
+
+
+def _open_connections(count: int) -> int:
+    """Opens `count` connections, held at once so that they're all distinct, and returns them to the pool."""
+    engine = db.engine
+    if hasattr(engine.pool, 'size'):
+        count = min(count, engine.pool.size())
+    connections = []
+    try:
+        for _ in range(count):
+            connections.append(engine.connect())
+            connections[-1].execute(text('SELECT 1'))
+    finally:
+        for connection in connections:
+            connection.close()
+    return len(connections)
@@ -0,0 +1,348 @@
+import atexit
+import ipaddress
+import json
+import os
+import random
+import socket
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from threading import Event, Lock, Thread
+from types import SimpleNamespace
+from typing import Any, Collection, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import SQLAlchemyError
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from urllib3.util.connection import create_connection
+from src import db
+from src.api_1_0.helpers.clock import utcnow
+from src.api_1_0.helpers.metrics import metrics
+from src.api_1_0.helpers.transport import Transport
+from src.api_1_0.models.b2b import StatusEnum, WebhookDelivery
+
+
+def is_public_address(address: str) -> bool:
+    """Whether the IP address is globally routable, i.e. not a private, loopback, link-local... one."""
+    try:
+        ip = ipaddress.ip_address(address.split('%', 1)[0])  # without the IPv6 scope
+    except ValueError:
+        return False
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+def host_addresses(host: str) -> List[str]:
+    """Returns the IP addresses the host resolves to, none if it doesn't."""
+    try:
+        return [info[4][0] for info in socket.getaddrinfo(host, None, proto=socket.IPPROTO_TCP)]
+    except (socket.gaierror, UnicodeError):
+        return []
+
+
+def is_allowed_host(host: str, allowed_hosts: Collection[str]) -> bool:
+    """Whether the host is one of the allowed ones (a `.example.com` entry allows its subdomains)."""
+    host = host.lower().rstrip('.')
+    return any(host == allowed or (allowed.startswith('.') and host.endswith(allowed)) for allowed in allowed_hosts)
+
+
+def is_webhook_url(url: Any, allowed_hosts: Collection[str] = ()) -> bool:
+    """Whether the URL can be used as a `callback_url`.
+
+    With `allowed_hosts`, only their URLs can. Otherwise, any http(s) URL can but those of a
+    non-public IP address, or of localhost; the names are resolved (again) before each POST.
+    """
+    if not isinstance(url, str) or len(url) > 2048:
+        return False
+    try:
+        parsed = urlparse(url)
+        host, _ = parsed.hostname, parsed.port  # a malformed port raises a ValueError
+    except ValueError:
+        return False
+    if parsed.scheme not in ('http', 'https') or not host:
+        return False
+    if allowed_hosts:
+        return is_allowed_host(host, allowed_hosts)
+    try:
+        ipaddress.ip_address(host)
+    except ValueError:
+        name = host.lower().rstrip('.')
+        return name != 'localhost' and not name.endswith('.localhost')
+    return is_public_address(host)
+
+
+class _PublicAddressConnection(HTTPConnection):
+    """A connection to one of the public addresses of its host, refused if the host has any other.
+
+    The host is resolved once, and the connection is made to an address of that resolution, so
+    the name can't be rebound to an internal address between the check and the connection. TLS
+    (SNI, certificate) still goes by the host name.
+    """
+
+    def _new_conn(self) -> socket.socket:
+        """Resolves the host, checks its addresses, and connects to the first one that answers."""
+        addresses = host_addresses(self.host)
+        if not addresses or not all(is_public_address(address) for address in addresses):
+            raise NewConnectionError(self, f'Failed to establish a new connection: {self.host} does not resolve '
+                                           f'(only) to public addresses')
+        error = None
+        for address in dict.fromkeys(addresses):
+            try:
+                return create_connection((address, self.port), self.timeout, source_address=self.source_address,
+                                         socket_options=self.socket_options)
+            except socket.timeout as e:
+                error = ConnectTimeoutError(self, f'Connection to {self.host} timed out. '
+                                                  f'(connect timeout={self.timeout})')
+                error.__cause__ = e
+            except OSError as e:
+                error = NewConnectionError(self, f'Failed to establish a new connection: {e}')
+                error.__cause__ = e
+        raise error
+
+
+class _PublicAddressHTTPSConnection(_PublicAddressConnection, HTTPSConnection):
+    """The HTTPS counterpart of `_PublicAddressConnection`."""
+
+
+class _PublicAddressHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _PublicAddressConnection
+
+
+class _PublicAddressHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _PublicAddressHTTPSConnection
+
+
+class PublicAddressAdapter(HTTPAdapter):
+    """A transport adapter connecting to public addresses only (see `_PublicAddressConnection`)."""
+
+    def init_poolmanager(self, *args: Any, **kwargs: Any) -> None:
+        """Creates the pool manager, with the pools of the checked connections."""
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': _PublicAddressHTTPConnectionPool,
+                                                   'https': _PublicAddressHTTPSConnectionPool}
+
+
+class WebhookDispatcher:
+    """Pushes the final status of the payments to the clients' `callback_url`.
+
+    A notification is saved (in `mpesa_b2b_webhook_deliveries`) in the same transaction
+    as the status itself, so it survives restarts. The due deliveries are claimed like
+    the outbox's payments, by pushing their `next_attempt_on` past a lease; those of the
+    same URL are coalesced into a single POST of `{"payments": [...]}` (at most
+    `max_batch` of them), sent through a pooled HTTP client, `concurrency` at a time.
+    A failed POST is retried with exponential backoff, and dropped after `max_attempts`.
+    Delivery is at-least-once: clients should expect the same notification twice.
+
+    Unless it's one of `allowed_hosts`, a URL's host must only resolve to public addresses
+    when it's POSTed to, so a `callback_url` can't reach the internal network. The check is
+    made when connecting, on the addresses connected to (see `PublicAddressAdapter`).
+    """
+
+    def __init__(self):
+        """Initializes the WebhookDispatcher class."""
+        self.app = None
+        self.enabled = False
+        self.poll_interval = 1.0
+        self.batch_size = 200
+        self.max_batch = 50
+        self.concurrency = 4
+        self.max_attempts = 8
+        self.backoff_base = 2.0
+        self.backoff_max = 3600.0
+        self.lease = 60.0
+        self.allowed_hosts = ()
+        self.transport = Transport()
+        self._thread = None
+        self._pid = None
+        self._lock = Lock()
+        self._stopping = Event()
+        atexit.register(self.stop)
+
+    def init_app(self, app: Any) -> None:
+        """Configures the dispatcher, it's started with the first request if enabled."""
+        self.stop()
+        self.app = app
+        self.enabled = app.config.get('WEBHOOKS_ENABLED', self.enabled)
+        self.poll_interval = app.config.get('WEBHOOK_POLL_INTERVAL', self.poll_interval)
+        self.batch_size = app.config.get('WEBHOOK_BATCH_SIZE', self.batch_size)
+        self.max_batch = app.config.get('WEBHOOK_MAX_BATCH', self.max_batch)
+        self.concurrency = app.config.get('WEBHOOK_CONCURRENCY', self.concurrency)
+        self.max_attempts = app.config.get('WEBHOOK_MAX_ATTEMPTS', self.max_attempts)
+        self.backoff_base = app.config.get('WEBHOOK_BACKOFF_BASE', self.backoff_base)
+        self.backoff_max = app.config.get('WEBHOOK_BACKOFF_MAX', self.backoff_max)
+        self.lease = app.config.get('WEBHOOK_LEASE', self.lease)
+        self.allowed_hosts = app.config.get('WEBHOOK_ALLOWED_HOSTS', self.allowed_hosts)
+        # the allowed hosts are trusted by name, whatever they resolve to
+        self.transport.adapter_class = HTTPAdapter if self.allowed_hosts else PublicAddressAdapter
+        # a pool of its own, the clients' endpoints shouldn't hold up the Daraja calls (and vice versa)
+        self.transport.init_app(SimpleNamespace(config=dict(
+            app.config,
+            HTTP_READ_TIMEOUT=app.config.get('WEBHOOK_TIMEOUT', 10.0),
+            HTTP_POOL_CONNECTIONS=app.config.get('WEBHOOK_POOL_CONNECTIONS', 20),
+            HTTP_POOL_MAXSIZE=self.concurrency,
+            HTTP_MAX_RETRIES=0
+        )))
+        if self.enabled:
+            app.before_request(self.ensure_started)
+
+    def ensure_started(self) -> None:
+        """Starts the dispatcher thread of the current process (gunicorn forks after import)."""
+        if self._thread is None or self._pid != os.getpid():
+            with self._lock:
+                if self._thread is None or self._pid != os.getpid():
+                    self._stopping.clear()
+                    self._thread = Thread(target=self._run, name='b2b-webhooks', daemon=True)
+                    self._pid = os.getpid()
+                    self._thread.start()
+
+    def stop(self, timeout: float = 30.0) -> None:
+        """Stops the dispatcher, once the notifications being sent are done."""
+        self._stopping.set()
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            self._thread.join(timeout)
+        self._thread, self._pid = None, None
+
+    @staticmethod
+    def notification(pnr: str, status: StatusEnum, details: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Returns the notification of a payment's final status (`details` are its result columns)."""
+        details = details or dict()
+        completed_on = details.get('completed_on')
+        return dict(
+            pnr=pnr,
+            status=status.value,
+            result_code=details.get('result_code'),
+            result_description=details.get('result_description'),
+            receipt=details.get('receipt'),
+            transaction_amount=details.get('transaction_amount'),
+            completed_on=completed_on.isoformat() if completed_on is not None else None
+        )
+
+    @staticmethod
+    def enqueue(notifications: Iterable[Tuple[str, Dict[str, Any]]]) -> int:
+        """Saves the (callback URL, notification) pairs, in the caller's transaction; returns their number."""
+        now = utcnow()
+        rows = [dict(url=url, pnr=notification['pnr'], payload=json.dumps(notification), next_attempt_on=now)
+                for url, notification in notifications]
+        if rows:
+            db.session.execute(insert(WebhookDelivery).values(rows))
+        return len(rows)
+
+    def _run(self) -> None:
+        """Delivers the notifications until stopped."""
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            while not self._stopping.is_set():
+                try:
+                    claimed = self._claim()
+                    list(executor.map(lambda group: self.deliver(*group), self._coalesce(claimed)))
+                except Exception as e:
+                    # the thread must outlive any failure, or the notifications are never sent again
+                    self.app.logger.error('Failed to deliver the webhook notifications ~>\n\t%s', e)
+                    claimed = []
+                if len(claimed) < self.batch_size:
+                    # nothing (more) is due, wait for more
+                    self._stopping.wait(self.poll_interval)
+
+    def _claim(self) -> List[Tuple[int, str, str, int]]:
+        """Claims a batch of due deliveries, returns their (id, url, payload, attempts)."""
+        with self.app.app_context():
+            now = utcnow()
+            candidates = db.session.execute(
+                select(WebhookDelivery.id, WebhookDelivery.url, WebhookDelivery.payload, WebhookDelivery.attempts)
+                .where(WebhookDelivery.next_attempt_on <= now)
+                .order_by(WebhookDelivery.next_attempt_on)
+                .limit(self.batch_size)
+            ).all()
+            claimed = []
+            for row in candidates:
+                # another worker may have claimed the delivery in the meantime
+                if db.session.execute(
+                    update(WebhookDelivery)
+                    .where(WebhookDelivery.id == row.id, WebhookDelivery.next_attempt_on <= now)
+                    .values(next_attempt_on=now + timedelta(seconds=self.lease))
+                    .execution_options(synchronize_session=False)
+                ).rowcount:
+                    claimed.append(tuple(row))
+            db.session.commit()
+            return claimed
+
+    def _coalesce(self, claimed: List[Tuple[int, str, str, int]]) -> List[Tuple[str, List[Tuple[int, str, int]]]]:
+        """Groups the deliveries by URL, in chunks of at most `max_batch`."""
+        by_url = defaultdict(list)
+        for row_id, url, payload, attempts in claimed:
+            by_url[url].append((row_id, payload, attempts))
+        return [(url, deliveries[i:i + self.max_batch])
+                for url, deliveries in by_url.items() for i in range(0, len(deliveries), self.max_batch)]
+
+    def deliver(self, url: str, deliveries: List[Tuple[int, str, int]]) -> bool:
+        """POSTs the (id, payload, attempts) deliveries to the URL at once, and records the outcome."""
+        # the payloads are JSON already, there's no need to decode them just to encode them again
+        body = '{"payments": [' + ', '.join(payload for _, payload, _ in deliveries) + ']}'
+        try:
+            # the host may resolve to an internal address by now, whatever it resolved to when validated
+            if not self.allows(url):
+                raise requests.RequestException('The host is not allowed (or does not resolve).')
+            # a redirect isn't followed, its host wasn't checked (a 3xx is a failed delivery)
+            response = self.transport.post(url, data=body.encode(), headers={'Content-Type': 'application/json'},
+                                           allow_redirects=False)
+            delivered, error = 200 <= response.status_code < 300, f'HTTP {response.status_code}'
+        except requests.RequestException as e:
+            delivered, error = False, str(e)
+        ids = [row_id for row_id, _, _ in deliveries]
+        with self.app.app_context():
+            try:
+                if delivered:
+                    db.session.execute(delete(WebhookDelivery).where(WebhookDelivery.id.in_(ids))
+                                       .execution_options(synchronize_session=False))
+                    metrics.inc('mpesa_b2b_webhooks_total', len(ids), outcome='delivered')
+                else:
+                    self._retry(url, deliveries, error)
+                db.session.commit()
+            except SQLAlchemyError:
+                # the lease expires, and the deliveries are sent again
+                db.session.rollback()
+                raise
+        return delivered
+
+    def allows(self, url: str) -> bool:
+        """Whether the URL can be POSTed to: its host is an allowed one, or only resolves to public addresses."""
+        host = urlparse(url).hostname
+        if self.allowed_hosts:
+            return bool(host) and is_allowed_host(host, self.allowed_hosts)
+        addresses = host_addresses(host) if host else []
+        return bool(addresses) and all(is_public_address(address) for address in addresses)
+
+    def _retry(self, url: str, deliveries: List[Tuple[int, str, int]], error: str) -> None:
+        """Schedules the next attempt of the failed deliveries, drops those out of attempts."""
+        exhausted = [row_id for row_id, _, attempts in deliveries if attempts + 1 >= self.max_attempts]
+        retried = [row_id for row_id, _, attempts in deliveries if attempts + 1 < self.max_attempts]
+        if exhausted:
+            self.app.logger.error('Giving up on %s webhook notification(s) to %s ~>\n\t%s', len(exhausted), url, error)
+            db.session.execute(delete(WebhookDelivery).where(WebhookDelivery.id.in_(exhausted))
+                               .execution_options(synchronize_session=False))
+            metrics.inc('mpesa_b2b_webhooks_total', len(exhausted), outcome='gave_up')
+        if retried:
+            self.app.logger.warning('Failed to deliver %s webhook notification(s) to %s, retrying ~>\n\t%s',
+                                    len(retried), url, error)
+            # the coalesced deliveries are retried together, with the backoff of the newest of them
+            attempts = min(attempts for _, _, attempts in deliveries) + 1
+            db.session.execute(
+                update(WebhookDelivery)
+                .where(WebhookDelivery.id.in_(retried))
+                .values(attempts=WebhookDelivery.attempts + 1,
+                        next_attempt_on=utcnow() + timedelta(seconds=self.backoff(attempts)))
+                .execution_options(synchronize_session=False)
+            )
+            metrics.inc('mpesa_b2b_webhooks_total', len(retried), outcome='retried')
+
+    def backoff(self, attempts: int) -> float:
+        """Returns the (full jitter) delay before the next attempt, in seconds."""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base ** attempts))
+
+
+# the process-wide webhook dispatcher, configured in `create_app`
+webhook_dispatcher = WebhookDispatcher()
@@ -1,6 +1,7 @@
 import enum
 from sqlalchemy.sql import func
 from src import db
+from src.api_1_0.helpers.clock import utcnow
 
 
 class StatusEnum(enum.Enum):
@@ -8,6 +9,8 @@ class StatusEnum(enum.Enum):
     PENDING = 'PENDING'
     SUCCESS = 'SUCCESS'
     FAILED = 'FAILED'
+    QUEUED = 'QUEUED'  # in the outbox, not sent to Daraja yet
+    UNKNOWN = 'UNKNOWN'  # sent to Daraja, but whether it was accepted isn't known (see `Reconciler.flag_unknown`)
 
 
 class B2B(db.Model):
@@ -17,8 +20,70 @@ class B2B(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     amount = db.Column(db.Integer)
     pnr = db.Column(db.String(100), unique=True, index=True, nullable=False)
-    originator_conversation_id = db.Column(db.String(100), unique=True, nullable=False)
-    conversation_id = db.Column(db.String(100), unique=True, nullable=False)
+    # the shortcode profile the payment was made from (see `TenantRegistry`)
+    tenant = db.Column(db.String(32), default='default', server_default='default', nullable=False)
+    # where the client wants the payment's final status pushed to (see `WebhookDispatcher`)
+    callback_url = db.Column(db.String(2048), nullable=True)
+    # only known once Daraja accepted the request, i.e. NULL while QUEUED
+    originator_conversation_id = db.Column(db.String(100), unique=True, nullable=True)
+    # unique, which indexes the callbacks' lookup of the payments by their conversation IDs
+    conversation_id = db.Column(db.String(100), unique=True, nullable=True)
     status = db.Column(db.Enum(StatusEnum), default=StatusEnum.PENDING)
-    created_on = db.Column(db.DateTime, index=True, server_default=func.now(), nullable=False)
-    updated_on = db.Column(db.DateTime, server_default=func.now(), onupdate=func.now(), nullable=False)
+    # from the payment's result (callback)
+    result_code = db.Column(db.Integer, nullable=True)
+    result_description = db.Column(db.String(255), nullable=True)
+    receipt = db.Column(db.String(32), index=True, nullable=True)
+    transaction_amount = db.Column(db.Integer, nullable=True)
+    completed_on = db.Column(db.DateTime, nullable=True)
+    # outbox bookkeeping
+    attempts = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    next_attempt_on = db.Column(db.DateTime, nullable=True)
+    # UTC, like the cutoffs they're compared with (the database's NOW() is in its session time zone)
+    created_on = db.Column(db.DateTime, index=True, default=utcnow, server_default=func.now(), nullable=False)
+    updated_on = db.Column(db.DateTime, default=utcnow, server_default=func.now(), onupdate=utcnow, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_mpesa_b2b_transactions_status_next_attempt_on', 'status', 'next_attempt_on'),
+        # the PENDING payments older than X (reconciler), and the transactions listing by status
+        db.Index('ix_mpesa_b2b_transactions_status_created_on', 'status', 'created_on'),
+    )
+
+
+class B2BArchive(db.Model):
+    """Archived B2B Model, the final (SUCCESS/FAILED) payments moved out of `mpesa_b2b_transactions`"""
+    __tablename__ = 'mpesa_b2b_transactions_archive'
+
+    # the payment's ID in `mpesa_b2b_transactions`
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    amount = db.Column(db.Integer)
+    pnr = db.Column(db.String(100), unique=True, index=True, nullable=False)
+    tenant = db.Column(db.String(32), default='default', server_default='default', nullable=False)
+    callback_url = db.Column(db.String(2048), nullable=True)
+    originator_conversation_id = db.Column(db.String(100), nullable=True)
+    conversation_id = db.Column(db.String(100), index=True, nullable=True)
+    status = db.Column(db.Enum(StatusEnum), nullable=False)
+    result_code = db.Column(db.Integer, nullable=True)
+    result_description = db.Column(db.String(255), nullable=True)
+    receipt = db.Column(db.String(32), index=True, nullable=True)
+    transaction_amount = db.Column(db.Integer, nullable=True)
+    completed_on = db.Column(db.DateTime, nullable=True)
+    attempts = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    next_attempt_on = db.Column(db.DateTime, nullable=True)
+    created_on = db.Column(db.DateTime, index=True, nullable=False)
+    updated_on = db.Column(db.DateTime, nullable=False)
+    archived_on = db.Column(db.DateTime, server_default=func.now(), nullable=False)
+
+
+class WebhookDelivery(db.Model):
+    """Webhook Delivery Model, a final payment status not pushed to the client's `callback_url` yet"""
+    __tablename__ = 'mpesa_b2b_webhook_deliveries'
+
+    id = db.Column(db.Integer, primary_key=True)
+    url = db.Column(db.String(2048), nullable=False)
+    pnr = db.Column(db.String(100), index=True, nullable=False)
+    # the notification, as JSON
+    payload = db.Column(db.Text, nullable=False)
+    attempts = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    # also pushed past a lease when the delivery is claimed by a worker
+    next_attempt_on = db.Column(db.DateTime, index=True, server_default=func.now(), nullable=False)
+    created_on = db.Column(db.DateTime, server_default=func.now(), nullable=False)
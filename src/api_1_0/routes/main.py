@@ -1,11 +1,20 @@
+import json
 import pytz
-from threading import Thread
 from datetime import datetime
 from typing import Dict, Any
-from flask import request, current_app
+from flask import request, current_app, stream_with_context
+from src import db, db_router
 from src.api_1_0 import api_bp
+from src.api_1_0.helpers.batch import BatchInitiator
+from src.api_1_0.helpers.callbacks import callback_journal, callback_processor
+from src.api_1_0.helpers.logs import log_pipeline
 from src.api_1_0.helpers.mpesa import MPESA
+from src.api_1_0.helpers.reconciler import Reconciler
+from src.api_1_0.helpers.resilience import oauth_breaker, rate_limiter, remittax_breaker, \
+    transaction_status_breaker
+from src.api_1_0.helpers.tenants import tenants
 from src.api_1_0.helpers.validator import Validator
+from src.api_1_0.models.b2b import B2B
 from src.api_1_0.routes.error import bad_request
 
 
@@ -13,9 +22,9 @@ from src.api_1_0.routes.error import bad_request
 def index():
     """Handle the initiation of a payment"""
     data, error_message = Validator.validate(request.get_json(silent=True))
-    current_app.logger.error(f'Received request:\n\t{data}')
+    current_app.logger.info('Received a payment request', extra=dict(payload=data))
     if error_message:
-        current_app.logger.error(f'Invalid request payload:\n\t{error_message}')
+        current_app.logger.warning('Invalid request payload: %s', error_message)
         # return a bad request response with the error message
         return bad_request(error_message)
     response, error = MPESA(data).initiate_b2b()
@@ -23,13 +32,37 @@ def index():
     return response, status_code
 
 
+@api_bp.route('/payment/initiate/batch', methods=['POST'])
+def batch():
+    """Handle the initiation of a batch of payments, a JSON list or NDJSON"""
+    if request.mimetype == 'application/x-ndjson':
+        try:
+            items = [json.loads(line) for line in request.get_data(as_text=True).splitlines() if line.strip()]
+        except ValueError:
+            return bad_request('invalid NDJSON payload.')
+    else:
+        items = request.get_json(silent=True)
+    if not items or not isinstance(items, list):
+        return bad_request('request must be a non-empty list of payments.')
+    if len(items) > current_app.config['BATCH_MAX_ITEMS']:
+        return bad_request(f"a batch cannot have more than {current_app.config['BATCH_MAX_ITEMS']} payments.")
+    current_app.logger.info('Received a batch of %s payment(s)', len(items))
+    # stream a result (as NDJSON) per payment, as each one finishes
+    results = BatchInitiator(items).run()
+    return current_app.response_class(
+        stream_with_context(json.dumps(result) + '\n' for result in results),
+        mimetype='application/x-ndjson'
+    )
+
+
 @api_bp.route('payment/confirm', methods=['POST'])
 def confirm(req: Dict[str, Any] = None):
     """Handle the confirmation of a payment"""
     data = request.get_json(silent=True) if not req else req
     tpt = datetime.now(pytz.timezone(current_app.config['TIME_ZONE']))\
         .strftime(current_app.config['TIME_FORMAT'])
-    current_app.logger.error(f'Received request:\n\t{data}')
+    current_app.logger.info('Received a payment result', extra=dict(payload=data))
+    callback_journal.append(request.path, data)
     # final response template to be returned to the client
     response = {
         'ResultCode': current_app.config['MPESA_B2B_FAILURE_CODE'],
@@ -38,18 +71,17 @@ def confirm(req: Dict[str, Any] = None):
     }
     # check if the request payload has the Result key
     if not data.get('Result'):
-        current_app.logger.error(f'Invalid request payload:\n\t{data}')
+        current_app.logger.warning('Invalid request payload', extra=dict(payload=data))
         response['ResultCode'] = current_app.config['GENERIC_FAILURE_CODE']
         response['ResultDesc'] = 'Invalid request payload.'
         return response, 400
     # check if the ResultCode is 0
     if data['Result']['ResultCode'] == current_app.config['MPESA_B2B_SUCCESS_CODE']:
         response['ResultCode'] = current_app.config['MPESA_B2B_SUCCESS_CODE']
-    # spawn a new thread to handle the confirmation
-    Thread(
-        target=MPESA.update_b2b_payment,
-        args=(current_app._get_current_object(), data['Result'])
-    ).start()
+    # queue the confirmation, it's applied in batches by the callback processor
+    if not callback_processor.submit(data['Result']):
+        # a redelivery, acknowledged like the first delivery
+        current_app.logger.info('Duplicate payment result ignored', extra=dict(payload=data))
     # we can safely return a response to the caller
     return response
 
@@ -62,3 +94,49 @@ def timeout():
     # Assuming, we get the same payload as 'confirm()',
     # we can pass the request to 'confirm()' and return the response
     return confirm(request.get_json(silent=True))
+
+
+@api_bp.route('payment/status/result', methods=['POST'])
+def status_result():
+    """Handle the result of a transaction status query, sent by the reconciler"""
+    data = request.get_json(silent=True) or {}
+    current_app.logger.info('Received a transaction status result', extra=dict(payload=data))
+    callback_journal.append(request.path, data)
+    if not isinstance(data.get('Result'), dict):
+        current_app.logger.warning('Invalid request payload', extra=dict(payload=data))
+        return {'ResultCode': current_app.config['GENERIC_FAILURE_CODE'], 'ResultDesc': 'Invalid request payload.'}, 400
+    result = Reconciler.payment_result(data['Result'])
+    if result is not None:
+        if not result['ConversationID']:
+            result['ConversationID'] = B2B.query.with_entities(B2B.conversation_id)\
+                .filter_by(originator_conversation_id=result['OriginatorConversationID']).scalar()
+        # applied with (and like) the payments' own results
+        callback_processor.submit(result)
+    return {'ResultCode': current_app.config['MPESA_B2B_SUCCESS_CODE'],
+            'ResultDesc': 'Status result received successfully.'}
+
+
+@api_bp.route('payment/status/timeout', methods=['POST'])
+def status_timeout():
+    """Handle a transaction status query that timed out, the payment is queried again later"""
+    current_app.logger.warning('Transaction status query timed out', extra=dict(payload=request.get_json(silent=True)))
+    callback_journal.append(request.path, request.get_json(silent=True))
+    return {'ResultCode': current_app.config['MPESA_B2B_SUCCESS_CODE'],
+            'ResultDesc': 'Status timeout received successfully.'}
+
+
+@api_bp.route('health', methods=['GET'])
+def health():
+    """Report the state of the background workers and of the Daraja circuits"""
+    breakers = [remittax_breaker, oauth_breaker, transaction_status_breaker]
+    return {
+        'status': 'degraded' if any(b.state != b.CLOSED for b in breakers) else 'ok',
+        'callbacks': callback_processor.stats(),
+        'logs': log_pipeline.stats(),
+        'circuit_breakers': {b.name: b.stats() for b in breakers},
+        'rate_limiter': rate_limiter.stats(),
+        # the rate limiter of each tenant (shortcode), the default one's is above
+        'tenants': tenants.stats(),
+        # the connection pool of the primary and of each read replica
+        'database': db_router.stats(db)
+    }
@@ -0,0 +1,22 @@
+from flask import request, current_app
+from src.api_1_0 import metrics_bp
+from src.api_1_0.helpers.metrics import metrics
+from src.api_1_0.helpers.profiler import profiler
+
+
+@metrics_bp.route('/metrics', methods=['GET'])
+def index():
+    """Expose the metrics of every worker, in the Prometheus text format"""
+    return current_app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@metrics_bp.route('/metrics/profile', methods=['POST'])
+def profile():
+    """Profile the worker serving the request for `seconds` seconds, in the background"""
+    if not profiler.enabled:
+        return {'error': 'the profiler is disabled.'}, 404
+    output = profiler.start(request.args.get('seconds', 30, type=float))
+    if output is None:
+        return {'error': 'a profile is already being taken.', 'output': profiler.output}, 409
+    current_app.logger.info('Profiling this worker, the profile will be written to %s', output)
+    return {'output': output}, 202
@@ -0,0 +1,49 @@
+from flask import request, current_app, stream_with_context
+from src.api_1_0 import api_bp
+from src.api_1_0.helpers.exceptions import ValidationError
+from src.api_1_0.helpers.transactions import TransactionQuery
+from src.api_1_0.routes.error import bad_request
+
+# the mimetype of each export format
+EXPORT_MIMETYPES = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+
+@api_bp.route('transactions', methods=['GET'])
+def transactions():
+    """List the transactions, newest first, a page at a time (see `next_cursor`)"""
+    limit = request.args.get('limit', current_app.config['TRANSACTIONS_PAGE_SIZE'], type=int)
+    if not 0 < limit <= current_app.config['TRANSACTIONS_MAX_PAGE_SIZE']:
+        return bad_request(f"<limit> must be between 1 and {current_app.config['TRANSACTIONS_MAX_PAGE_SIZE']}.")
+    try:
+        items, next_cursor = TransactionQuery(request.args).page(limit, request.args.get('cursor'))
+    except ValidationError as e:
+        return bad_request(str(e))
+    return {'transactions': items, 'next_cursor': next_cursor}
+
+
+@api_bp.route('transactions/export', methods=['GET'])
+def export():
+    """Export the transactions, oldest first, as CSV or NDJSON"""
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_MIMETYPES:
+        return bad_request(f"<format> must be one of {', '.join(EXPORT_MIMETYPES)}.")
+    try:
+        query = TransactionQuery(request.args)
+    except ValidationError as e:
+        return bad_request(str(e))
+    # rows are streamed as they're fetched, the export is never held in memory
+    response = current_app.response_class(
+        stream_with_context(query.export(export_format, current_app.config['TRANSACTIONS_EXPORT_YIELD_PER'])),
+        mimetype=EXPORT_MIMETYPES[export_format]
+    )
+    response.headers['Content-Disposition'] = f'attachment; filename=transactions.{export_format}'
+    return response
+
+
+@api_bp.route('transactions/<reference>', methods=['GET'])
+def transaction(reference: str):
+    """Look a transaction up by its PNR, (originator) conversation ID or receipt"""
+    item = TransactionQuery.lookup(reference)
+    if item is None:
+        return {'error': 'transaction not found.'}, 404
+    return item
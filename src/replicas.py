@@ -0,0 +1,109 @@
+import itertools
+import time
+from contextlib import contextmanager
+from threading import Lock
+from typing import Any, Dict, Iterator, List, Optional
+from flask_sqlalchemy.session import Session
+
+# the session.info keys of the routing state
+READ_FROM_REPLICA = 'mpesa_b2b_read_from_replica'
+WROTE_AT = 'mpesa_b2b_wrote_at'
+
+
+class RoutingSession(Session):
+    """A session that reads from a replica inside `db_router.replica()` blocks, and from the primary otherwise.
+
+    Writes (and flushes) always go to the primary, and so do the reads of a session
+    that wrote in the last `db_router.pin_window` seconds (read-your-writes).
+    """
+
+    def get_bind(self, mapper: Any = None, clause: Any = None, bind: Any = None, **kwargs: Any) -> Any:
+        if bind is None:
+            if self._flushing or getattr(clause, 'is_dml', False):
+                self.info[WROTE_AT] = time.monotonic()
+            elif self.info.get(READ_FROM_REPLICA) and getattr(clause, 'is_select', False) and \
+                    time.monotonic() - self.info.get(WROTE_AT, float('-inf')) >= db_router.pin_window:
+                engine = db_router.replica_engine(self._db)
+                if engine is not None:
+                    return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+class DatabaseRouter:
+    """Spreads the reads that tolerate replication lag over the read replicas (SQLALCHEMY_REPLICA_URIS).
+
+    The replicas are engine binds named `replica_<n>`, picked in turn. A reference (e.g. a PNR)
+    written by this worker is pinned to the primary for `pin_window` seconds, see `pin`.
+    """
+
+    def __init__(self):
+        """Initializes the DatabaseRouter class."""
+        self.replicas: List[str] = []
+        self.pin_window = 5.0
+        self.reads = dict()  # replica -> number of reads routed to it
+        self._pins = dict()  # reference -> until when it's pinned to the primary
+        self._turn = itertools.count()
+        self._lock = Lock()
+
+    def init_app(self, app: Any) -> None:
+        """Adds the replicas to the engine binds, so it must be called before `db.init_app`."""
+        uris = app.config.get('SQLALCHEMY_REPLICA_URIS') or ()
+        self.replicas = [f'replica_{n}' for n in range(len(uris))]
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        binds.update(zip(self.replicas, uris))
+        app.config['SQLALCHEMY_BINDS'] = binds
+        self.pin_window = app.config.get('DB_READ_YOUR_WRITES_WINDOW', self.pin_window)
+        self.reads = {name: 0 for name in self.replicas}
+        self._pins = dict()
+
+    @contextmanager
+    def replica(self, *references: Optional[str]) -> Iterator[None]:
+        """Reads from a replica in the block, unless one of the references was written recently."""
+        from src import db  # src imports this module before creating `db`
+        session = db.session()
+        previous = session.info.get(READ_FROM_REPLICA)
+        session.info[READ_FROM_REPLICA] = bool(self.replicas) and not any(self.pinned(r) for r in references if r)
+        try:
+            yield
+        finally:
+            session.info[READ_FROM_REPLICA] = previous
+
+    def pin(self, *references: str) -> None:
+        """Pins the (just written) references to the primary, until the replicas have caught up."""
+        if not self.replicas:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if len(self._pins) > 10000:
+                self._pins = {r: until for r, until in self._pins.items() if until > now}
+            for reference in references:
+                self._pins[reference] = now + self.pin_window
+
+    def pinned(self, reference: str) -> bool:
+        return self._pins.get(reference, 0.0) > time.monotonic()
+
+    def replica_engine(self, db: Any) -> Optional[Any]:
+        """Returns the next replica's engine (None without replicas)."""
+        if not self.replicas:
+            return None
+        name = self.replicas[next(self._turn) % len(self.replicas)]
+        self.reads[name] += 1
+        return db.engines[name]
+
+    def stats(self, db: Any) -> Dict[str, Any]:
+        """Returns the connection pool state of each engine, and the reads routed to each replica."""
+        stats = dict()
+        for name, engine in db.engines.items():
+            pool = engine.pool
+            stats[name or 'primary'] = dict(
+                size=pool.size() if hasattr(pool, 'size') else None,
+                checked_in=pool.checkedin() if hasattr(pool, 'checkedin') else None,
+                checked_out=pool.checkedout() if hasattr(pool, 'checkedout') else None,
+                overflow=pool.overflow() if hasattr(pool, 'overflow') else None,
+                reads=self.reads.get(name)
+            )
+        return stats
+
+
+# the process-wide router, configured in `create_app`
+db_router = DatabaseRouter()
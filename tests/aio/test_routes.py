@@ -0,0 +1,138 @@
+import asyncio
+import uuid
+from datetime import datetime
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+pytest.importorskip('quart')
+
+import httpx  # noqa: E402
+
+from src.aio import create_async_app  # noqa: E402
+from src.api_1_0.helpers.archive import archive_index  # noqa: E402
+from src.api_1_0.helpers.resilience import rate_limiter, remittax_breaker  # noqa: E402
+from src.api_1_0.models.b2b import B2B, B2BArchive, StatusEnum  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def async_app():
+    return create_async_app('testing')
+
+
+def call(async_app, method: str, url: str, **kwargs):
+    """Make a request against the ASGI app, return the status code and JSON body."""
+    async def _call():
+        async with async_app.test_app():
+            response = await getattr(async_app.test_client(), method)(url, **kwargs)
+            return response.status_code, await response.get_json()
+    return asyncio.run(_call())
+
+
+def test_async_initiate_b2b_payment_with_empty_request_payload(async_app):
+    """Test the ASGI app validates the payload like the WSGI one."""
+    assert call(async_app, 'post', '/api/v1.0/payment/initiate', json={}) == (400, {'error': 'request is empty.'})
+
+
+def test_async_initiate_and_confirm_b2b_payment(async_app, database, mocker):
+    """Test a payment goes through the ASGI app, from initiation to confirmation."""
+    conversation_id, originator_conversation_id, pnr = f'AG_{uuid.uuid4().hex}', uuid.uuid4().hex, uuid.uuid4().hex
+    mocker.patch('src.aio.mpesa.async_token_manager.get_token', AsyncMock(return_value='mock_token'))
+    mocker.patch('src.api_1_0.helpers.mpesa.MPESA.security_credential', return_value='mock_encrypted_password')
+    upstream = MagicMock(status_code=200)
+    upstream.json.return_value = {'ConversationID': conversation_id,
+                                  'OriginatorConversationID': originator_conversation_id,
+                                  'ResponseCode': '0'}
+    post = mocker.patch('src.aio.mpesa.async_transport.post', AsyncMock(return_value=upstream))
+    status_code, body = call(async_app, 'post', '/api/v1.0/payment/initiate', json={'Amount': '100', 'pnr': pnr})
+    assert status_code == 201
+    assert body == {'status_code': '0', 'status_message': 'B2B payment initiated successfully.',
+                    'account_reference': pnr}
+    assert post.call_args.kwargs['json']['AccountReference'] == pnr
+    assert B2B.query.filter_by(pnr=pnr).one().status == StatusEnum.PENDING
+    # the same PNR is rejected
+    assert call(async_app, 'post', '/api/v1.0/payment/initiate', json={'Amount': '100', 'pnr': pnr})[0] == 400
+    result = {'ResultCode': 0, 'ResultDesc': 'The service request is processed successfully.',
+              'ConversationID': conversation_id, 'OriginatorConversationID': originator_conversation_id,
+              'ResultParameters': {'ResultParameter': [
+                  {'Key': 'TransactionReceipt', 'Value': 'NLJ7RT61SV'},
+                  {'Key': 'TransactionAmount', 'Value': 100},
+                  {'Key': 'TransCompletedTime', 'Value': 20191219114550}
+              ]}}
+    assert call(async_app, 'post', '/api/v1.0/payment/confirm', json={'Result': result})[0] == 200
+    database.session.expire_all()
+    record = B2B.query.filter_by(pnr=pnr).one()
+    assert record.status == StatusEnum.SUCCESS
+    # the same result columns as the WSGI app's, e.g. for the lookups by receipt
+    assert (record.result_code, record.receipt, record.transaction_amount, record.completed_on) == \
+        (0, 'NLJ7RT61SV', 100, datetime(2019, 12, 19, 11, 45, 50))
+
+
+def test_async_initiate_b2b_payment_rejects_an_archived_pnr(async_app, database, mocker, tmp_path):
+    """Test that a PNR moved to the archive table is still rejected as a duplicate by the ASGI app."""
+    pnr, now = uuid.uuid4().hex, datetime.now()
+    mocker.patch.object(archive_index, 'path', str(tmp_path / 'archived-pnrs.bloom'))
+    mocker.patch.object(archive_index, 'reload_interval', 0)
+    archive_index.add([pnr])
+    database.session.add(B2BArchive(id=1, pnr=pnr, amount=100, status=StatusEnum.SUCCESS, created_on=now,
+                                    updated_on=now))
+    database.session.commit()
+    post = mocker.patch('src.aio.mpesa.async_transport.post', AsyncMock())
+    status_code, body = call(async_app, 'post', '/api/v1.0/payment/initiate', json={'Amount': '100', 'pnr': pnr})
+    assert (status_code, body['status_message']) == (400, 'A similar B2B payment already exists.')
+    post.assert_not_called()
+    assert B2B.query.filter_by(pnr=pnr).count() == 0  # its reservation is dropped
+    archive_index.close()
+
+
+def test_async_initiate_b2b_payment_reserves_the_pnr_before_calling_daraja(async_app, database, mocker):
+    """Test that a taken PNR is rejected upfront, a rejected payment frees its PNR, and an unknown outcome doesn't."""
+    taken, rejected, unknown = (uuid.uuid4().hex for _ in range(3))
+    database.session.add(B2B(pnr=taken, amount=100, status=StatusEnum.PENDING))  # e.g. by another host
+    database.session.commit()
+    mocker.patch('src.aio.mpesa.async_token_manager.get_token', AsyncMock(return_value='mock_token'))
+    mocker.patch('src.api_1_0.helpers.mpesa.MPESA.security_credential', return_value='mock_encrypted_password')
+    upstream = MagicMock(status_code=200)
+    upstream.json.return_value = {'errorCode': '401.002.01', 'errorMessage': 'Error Occurred - Invalid Access Token'}
+    post = mocker.patch('src.aio.mpesa.async_transport.post', AsyncMock(return_value=upstream))
+    assert call(async_app, 'post', '/api/v1.0/payment/initiate', json={'Amount': '100', 'pnr': taken})[1] == \
+        {'status_code': '999', 'status_message': 'A similar B2B payment already exists.', 'account_reference': taken}
+    post.assert_not_called()
+    status_code, body = call(async_app, 'post', '/api/v1.0/payment/initiate', json={'Amount': '100', 'pnr': rejected})
+    assert (status_code, body['status_message']) == (400, 'Failed to initiate B2B payment.')
+    assert B2B.query.filter_by(pnr=rejected).count() == 0
+    post.side_effect = httpx.ReadTimeout('timed out')
+    status_code, body = call(async_app, 'post', '/api/v1.0/payment/initiate', json={'Amount': '100', 'pnr': unknown})
+    assert (status_code, body['status_message']) == (400, 'B2B payment outcome unknown, it is being confirmed.')
+    assert B2B.query.filter_by(pnr=unknown).one().originator_conversation_id is None
+    remittax_breaker.reset()
+
+
+def test_async_initiate_b2b_payment_goes_through_the_breaker_and_the_rate_limiter(async_app, database, mocker):
+    """Test that the ASGI app fails fast on an open circuit, and slows down when Daraja throttles it."""
+    open_circuit, throttled = uuid.uuid4().hex, uuid.uuid4().hex
+    mocker.patch('src.aio.mpesa.async_token_manager.get_token', AsyncMock(return_value='mock_token'))
+    mocker.patch('src.api_1_0.helpers.mpesa.MPESA.security_credential', return_value='mock_encrypted_password')
+    upstream = MagicMock(status_code=200)
+    upstream.json.return_value = {'errorCode': '500.003.02', 'errorMessage': 'Spike arrest violation'}
+    post = mocker.patch('src.aio.mpesa.async_transport.post', AsyncMock(return_value=upstream))
+    for _ in range(remittax_breaker.failure_threshold):
+        remittax_breaker.record_failure()
+    status_code, body = call(async_app, 'post', '/api/v1.0/payment/initiate',
+                             json={'Amount': '100', 'pnr': open_circuit})
+    assert (status_code, body['status_message']) == (400, 'Failed to initiate B2B payment.')
+    post.assert_not_called()
+    assert B2B.query.filter_by(pnr=open_circuit).count() == 0  # never sent, its PNR is free again
+    remittax_breaker.reset()
+    rate = rate_limiter.rate
+    status_code, body = call(async_app, 'post', '/api/v1.0/payment/initiate', json={'Amount': '100', 'pnr': throttled})
+    assert (status_code, body['status_message']) == (400, 'Failed to initiate B2B payment.')
+    assert rate_limiter.rate == pytest.approx(rate / 2, rel=0.05)
+    assert rate_limiter.throttled_count and remittax_breaker.failures == 0
+    rate_limiter.init_app(async_app)
+
+
+def test_async_app_logs_through_the_log_pipeline(async_app):
+    """Test that the ASGI app's records are written by the pipeline's thread, not on the event loop."""
+    from src.api_1_0.helpers.logs import _QueueHandler
+    assert [type(handler) for handler in async_app.logger.handlers] == [_QueueHandler]
@@ -1,6 +1,6 @@
 import os
 import pytest
-from src import create_app
+from src import create_app, db
 
 
 @pytest.fixture(scope="session")
@@ -19,6 +19,16 @@ def runner(app):
     return app.test_cli_runner()
 
 
+@pytest.fixture
+def database(app):
+    """Create the tables in the test database, and drop them afterwards."""
+    with app.app_context():
+        db.create_all()
+        yield db
+        db.session.remove()
+        db.drop_all()
+
+
 @pytest.fixture(scope="session")
 def supply_test_config():
     """Supply the test configuration to the app."""
@@ -0,0 +1,104 @@
+import time
+from threading import Thread
+from unittest.mock import MagicMock
+
+import pytest
+
+from src.api_1_0.helpers.access_token import TokenManager
+from src.api_1_0.helpers.mpesa import MPESA
+from src.api_1_0.helpers.resilience import oauth_breaker
+from src.api_1_0.helpers.tenants import tenants
+
+
+def test_get_token_caches_the_token():
+    """Test that the token is only fetched once while it is valid."""
+    fetch = MagicMock(return_value=('mock_token', 3599))
+    manager = TokenManager(fetch)
+    assert manager.get_token() == 'mock_token'
+    assert manager.get_token() == 'mock_token'
+    fetch.assert_called_once()
+
+
+def test_get_token_refreshes_in_the_background_before_expiry():
+    """Test that a token inside its refresh window is served while a new one is fetched."""
+    fetch = MagicMock(side_effect=[('old_token', 10), ('new_token', 3599)])
+    manager = TokenManager(fetch)
+    manager.refresh_margin = 60
+    assert manager.get_token() == 'old_token'
+    # the old token is still returned, the refresh happens in the background
+    assert manager.get_token() == 'old_token'
+    for _ in range(100):
+        if fetch.call_count == 2 and not manager._lock.locked():
+            break
+        time.sleep(0.01)
+    assert manager.get_token() == 'new_token'
+
+
+def test_concurrent_callers_share_a_single_refresh():
+    """Test that concurrent callers wait on one refresh instead of each fetching a token."""
+    def slow_fetch():
+        time.sleep(0.1)
+        return 'mock_token', 3599
+    fetch = MagicMock(side_effect=slow_fetch)
+    manager = TokenManager(fetch)
+    tokens = []
+    threads = [Thread(target=lambda: tokens.append(manager.get_token())) for _ in range(10)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    assert tokens == ['mock_token'] * 10
+    fetch.assert_called_once()
+
+
+def test_token_is_shared_through_the_cache_file(tmp_path):
+    """Test that a second worker picks up the token written by the first one."""
+    cache_file = str(tmp_path / 'token.json')
+    first, second = TokenManager(MagicMock(return_value=('mock_token', 3599))), TokenManager(MagicMock())
+    first.cache_file = second.cache_file = cache_file
+    assert first.get_token() == 'mock_token'
+    assert second.get_token() == 'mock_token'
+    second.fetch.assert_not_called()
+
+
+def test_fetch_errors_are_raised_when_there_is_no_token():
+    """Test that a failed refresh raises when there is no valid token to fall back on."""
+    manager = TokenManager(MagicMock(side_effect=ValueError('boom')))
+    with pytest.raises(ValueError):
+        manager.get_token()
+
+
+def wait_for_refresh(manager: TokenManager, fetch: MagicMock, calls: int) -> None:
+    """Wait for the background refresh to be done."""
+    for _ in range(100):
+        if fetch.call_count == calls and not manager._lock.locked():
+            break
+        time.sleep(0.01)
+
+
+def test_background_refresh_fetches_a_token_outside_of_the_app_context(app, mocker):
+    """Test that the refresh thread (which has no app context) fetches the token from Daraja."""
+    tenant = tenants.get()
+    oauth_breaker.reset()
+    get = mocker.patch.object(tenant.transport, 'get')
+    get.return_value.status_code = 200
+    get.return_value.json.return_value = {'access_token': 'new_token', 'expires_in': '3599'}
+    manager = TokenManager(lambda: MPESA.fetch_access_token(tenant))
+    manager.refresh_margin = 60
+    manager._token, manager._expires_at = 'old_token', time.time() + 10
+    assert manager.get_token() == 'old_token'
+    wait_for_refresh(manager, get, 1)
+    assert manager.get_token() == 'new_token'
+
+
+def test_background_refresh_survives_any_error():
+    """Test that a failed refresh is logged, and the next caller tries again."""
+    fetch = MagicMock(side_effect=[RuntimeError('boom'), ('new_token', 3599)])
+    manager = TokenManager(fetch)
+    manager.logger = MagicMock()
+    manager.refresh_margin = 60
+    manager._token, manager._expires_at = 'old_token', time.time() + 10
+    assert manager.get_token() == 'old_token'
+    wait_for_refresh(manager, fetch, 1)
+    manager.logger.warning.assert_called_once()
+    assert manager.get_token() == 'old_token'
+    wait_for_refresh(manager, fetch, 2)
+    assert manager.get_token() == 'new_token'
@@ -0,0 +1,100 @@
+from datetime import timedelta
+
+import pytest
+from sqlalchemy import event
+
+from src import db
+from src.api_1_0.helpers.archive import ArchiveIndex, Archiver, BloomFilter, archive_index
+from src.api_1_0.helpers.mpesa import MPESA
+from src.api_1_0.helpers.clock import utcnow
+from src.api_1_0.models.b2b import B2B, B2BArchive, StatusEnum
+
+
+@pytest.fixture
+def index(app, tmp_path, monkeypatch):
+    """The process-wide archive index, with a Bloom filter in a temporary directory."""
+    monkeypatch.setattr(archive_index, 'path', str(tmp_path / 'archived-pnrs.bloom'))
+    monkeypatch.setattr(archive_index, 'capacity', 1000)
+    monkeypatch.setattr(archive_index, 'reload_interval', 0)
+    yield archive_index
+    archive_index.close()
+
+
+def add_payment(index: int, age: timedelta, status: StatusEnum) -> None:
+    db.session.add(B2B(amount=100, pnr=f'pnr-{index}', originator_conversation_id=f'{index}',
+                       conversation_id=f'AG_{index}', status=status, created_on=utcnow() - age))
+    db.session.commit()
+
+
+def test_bloom_filter_has_no_false_negatives(tmp_path):
+    """Test that every added value is found, and that the false positive rate stays near the target."""
+    bloom = BloomFilter.create(str(tmp_path / 'filter'), capacity=10000, error_rate=0.01)
+    for index in range(10000):
+        bloom.add(f'pnr-{index}')
+    bloom.flush()
+    reader = BloomFilter(str(tmp_path / 'filter'))
+    assert all(f'pnr-{index}' in reader for index in range(10000))
+    assert sum(f'other-{index}' in reader for index in range(10000)) < 200
+
+
+def test_archiver_moves_the_old_final_payments_in_chunks(app, database, index, mocker):
+    """Test that only the old SUCCESS/FAILED payments are archived, and are still seen as duplicates."""
+    add_payment(0, timedelta(days=200), StatusEnum.SUCCESS)
+    add_payment(1, timedelta(days=200), StatusEnum.FAILED)
+    add_payment(2, timedelta(days=200), StatusEnum.SUCCESS)
+    add_payment(3, timedelta(days=200), StatusEnum.PENDING)
+    add_payment(4, timedelta(days=1), StatusEnum.SUCCESS)
+    archiver = Archiver()
+    archiver.init_app(app)
+    archiver.chunk_size, archiver.chunk_pause = 2, 0
+    assert archiver.archive(after_days=180) == 3
+    assert sorted(pnr for pnr, in db.session.query(B2B.pnr)) == ['pnr-3', 'pnr-4']
+    archived = db.session.get(B2BArchive, 2)
+    assert (archived.pnr, archived.status, archived.conversation_id) == ('pnr-1', StatusEnum.FAILED, 'AG_1')
+    assert index.archived(['pnr-0', 'pnr-1', 'pnr-3', 'unknown']) == {'pnr-0', 'pnr-1'}
+
+    send = mocker.patch('src.api_1_0.helpers.mpesa.MPESA._send_b2b')
+    response, error = MPESA({'amount': 100, 'pnr': 'pnr-0'}).initiate_b2b()
+    assert error and response['status_message'] == 'A similar B2B payment already exists.'
+    send.assert_not_called()
+    assert db.session.query(B2B).filter_by(pnr='pnr-0').count() == 0  # its reservation is dropped
+
+
+def test_archive_index_rebuild(app, database, index, runner):
+    """Test that the filter is rebuilt from the archive table, and that the workers switch to it."""
+    for pnr in ('pnr-0', 'pnr-1'):
+        db.session.add(B2BArchive(id=int(pnr[-1]), amount=100, pnr=pnr, status=StatusEnum.SUCCESS,
+                                  created_on=utcnow(), updated_on=utcnow()))
+    db.session.commit()
+    assert index._current() is None  # no filter yet, every PNR is looked up
+    result = runner.invoke(args=['archive', 'rebuild-index'])
+    assert result.output == 'Indexed 2 archived PNR(s).\n'
+    assert 'pnr-1' in index._current() and 'pnr-2' not in index._current()
+    assert ArchiveIndex().archived(['pnr-1', 'pnr-2']) == {'pnr-1'}  # without a filter
+
+
+def test_archive_table_is_only_queried_for_the_pnrs_the_filter_may_have(app, database, index):
+    """Test that new PNRs are told apart in memory, before and after the first archive run."""
+    index.reload_interval = 60
+    statements = []
+    listener = lambda conn, cursor, statement, *args: statements.append(statement)  # noqa: E731
+    event.listen(db.engine, 'before_cursor_execute', listener)
+    try:
+        assert index.archived(['pnr-0']) == set() and index.archived(['pnr-1']) == set()
+        assert len(statements) == 1  # the archive table is empty (until the next check)
+        index.add(['pnr-0'])
+        index.close()  # e.g. `reload_interval` later
+        statements.clear()
+        assert index.archived(['pnr-1']) == set()
+        assert statements == []
+        index.archived(['pnr-0'])
+        assert len(statements) == 1
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', listener)
+
+
+def test_archive_index_lock_is_a_no_op_without_fcntl(index, mocker):
+    """Test that the archiver still runs where there's no `fcntl` (e.g. Windows)."""
+    mocker.patch('src.api_1_0.helpers.archive.fcntl', None)
+    with index.locked():
+        pass
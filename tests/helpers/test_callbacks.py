@@ -0,0 +1,167 @@
+import uuid
+from datetime import datetime
+
+import pytest
+
+from src import db
+from src.api_1_0.helpers.callbacks import _STOP, CallbackJournal, CallbackProcessor, TTLCache
+from src.api_1_0.helpers.mpesa import MPESA
+from src.api_1_0.models.b2b import B2B, StatusEnum
+
+
+def seed(count: int, status: StatusEnum = StatusEnum.PENDING) -> list:
+    """Insert `count` B2B records, return them."""
+    records = [B2B(amount=100, pnr=uuid.uuid4().hex, originator_conversation_id=uuid.uuid4().hex,
+                   conversation_id=uuid.uuid4().hex, status=status) for _ in range(count)]
+    db.session.add_all(records)
+    db.session.commit()
+    return records
+
+
+def result(record: B2B, code: int = 0) -> dict:
+    """Build the callback `Result` of a record."""
+    return {'ResultCode': code, 'ConversationID': record.conversation_id,
+            'OriginatorConversationID': record.originator_conversation_id}
+
+
+def status_of(record: B2B) -> StatusEnum:
+    return db.session.get(B2B, record.id).status
+
+
+def test_update_b2b_payments_applies_a_batch(app, database):
+    """Test that a batch of results moves PENDING records to their final state."""
+    success, failure, final = *seed(2), seed(1, StatusEnum.FAILED)[0]
+    unknown = {'ResultCode': 0, 'ConversationID': 'AG_0', 'OriginatorConversationID': '0'}
+    updated = MPESA.update_b2b_payments(app, [result(success), result(failure, 2001), result(final), unknown])
+    database.session.expire_all()
+    assert updated == 2
+    assert status_of(success) == StatusEnum.SUCCESS
+    assert status_of(failure) == StatusEnum.FAILED
+    assert status_of(final) == StatusEnum.FAILED  # already final, left as is
+
+
+def test_update_b2b_payments_keeps_the_first_result_of_a_transaction(app, database):
+    """Test that a redelivered result in the same batch doesn't override the first one."""
+    record = seed(1)[0]
+    MPESA.update_b2b_payments(app, [result(record, 2001), result(record, 0)])
+    database.session.expire_all()
+    assert status_of(record) == StatusEnum.FAILED
+
+
+def test_update_b2b_payments_saves_the_result_parameters(app, database):
+    """Test that each record of a batch gets the receipt, amount and completion time of its own result."""
+    first, second = seed(2)
+    results = [result(first), result(second)]
+    for index, item in enumerate(results):
+        item.update(ResultDesc='The service request is processed successfully.', TransactionID=f'NLJ{index}',
+                    ResultParameters={'ResultParameter': [
+                        {'Key': 'TransactionAmount', 'Value': 100 + index},
+                        {'Key': 'TransactionReceipt', 'Value': f'NLJ7RT6{index}'},
+                        {'Key': 'TransactionCompletedDateTime', 'Value': f'19.12.2019 11:45:5{index}'}
+                    ]})
+    MPESA.update_b2b_payments(app, results)
+    database.session.expire_all()
+    for index, record in enumerate((first, second)):
+        record = db.session.get(B2B, record.id)
+        assert (record.result_code, record.receipt, record.transaction_amount) == (0, f'NLJ7RT6{index}', 100 + index)
+        assert record.completed_on == datetime(2019, 12, 19, 11, 45, 50 + index)
+        assert record.result_description == 'The service request is processed successfully.'
+
+
+@pytest.mark.parametrize('malformed', [
+    {'ResultDesc': 5, 'ResultParameters': [{'Key': 'TransactionAmount', 'Value': 100}]},
+    {'ResultDesc': {'text': 'ok'}, 'ResultParameters': {'ResultParameter': 'TransactionReceipt'}},
+    {'ResultDesc': None, 'ResultParameters': 'none', 'TransactionID': ['NLJ0']}
+])
+def test_update_b2b_payments_tolerates_malformed_results(app, database, malformed):
+    """Test that a malformed result still finalizes its payment, with NULL for the columns it can't fill."""
+    record = seed(1)[0]
+    assert MPESA.update_b2b_payments(app, [{**result(record), **malformed}]) == 1
+    database.session.expire_all()
+    record = db.session.get(B2B, record.id)
+    assert (record.status, record.receipt, record.transaction_amount) == (StatusEnum.SUCCESS, None, None)
+    assert record.result_description == ('5' if malformed['ResultDesc'] == 5 else None)
+
+
+@pytest.fixture
+def processor(app):
+    processor = CallbackProcessor()
+    processor.init_app(app)
+    yield processor
+    processor.stop()
+
+
+def test_callback_processor_applies_callbacks_in_batches(processor, database):
+    """Test that queued callbacks are applied in batches, and counted."""
+    processor.batch_window, processor.workers = 5, 1  # only the batch size (or stop) should trigger a flush
+    processor.batch_size = 10
+    records = seed(20)
+    for record in records:
+        processor.submit(result(record))
+    processor.stop()
+    database.session.expire_all()
+    assert {status_of(record) for record in records} == {StatusEnum.SUCCESS}
+    stats = processor.stats()
+    assert stats['batches'] == 2
+    assert stats['updated'] == stats['processed'] == stats['received'] == 20
+    assert stats['queue_depth'] == 0
+
+
+def test_callback_processor_acknowledges_redeliveries_without_queueing_them(processor, database, mocker):
+    """Test that a result already queued, or of a payment known to be final, isn't applied again."""
+    processor.workers = 1
+    record, missing = seed(1)[0], B2B(conversation_id='AG_0', originator_conversation_id='0')
+    assert processor.submit(result(record)) is True
+    assert processor.submit(result(record)) is False  # still queued
+    assert processor.submit(result(missing)) is True
+    processor.stop()
+    update = mocker.spy(MPESA, 'update_b2b_payments')
+    assert processor.submit(result(record, 2001)) is False  # the payment is final
+    assert processor.submit(result(missing)) is True  # the payment wasn't found, it may be saved by now
+    processor.stop()
+    assert update.call_count == 1
+    assert processor.stats()['duplicates'] == 2
+
+
+def test_callback_processor_survives_a_failed_batch(processor, database, mocker):
+    """Test that a batch failing unexpectedly is counted as failed, and that a dead worker is replaced."""
+    processor.workers = 1
+    record = seed(1)[0]
+    mocker.patch.object(MPESA, 'update_b2b_payments', side_effect=TypeError('malformed'))
+    assert processor.submit(result(record)) is True
+    processor.stop()
+    assert processor.stats()['failed'] == 1
+    assert processor.submit(result(record)) is True  # not remembered as applied, a redelivery is queued
+    thread = processor._threads[0]
+    processor.queue.put(_STOP)  # the worker exits, as if it had died
+    thread.join()
+    processor._ensure_started()
+    assert processor._threads[0] is not thread and processor._threads[0].is_alive()
+
+
+def test_ttl_cache_forgets_the_expired_and_oldest_keys(mocker):
+    """Test that the cache is bounded in size and time."""
+    clock = mocker.patch('src.api_1_0.helpers.callbacks.time.monotonic', return_value=0)
+    cache = TTLCache(max_size=2, ttl=10)
+    assert cache.add('a') and cache.add('b') and not cache.add('a')
+    cache.add('c')
+    assert 'a' not in cache and len(cache) == 2
+    clock.return_value = 11
+    assert 'b' not in cache and cache.add('b')
+
+
+def test_callback_journal_replay(app, database, runner, tmp_path, mocker):
+    """Test that the raw callbacks are journaled, and can be applied again from the journal."""
+    journal = CallbackJournal()
+    mocker.patch.dict(app.config, {'CALLBACK_JOURNAL_DIR': str(tmp_path)})
+    journal.init_app(app)
+    record = seed(1)[0]
+    journal.append('/api/v1.0/payment/confirm', {'Result': result(record, 2001)})
+    journal.append('/api/v1.0/payment/confirm', {'invalid': True})
+    journal.close()
+    [path] = tmp_path.iterdir()
+    assert [route for route, _ in CallbackJournal.read(str(path))] == ['/api/v1.0/payment/confirm'] * 2
+    output = runner.invoke(args=['callbacks', 'replay', str(path)]).output
+    assert output == 'Replayed 1 callback(s), 1 B2B payment record(s) updated.\n'
+    database.session.expire_all()
+    assert status_of(record) == StatusEnum.FAILED
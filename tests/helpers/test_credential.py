@@ -0,0 +1,54 @@
+import base64
+import os
+
+import pytest
+from Crypto.Cipher import PKCS1_v1_5
+from Crypto.PublicKey import RSA
+
+from src.api_1_0.helpers.credential import CredentialProvider
+
+# a throwaway key pair to stand in for the M-PESA certificate
+key = RSA.generate(2048)
+
+
+@pytest.fixture
+def certificate(tmp_path):
+    """Write the public key to a temporary certificate file."""
+    path = tmp_path / 'key.cer'
+    path.write_bytes(key.publickey().export_key())
+    return str(path)
+
+
+def decrypt(credential: str) -> str:
+    """Decrypt a SecurityCredential with the private key."""
+    return PKCS1_v1_5.new(key).decrypt(base64.b64decode(credential), None).decode()
+
+
+def test_get_credential_encrypts_the_password_once(certificate, mocker):
+    """Test that the credential is computed once and then served from the cache."""
+    provider = CredentialProvider('password', certificate)
+    encrypt = mocker.spy(CredentialProvider, 'encrypt')
+    credential = provider.get_credential()
+    assert decrypt(credential) == 'password'
+    assert provider.get_credential() == credential
+    assert encrypt.call_count == 1
+
+
+def test_get_credential_picks_up_a_rotated_certificate(certificate, mocker):
+    """Test that the credential is recomputed when the certificate changes."""
+    provider = CredentialProvider('password', certificate)
+    provider.check_interval = 0
+    encrypt = mocker.spy(CredentialProvider, 'encrypt')
+    provider.get_credential()
+    provider.get_credential()
+    assert encrypt.call_count == 1
+    stat = os.stat(certificate)
+    os.utime(certificate, (stat.st_atime, stat.st_mtime + 10))
+    provider.get_credential()
+    assert encrypt.call_count == 2
+
+
+def test_get_credential_raises_correct_exception():
+    """Test that a missing certificate raises a FileNotFoundError."""
+    with pytest.raises(FileNotFoundError):
+        CredentialProvider('password', 'not/a/real/path').get_credential()
@@ -0,0 +1,61 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from src.api_1_0.helpers.idempotency import PNRGuard, SQLiteReservations
+
+
+def test_a_pnr_in_flight_cannot_be_reserved_twice():
+    """Test that a PNR is rejected while a payment for it is in flight."""
+    guard = PNRGuard()
+    assert guard.reserve('56yR533')
+    assert not guard.reserve('56yR533')
+
+
+def test_only_one_concurrent_caller_reserves_a_pnr():
+    """Test that the reservation is atomic."""
+    guard = PNRGuard()
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        reserved = list(executor.map(lambda _: guard.reserve('56yR533'), range(100)))
+    assert reserved.count(True) == 1
+
+
+def test_a_released_pnr_can_be_retried():
+    """Test that a PNR can be used again when the payment wasn't initiated."""
+    guard = PNRGuard()
+    guard.reserve('56yR533')
+    guard.release('56yR533')
+    assert guard.reserve('56yR533')
+
+
+def test_completed_pnrs_are_remembered_in_a_bounded_lru():
+    """Test that completed PNRs are rejected, and the oldest ones evicted."""
+    guard = PNRGuard(max_recent=2)
+    for pnr in ('a', 'b', 'c'):
+        guard.reserve(pnr)
+        guard.complete(pnr)
+    assert not guard.reserve('c')
+    assert guard.reserve('a')  # evicted, left to the DB check
+
+
+@pytest.fixture
+def shared(tmp_path):
+    return str(tmp_path / 'pnr.sqlite')
+
+
+def test_reservations_are_shared_across_workers(shared):
+    """Test that a PNR reserved by one worker is rejected by another one."""
+    first, second = PNRGuard(), PNRGuard()
+    first.shared = SQLiteReservations(shared, 300, 3600)
+    second.shared = SQLiteReservations(shared, 300, 3600)
+    assert first.reserve('56yR533')
+    assert not second.reserve('56yR533')
+    first.release('56yR533')
+    assert second.reserve('56yR533')
+
+
+def test_stale_shared_reservations_expire(shared):
+    """Test that a reservation left behind by a dead worker expires."""
+    reservations = SQLiteReservations(shared, -1, 3600)
+    assert reservations.reserve('56yR533')
+    assert reservations.reserve('56yR533')
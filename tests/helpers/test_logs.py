@@ -0,0 +1,58 @@
+import json
+import logging
+import os
+import queue
+
+from flask import Flask, g
+
+from src.api_1_0.helpers.logs import LogPipeline, StructuredFormatter
+
+
+def make_record(msg, *args, **extra):
+    record = logging.LogRecord('src', logging.INFO, __file__, 1, msg, args, None)
+    record.__dict__.update(extra)
+    return record
+
+
+def test_formatter_redacts_the_security_credential():
+    """Test that secrets are redacted from the arguments, the extra fields and already rendered messages."""
+    formatter = StructuredFormatter(('SecurityCredential', 'Authorization'))
+    payload = {'SecurityCredential': 'secret', 'Amount': '100'}
+    entry = json.loads(formatter.format(make_record('with payload %s', payload, headers={'Authorization': 'Bearer x'})))
+    assert 'secret' not in entry['message'] and "'Amount': '100'" in entry['message']
+    assert entry['headers'] == {'Authorization': '***'}
+    assert payload['SecurityCredential'] == 'secret'  # the caller's payload is left as is
+    text = StructuredFormatter(('SecurityCredential',), json_lines=False).format(
+        make_record("payload {'SecurityCredential': 'secret', 'Amount': '100'}", pnr='1'))
+    assert "'SecurityCredential': '***'" in text and text.endswith('{"pnr": "1"}')
+
+
+def test_records_of_unsampled_requests_are_dropped_below_warning():
+    """Test that only the warnings and errors of the requests left out of the sample are logged."""
+    pipeline = LogPipeline()
+    with Flask(__name__).test_request_context():
+        g.log_sampled = False
+        assert not pipeline.sample(make_record('Received a payment request'))
+        warning = make_record('Invalid request payload')
+        warning.levelno = logging.WARNING
+        assert pipeline.sample(warning)
+    assert pipeline.sample(make_record('outside of a request'))
+
+
+def test_records_are_written_by_the_listener_and_dropped_when_the_queue_is_full():
+    """Test that records go through the queue to the handlers, and never block the caller."""
+    records = []
+
+    class Handler(logging.Handler):
+        def emit(self, record):
+            records.append(self.format(record))
+
+    pipeline = LogPipeline()
+    pipeline.handlers = [Handler()]
+    pipeline.put(make_record('first'))
+    pipeline.stop()
+    assert records == ['first']
+    pipeline.queue, pipeline._pid = queue.Queue(maxsize=1), os.getpid()  # nothing drains this queue
+    pipeline.put(make_record('second'))
+    pipeline.put(make_record('third'))
+    assert pipeline.dropped == 1
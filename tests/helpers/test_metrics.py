@@ -0,0 +1,77 @@
+import os
+import time
+from unittest.mock import patch
+
+from src.api_1_0.helpers.metrics import Metrics
+from src.api_1_0.helpers.profiler import SamplingProfiler
+
+
+def test_histograms_are_rendered_with_cumulative_buckets():
+    """Test that a timer observation lands in the right buckets, and counters keep their labels."""
+    metrics = Metrics()
+    metrics.observe('phase_seconds', 0.02, phase='pnr_lookup')
+    metrics.observe('phase_seconds', 3, phase='pnr_lookup')
+    with metrics.timer('phase_seconds', phase='daraja_request'):
+        pass
+    metrics.inc('payments_total', outcome='duplicate_pnr')
+    metrics.inc('payments_total', 2, outcome='duplicate_pnr')
+    text = metrics.render()
+    assert '# TYPE phase_seconds histogram' in text
+    assert 'phase_seconds_bucket{phase="pnr_lookup",le="0.01"} 0' in text
+    assert 'phase_seconds_bucket{phase="pnr_lookup",le="0.025"} 1' in text
+    assert 'phase_seconds_bucket{phase="pnr_lookup",le="+Inf"} 2' in text
+    assert 'phase_seconds_count{phase="pnr_lookup"} 2' in text
+    assert 'phase_seconds_count{phase="daraja_request"} 1' in text
+    assert 'payments_total{outcome="duplicate_pnr"} 3' in text
+
+
+def test_metrics_are_aggregated_across_workers(tmp_path):
+    """Test that the snapshots of every worker in the metrics directory are summed up."""
+    worker, other = Metrics(), Metrics()
+    worker.directory = other.directory = str(tmp_path)
+    other.inc('callbacks_total', 2, outcome='not_found')
+    other.observe('phase_seconds', 0.5, phase='commit')
+    other.flush()
+    os.rename(tmp_path / f'{os.getpid()}.json', tmp_path / 'another-worker.json')
+    worker.inc('callbacks_total', outcome='not_found')
+    text = worker.render()
+    assert 'callbacks_total{outcome="not_found"} 3' in text
+    assert 'phase_seconds_count{phase="commit"} 1' in text
+
+
+def test_exited_workers_are_folded_into_the_retired_totals(tmp_path):
+    """Test that an exited worker's file is folded into a single cumulative one, and its counters kept."""
+    metrics = Metrics()
+    metrics.directory = str(tmp_path)
+    for pid in (101, 102):
+        worker = Metrics()
+        worker.directory = str(tmp_path)
+        worker.inc('callbacks_total', 2, outcome='not_found')
+        worker.observe('phase_seconds', 0.5, phase='commit')
+        with patch('src.api_1_0.helpers.metrics.os.getpid', return_value=pid):
+            worker.flush()
+    folded = (tmp_path / '102.json').read_text()
+    metrics.inc('callbacks_total', outcome='not_found')
+    assert 'callbacks_total{outcome="not_found"} 5' in metrics.render()
+    Metrics.retire(str(tmp_path), 101)
+    Metrics.retire(str(tmp_path), 102)
+    Metrics.retire(str(tmp_path), 103)  # no metrics
+    assert sorted(os.listdir(tmp_path)) == sorted([f'{os.getpid()}.json', 'retired.json'])
+    text = metrics.render()
+    assert 'callbacks_total{outcome="not_found"} 5' in text
+    assert 'phase_seconds_count{phase="commit"} 2' in text
+    # a file folded but not removed yet (e.g. read by a scrape in the meantime) isn't counted twice
+    (tmp_path / '102.json').write_text(folded)
+    assert 'callbacks_total{outcome="not_found"} 5' in metrics.render()
+
+
+def test_profiler_writes_collapsed_stacks(tmp_path):
+    """Test that the profiler samples the other threads, and writes their stacks when stopped."""
+    profiler = SamplingProfiler()
+    profiler.interval, profiler.output_dir = 0.001, str(tmp_path)
+    output = profiler.start(10)
+    assert profiler.start(10) is None  # one profile at a time
+    time.sleep(0.05)
+    profiler.stop()
+    stacks = open(output).read()
+    assert 'test_profiler_writes_collapsed_stacks (test_metrics.py)' in stacks
@@ -4,8 +4,11 @@ from typing import Tuple
 from unittest.mock import MagicMock
 
 import pytest
+import requests
+from urllib3.exceptions import MaxRetryError, NewConnectionError
 
 from src.api_1_0.helpers.mpesa import MPESA
+from src.api_1_0.helpers.resilience import remittax_breaker
 
 # the mpesa object to be used in the tests
 m = MPESA(
@@ -93,18 +96,60 @@ def test_generate_access_token_raises_correct_exception(app, supply_test_config)
 
 def generic_mocking(mocker: MagicMock, status_code: int, mock_response: dict) -> Tuple[dict, bool, MagicMock]:
     """Generic mocking for the initiate_b2b method."""
-    # mock the first method of the query object
-    mocker.patch('sqlalchemy.orm.query.Query.first', return_value=None)
-    # mock the Thread class
-    mocker.patch('src.api_1_0.helpers.mpesa.Thread')
+    # mock the reservation of the PNR in the database
+    mocker.patch('src.api_1_0.helpers.mpesa.reserve_payment', return_value=True)
+    mocker.patch('src.api_1_0.helpers.mpesa.release_payment')
+    # ... and the lookup of the archived PNRs
+    mocker.patch('src.api_1_0.helpers.mpesa.archive_index.archived', return_value=set())
+    # mock the PNR guard, the same PNR is used across tests
+    mocker.patch('src.api_1_0.helpers.mpesa.pnr_guard.reserve', return_value=True)
+    # mock the persistence worker
+    mocker.patch('src.api_1_0.helpers.mpesa.persistence_worker.submit')
     # mock the generate_access_token method
     mocker.patch('src.api_1_0.helpers.mpesa.MPESA.generate_access_token', return_value='mock_token')
-    # mock the rsa_encrypt method
-    mocker.patch('src.api_1_0.helpers.mpesa.MPESA.rsa_encrypt', return_value='mock_encrypted_password')
-    # mock the requests.post method
-    mock_requests = mocker.patch('requests.post')
+    # mock the security_credential method
+    mocker.patch('src.api_1_0.helpers.mpesa.MPESA.security_credential', return_value='mock_encrypted_password')
+    # mock the transport's post method
+    mock_requests = mocker.patch('src.api_1_0.helpers.transport.transport.post')
     mock_requests.return_value.status_code = status_code
     mock_requests.return_value.json.return_value = mock_response
     # make the call
     response, error = m.initiate_b2b()
     return response, error, mock_requests  # return the response, error and mock_requests object
+
+
+@pytest.mark.parametrize('failure, rejected', [
+    (requests.ConnectionError(MaxRetryError(None, '/', NewConnectionError(None, 'refused'))), True),
+    (requests.ConnectTimeout(), True),
+    (requests.ReadTimeout(), False),
+    (requests.ConnectionError('Connection aborted.'), False),
+    ({'errorCode': '500.003.02', 'errorMessage': 'System is busy'}, True),
+    ({'ResponseCode': '0'}, False)
+])
+def test_request_b2b_tells_rejections_from_unknown_outcomes(app, mocker, failure, rejected):
+    """Test that only the requests that never reached Daraja, or that it rejected, are reported as rejected."""
+    with app.app_context():
+        mocker.patch('src.api_1_0.helpers.mpesa.MPESA.generate_access_token', return_value='mock_token')
+        mocker.patch('src.api_1_0.helpers.mpesa.MPESA.security_credential', return_value='mock_encrypted_password')
+        post = mocker.patch('src.api_1_0.helpers.transport.transport.post')
+        if isinstance(failure, dict):
+            post.return_value.status_code = 200
+            post.return_value.json.return_value = failure
+        else:
+            post.side_effect = failure
+        assert m._request_b2b() == (None, rejected)
+    remittax_breaker.reset()
+
+
+def test_initiate_b2b_keeps_the_pnr_of_a_payment_of_unknown_outcome(app, mocker):
+    """Test that a payment Daraja may have accepted keeps its PNR, unlike a rejected one."""
+    with app.app_context():
+        mocker.patch('src.api_1_0.helpers.mpesa.MPESA._request_b2b', return_value=(None, False))
+        response, error, _ = generic_mocking(mocker, 200, {})
+        assert error and response['status_message'] == 'B2B payment outcome unknown, it is being confirmed.'
+        release = mocker.patch('src.api_1_0.helpers.mpesa.release_payment')
+        m.initiate_b2b()
+        release.assert_not_called()
+        mocker.patch('src.api_1_0.helpers.mpesa.MPESA._request_b2b', return_value=(None, True))
+        assert m.initiate_b2b()[0]['status_message'] == 'Failed to initiate B2B payment.'
+        release.assert_called_once_with(m.data['pnr'])
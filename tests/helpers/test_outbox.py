@@ -0,0 +1,121 @@
+import uuid
+
+import pytest
+from sqlalchemy import event, update
+
+from src import db
+from src.api_1_0.helpers.mpesa import MPESA
+from src.api_1_0.helpers.outbox import OutboxDispatcher
+from src.api_1_0.models.b2b import B2B, StatusEnum
+
+
+@pytest.fixture
+def dispatcher(app, database):
+    dispatcher = OutboxDispatcher()
+    dispatcher.init_app(app)
+    return dispatcher
+
+
+def queue_payment(app, mocker) -> B2B:
+    """Initiate a payment in outbox mode, return its record."""
+    mocker.patch.dict(app.config, {'OUTBOX_MODE': True})
+    pnr = uuid.uuid4().hex
+    response, error = MPESA({'amount': 100, 'pnr': pnr}).initiate_b2b()
+    assert not error
+    assert response['status_message'] == 'B2B payment queued successfully.'
+    return B2B.query.filter_by(pnr=pnr).one()
+
+
+def test_initiate_b2b_in_outbox_mode_saves_the_payment_without_calling_daraja(app, dispatcher, mocker):
+    """Test that an outbox payment is saved as QUEUED, and Daraja is left to the dispatcher."""
+    request_b2b = mocker.patch('src.api_1_0.helpers.mpesa.MPESA._request_b2b')
+    record = queue_payment(app, mocker)
+    assert record.status == StatusEnum.QUEUED
+    assert record.conversation_id is None
+    request_b2b.assert_not_called()
+
+
+def test_dispatcher_sends_the_queued_payments(app, dispatcher, mocker):
+    """Test that a claimed payment is sent, and moves to PENDING with its conversation IDs."""
+    record = queue_payment(app, mocker)
+    mocker.patch('src.api_1_0.helpers.mpesa.MPESA._request_b2b',
+                 return_value=({'ConversationID': 'AG_1', 'OriginatorConversationID': '1'}, False))
+    ids = dispatcher._claim()
+    assert ids == [record.id]
+    assert dispatcher._claim() == []  # leased
+    dispatcher.dispatch(record.id)
+    db.session.expire_all()
+    record = db.session.get(B2B, record.id)
+    assert (record.status, record.conversation_id, record.attempts) == (StatusEnum.PENDING, 'AG_1', 1)
+
+
+def test_dispatcher_claims_a_batch_with_a_single_update(app, dispatcher, mocker):
+    """Test that a batch is claimed in one UPDATE, and that rows changed since they were read aren't claimed."""
+    ids = sorted(queue_payment(app, mocker).id for _ in range(3))
+    statements = []
+    listener = lambda conn, cursor, statement, *args: statements.append(statement)  # noqa: E731
+    event.listen(db.engine, 'before_cursor_execute', listener)
+    try:
+        assert sorted(dispatcher._claim()) == ids
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', listener)
+    assert [statement.split()[0] for statement in statements] == ['SELECT', 'UPDATE']
+    db.session.execute(update(B2B).where(B2B.id.in_(ids)).values(next_attempt_on=None))
+    db.session.commit()
+    # another worker claims a row between the SELECT and the UPDATE (as without row locks)
+    execute = db.session.execute
+
+    def claimed_meanwhile(statement, *args, **kwargs):
+        if getattr(statement, 'is_update', False):
+            execute(update(B2B).where(B2B.id == ids[0]).values(status=StatusEnum.PENDING))
+        return execute(statement, *args, **kwargs)
+    mocker.patch.object(db.session, 'execute', side_effect=claimed_meanwhile)
+    assert dispatcher._claim() == []
+    mocker.stopall()
+    assert sorted(dispatcher._claim()) == ids  # the claim was rolled back (with the change, in this session)
+
+
+def test_dispatcher_retries_with_backoff_then_gives_up(app, dispatcher, mocker):
+    """Test that a rejected payment is retried later, and marked FAILED after the last attempt."""
+    record = queue_payment(app, mocker)
+    mocker.patch('src.api_1_0.helpers.mpesa.MPESA._request_b2b', return_value=(None, True))
+    dispatcher.max_attempts = 2
+    dispatcher.dispatch(record.id)
+    db.session.expire_all()
+    record = db.session.get(B2B, record.id)
+    assert record.status == StatusEnum.QUEUED
+    assert record.next_attempt_on is not None
+    dispatcher.dispatch(record.id)
+    db.session.expire_all()
+    assert db.session.get(B2B, record.id).status == StatusEnum.FAILED
+
+
+def test_dispatcher_never_resends_a_payment_of_unknown_outcome(app, dispatcher, mocker):
+    """Test that a payment Daraja may have accepted (e.g. a read timeout) is flagged UNKNOWN, for an operator."""
+    record = queue_payment(app, mocker)
+    mocker.patch('src.api_1_0.helpers.mpesa.MPESA._request_b2b', return_value=(None, False))
+    inc = mocker.patch('src.api_1_0.helpers.outbox.metrics.inc')
+    dispatcher.dispatch(record.id)
+    db.session.expire_all()
+    record = db.session.get(B2B, record.id)
+    # even with the reconciler disabled, it's listed by `flask payments unknown`
+    assert (record.status, record.conversation_id, record.attempts) == (StatusEnum.UNKNOWN, None, 1)
+    inc.assert_called_once_with('mpesa_b2b_unknown_payments_total')
+    assert dispatcher._claim() == []
+
+
+def test_dispatcher_survives_a_failed_payment(app, dispatcher, mocker):
+    """Test that a payment failing unexpectedly doesn't stop the dispatcher."""
+    record = queue_payment(app, mocker)
+    mocker.patch('src.api_1_0.helpers.mpesa.MPESA._request_b2b', side_effect=KeyError('amount'))
+    error = mocker.patch.object(app.logger, 'error')
+    dispatcher._dispatch(record.id)
+    dispatcher._dispatch(-1)  # gone
+    error.assert_called_once()
+
+
+def test_backoff_is_jittered_and_capped(dispatcher):
+    """Test that the backoff delay grows exponentially, with full jitter, up to a cap."""
+    dispatcher.backoff_base, dispatcher.backoff_max = 2, 10
+    assert all(0 <= dispatcher.backoff(3) <= 8 for _ in range(100))
+    assert all(0 <= dispatcher.backoff(10) <= 10 for _ in range(100))
@@ -0,0 +1,111 @@
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from threading import Barrier
+
+import pytest
+from sqlalchemy.dialects import mysql
+from sqlalchemy.exc import IntegrityError
+
+from src import db
+from src.api_1_0.helpers.persistence import PersistenceWorker, release_payment, reserve_payment, reserve_statement
+from src.api_1_0.models.b2b import B2B, StatusEnum
+
+
+def record(pnr: str, conversation_id: str = None) -> dict:
+    """Build the conversation IDs of a payment, as queued by the MPESA class."""
+    return dict(pnr=pnr, originator_conversation_id=uuid.uuid4().hex,
+                conversation_id=conversation_id or uuid.uuid4().hex)
+
+
+def reserve(count: int) -> list:
+    """Reserve PENDING payments, returns their PNRs."""
+    pnrs = [uuid.uuid4().hex for _ in range(count)]
+    for pnr in pnrs:
+        assert reserve_payment(dict(amount=100, pnr=pnr, status=StatusEnum.PENDING))
+    return pnrs
+
+
+@pytest.fixture
+def worker(app, database):
+    worker = PersistenceWorker()
+    worker.init_app(app)
+    worker.flush_interval = 5  # only the batch size (or stop) should trigger a flush
+    worker.batch_size = 10
+    yield worker
+    worker.stop()
+
+
+def recorded() -> int:
+    return B2B.query.filter(B2B.conversation_id.isnot(None)).count()
+
+
+def test_records_are_saved_in_batches(worker):
+    """Test that queued conversation IDs are recorded with one commit per batch."""
+    for pnr in reserve(25):
+        worker.submit(record(pnr))
+    worker.stop()  # drains the queue
+    assert recorded() == 25
+    assert worker.commits == 3
+    assert {r.status for r in B2B.query.all()} == {StatusEnum.PENDING}
+
+
+def test_a_bad_record_does_not_drop_the_batch(worker):
+    """Test that a duplicate conversation ID only loses its own record, not the whole batch."""
+    first, second, third = reserve(3)
+    worker.submit(record(first, 'duplicate'))
+    worker.submit(record(second, 'duplicate'))
+    worker.submit(record(third))
+    worker.stop()
+    assert recorded() == 2
+
+
+def test_a_full_queue_saves_the_record_inline(worker):
+    """Test that records are written on the caller's thread when the queue stays full."""
+    worker.queue.maxsize, worker.enqueue_timeout = 1, 0.01
+    worker._ensure_started = lambda: None  # nobody drains the queue
+    for pnr in reserve(2):
+        worker.submit(record(pnr))
+    assert recorded() == 1
+
+
+def test_a_pnr_is_reserved_once_under_concurrency(app, database):
+    """Test that only one of many concurrent reservations of the same PNR gets it, the others are told so."""
+    threads = 16
+    barrier = Barrier(threads)
+
+    def attempt(_) -> bool:
+        with app.app_context():
+            barrier.wait()
+            return reserve_payment(dict(amount=100, pnr='contended', status=StatusEnum.PENDING))
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        results = list(executor.map(attempt, range(threads)))
+    assert results.count(True) == 1
+    assert B2B.query.filter_by(pnr='contended').count() == 1
+
+
+def test_a_released_pnr_can_be_reserved_again(database):
+    """Test that a payment Daraja didn't accept gives its PNR back, unlike an accepted one."""
+    pnr, = reserve(1)
+    release_payment(pnr)
+    assert reserve_payment(dict(amount=100, pnr=pnr, status=StatusEnum.PENDING))
+    B2B.query.filter_by(pnr=pnr).update(dict(originator_conversation_id='1', conversation_id='AG_1'))
+    database.session.commit()
+    release_payment(pnr)
+    assert not reserve_payment(dict(amount=100, pnr=pnr, status=StatusEnum.PENDING))
+
+
+def test_a_taken_pnr_is_told_by_mysql_duplicate_entry_error(app, mocker):
+    """Test that on MySQL the reservation is a plain INSERT, whose duplicate key error (only) means the PNR is taken."""
+    payment = dict(amount=100, pnr='taken', status=StatusEnum.PENDING)
+    assert 'ON DUPLICATE' not in str(reserve_statement('mysql', payment).compile(dialect=mysql.dialect()))
+    session = mocker.patch.object(db, 'session')
+    session.get_bind.return_value.dialect.name = 'mysql'
+    session.execute.side_effect = IntegrityError('INSERT', {}, Exception(1062, "Duplicate entry 'taken' for key 'pnr'"))
+    assert reserve_payment(payment) is False
+    session.execute.side_effect = IntegrityError('INSERT', {}, Exception(1048, "Column 'amount' cannot be null"))
+    with pytest.raises(IntegrityError):
+        reserve_payment(payment)
+    session.execute.side_effect = None
+    assert reserve_payment(payment) is True
+    session.commit.assert_called_once()
@@ -0,0 +1,110 @@
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from src import db
+from src.api_1_0.helpers.clock import utcnow
+from src.api_1_0.helpers.persistence import reserve_payment
+from src.api_1_0.helpers.reconciler import Reconciler
+from src.api_1_0.models.b2b import B2B, StatusEnum
+
+
+@pytest.fixture
+def reconciler(app, database):
+    reconciler = Reconciler()
+    reconciler.init_app(app)
+    reconciler.page_size = 2
+    return reconciler
+
+
+def add_payment(index: int, age: timedelta, status: StatusEnum = StatusEnum.PENDING) -> None:
+    db.session.add(B2B(amount=100, pnr=f'pnr-{index}', originator_conversation_id=f'{index}',
+                       conversation_id=f'AG_{index}', status=status, created_on=utcnow() - age))
+    db.session.commit()
+
+
+def test_reconciler_queries_each_stale_pending_payment_once(app, reconciler, mocker):
+    """Test that the stale PENDING payments are paged through, queried, and not queried again until retried."""
+    for index in range(3):
+        add_payment(index, timedelta(hours=1))
+    add_payment(3, timedelta(seconds=1))  # not stale yet
+    add_payment(4, timedelta(hours=1), status=StatusEnum.SUCCESS)
+    mocker.patch('src.api_1_0.helpers.mpesa.MPESA.generate_access_token', return_value='mock_token')
+    mocker.patch('src.api_1_0.helpers.mpesa.MPESA.security_credential', return_value='mock_encrypted_password')
+    query = mocker.patch('src.api_1_0.helpers.mpesa.MPESA.request_transaction_status', return_value={})
+    assert reconciler.reconcile() == 3
+    assert sorted(call.args[0] for call in query.call_args_list) == ['0', '1', '2']
+    assert all(call.args[1:] == ('mock_token', 'mock_encrypted_password') for call in query.call_args_list)
+    assert reconciler.reconcile() == 0  # claimed until the retry interval elapses
+    assert reconciler._claim(None) == ([], None)  # and not even read again
+
+
+def test_reconciler_thread_survives_a_failure(app, reconciler, mocker):
+    """Test that an unexpected failure is logged, and reconciling goes on."""
+    reconcile = mocker.patch.object(reconciler, 'reconcile', side_effect=[KeyError('tenant')] + [0] * 1000)
+    reconciler.interval = 0.01
+    error = mocker.patch.object(app.logger, 'error')
+    reconciler.ensure_started()
+    try:
+        for _ in range(100):
+            if reconcile.call_count > 1:
+                break
+            time.sleep(0.01)
+    finally:
+        reconciler.stop()
+    assert reconcile.call_count > 1
+    error.assert_called_once()
+
+
+def test_payment_result_of_a_transaction_status_result():
+    """Test that a status result is turned into the payment's own result, unless it's still in progress."""
+    result = {
+        'ResultCode': 0,
+        'ResultParameters': {'ResultParameter': [
+            {'Key': 'TransactionStatus', 'Value': 'Completed'},
+            {'Key': 'ConversationID', 'Value': 'AG_1'}
+        ]},
+        'ReferenceData': {'ReferenceItem': {'Key': 'Occasion', 'Value': '1'}}
+    }
+    assert Reconciler.payment_result(result) == {
+        'ConversationID': 'AG_1', 'OriginatorConversationID': '1', 'ResultCode': 0,
+        'ResultDesc': 'Transaction status: Completed'
+    }
+    result['ResultParameters']['ResultParameter'][0]['Value'] = 'Declined'
+    assert Reconciler.payment_result(result)['ResultCode'] == 1
+    result['ResultParameters']['ResultParameter'][0]['Value'] = 'Pending'
+    assert Reconciler.payment_result(result) is None
+    assert Reconciler.payment_result({'ResultCode': 2001}) is None
+
+
+def test_payments_without_conversation_ids_are_flagged_then_settled(app, reconciler, runner):
+    """Test that a payment whose conversation IDs never came is flagged UNKNOWN, and settled by an operator."""
+    for index, age in enumerate((timedelta(hours=1), timedelta(hours=1), timedelta(seconds=1))):
+        db.session.add(B2B(amount=100, pnr=f'pnr-{index}', status=StatusEnum.PENDING, updated_on=utcnow() - age))
+    add_payment(3, timedelta(hours=1))  # its result is just late
+    db.session.commit()
+    assert sorted(reconciler.flag_unknown()) == ['pnr-0', 'pnr-1']
+    result = runner.invoke(args=['payments', 'unknown'])
+    assert [line.split('\t')[0] for line in result.output.splitlines()] == ['pnr-0', 'pnr-1']
+    result = runner.invoke(args=['payments', 'resolve', 'pnr-0', 'success', '--receipt', 'NLJ7RT61SV'])
+    assert result.exit_code == 0
+    assert runner.invoke(args=['payments', 'resolve', 'pnr-1', 'not-sent']).exit_code == 0
+    assert runner.invoke(args=['payments', 'resolve', 'pnr-2', 'failed']).exit_code != 0  # not flagged
+    db.session.expire_all()
+    settled = B2B.query.filter_by(pnr='pnr-0').one()
+    assert (settled.status, settled.receipt) == (StatusEnum.SUCCESS, 'NLJ7RT61SV')
+    assert B2B.query.filter_by(pnr='pnr-1').count() == 0  # the PNR can be used again
+
+
+def test_payment_timestamps_are_on_the_clock_of_the_cutoffs(app, reconciler, mocker):
+    """Test that a payment is timestamped in UTC by the app, not by the database's NOW() (in its session time zone)."""
+    clock = mocker.patch('src.api_1_0.helpers.clock.datetime')
+    clock.now.return_value = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    assert reserve_payment(dict(amount=100, pnr='pnr-0', status=StatusEnum.PENDING))
+    assert (B2B.query.one().created_on, B2B.query.one().updated_on) == (datetime(2020, 1, 1), datetime(2020, 1, 1))
+    assert reconciler.flag_unknown() == []
+    clock.now.return_value += timedelta(seconds=reconciler.stale_after + 1)
+    assert reconciler.flag_unknown() == ['pnr-0']
+    db.session.expire_all()
+    assert B2B.query.one().updated_on == datetime(2020, 1, 1) + timedelta(seconds=reconciler.stale_after + 1)
@@ -0,0 +1,47 @@
+import pytest
+from sqlalchemy import create_engine
+from src import db, db_router
+from src.api_1_0.helpers.transactions import TransactionQuery
+from src.api_1_0.models.b2b import B2B, StatusEnum
+
+
+@pytest.fixture
+def replica(database, tmp_path):
+    """Adds an (empty) read replica to the app, and removes it afterwards."""
+    engine = create_engine(f'sqlite:///{tmp_path}/replica.db')
+    B2B.metadata.create_all(engine)
+    replicas, reads = db_router.replicas, db_router.reads
+    db.engines['replica_0'] = engine
+    db_router.replicas, db_router.reads = ['replica_0'], {'replica_0': 0}
+    yield engine
+    db_router.replicas, db_router.reads = replicas, reads
+    db_router._pins.clear()
+    del db.engines['replica_0']
+    engine.dispose()
+
+
+def save(pnr):
+    db.session.add(B2B(pnr=pnr, amount=100, status=StatusEnum.PENDING, originator_conversation_id=f'{pnr}-oc'))
+    db.session.commit()
+    # a new session, which hasn't written anything
+    db.session.remove()
+
+
+def test_lookups_read_from_the_replica(replica):
+    """Test that a transaction lookup reads from the replica (which hasn't caught up)."""
+    save('PNR-1')
+    assert TransactionQuery.lookup('PNR-1') is None
+    assert db_router.reads['replica_0'] == 2  # the transactions, then the archive
+    assert db_router.stats(db).keys() == {'primary', 'replica_0'}
+
+
+def test_recent_writes_are_read_from_the_primary(replica):
+    """Test that a PNR pinned after a write, and a session that just wrote, read from the primary."""
+    save('PNR-1')
+    db_router.pin('PNR-1')
+    assert TransactionQuery.lookup('PNR-1')['pnr'] == 'PNR-1'
+    save('PNR-2')
+    db.session.add(B2B(pnr='PNR-3', amount=100, status=StatusEnum.PENDING))
+    db.session.flush()
+    assert TransactionQuery.lookup('PNR-2')['pnr'] == 'PNR-2'
+    assert db_router.reads['replica_0'] == 0
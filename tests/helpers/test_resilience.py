@@ -0,0 +1,84 @@
+import asyncio
+import time
+from unittest.mock import MagicMock
+
+import pytest
+import requests
+
+from src.api_1_0.helpers.exceptions import CircuitOpenError
+from src.api_1_0.helpers.mpesa import MPESA
+from src.api_1_0.helpers.resilience import CircuitBreaker, RateLimiter
+
+
+def test_circuit_opens_after_consecutive_failures_and_fails_fast():
+    """Test that the circuit opens after `failure_threshold` failures in a row."""
+    breaker = CircuitBreaker('remittax', failure_threshold=2, reset_timeout=60)
+    for _ in range(2):
+        breaker.before_call()
+        breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+
+def test_half_open_circuit_lets_a_single_trial_call_through():
+    """Test that after the reset timeout one call is tried, and closes the circuit if it succeeds."""
+    breaker = CircuitBreaker('remittax', failure_threshold=1, reset_timeout=0)
+    breaker.record_failure()
+    breaker.before_call()  # the trial call
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_guarded_call_records_failures_and_throttling(app, mocker):
+    """Test that connection errors trip the breaker, and throttling slows the limiter down."""
+    breaker, limiter = CircuitBreaker('remittax', failure_threshold=1), RateLimiter(rate=10)
+    mocker.patch('src.api_1_0.helpers.mpesa.rate_limiter', limiter)
+    with app.app_context():
+        throttled = MagicMock(status_code=500)
+        throttled.json.return_value = {'errorCode': '500.003.02'}
+        MPESA._guarded(breaker, MagicMock(return_value=throttled))
+        assert breaker.state == CircuitBreaker.CLOSED
+        assert limiter.rate == 5
+        with pytest.raises(requests.ConnectionError):
+            MPESA._guarded(breaker, MagicMock(side_effect=requests.ConnectionError()))
+        assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_rate_limiter_rejects_once_the_bucket_is_empty():
+    """Test that the bucket allows a burst, then rejects requests that would wait too long."""
+    limiter = RateLimiter(rate=1, burst=3, max_wait=0)
+    assert [limiter.acquire() for _ in range(4)] == [True, True, True, False]
+
+
+def test_rate_limiter_waits_on_the_event_loop():
+    """Test that `acquire_async` waits for the next token without blocking the loop, and gives up like `acquire`."""
+    async def acquire(limiter):
+        ticks = []
+
+        async def tick():
+            while True:
+                ticks.append(time.monotonic())
+                await asyncio.sleep(0.01)
+        ticker = asyncio.create_task(tick())
+        acquired = [await limiter.acquire_async() for _ in range(3)]
+        ticker.cancel()
+        return acquired, len(ticks)
+    acquired, ticks = asyncio.run(acquire(RateLimiter(rate=10, burst=1, max_wait=0.15)))
+    assert acquired == [True, True, True] and ticks > 5
+    acquired, _ = asyncio.run(acquire(RateLimiter(rate=1, burst=1, max_wait=0.05)))
+    assert acquired == [True, False, False]
+
+
+def test_rate_limiter_halves_its_rate_when_throttled_and_recovers():
+    """Test the limiter's multiplicative decrease and additive increase."""
+    limiter = RateLimiter(rate=8, min_rate=1, recovery_step=100)
+    limiter.throttled()
+    limiter.throttled()
+    assert limiter.rate == pytest.approx(2, abs=0.1)
+    time.sleep(0.1)
+    limiter.acquire()
+    assert limiter.rate == 8
@@ -0,0 +1,76 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from src.api_1_0.helpers.exceptions import ConfigurationError
+from src.api_1_0.helpers.settings import Settings
+
+config = {
+    'BASE_URL': 'https://example.com/api/v1.0',
+    'B2B_BASE_URL': 'https://sandbox.safaricom.co.ke',
+    'B2B_ACCESS_KEY': 'key',
+    'B2B_CONSUMER_SECRET': 'secret',
+    'B2B_INITIATOR': 'initiator',
+    'B2B_INITIATOR_PASSWORD': 'password',
+    'B2B_COMMAND_ID': 'PayTaxToKRA',
+    'SENDER_IDENTIFIER_TYPE': '4',
+    'RECIEVER_IDENTIFIER_TYPE': '4',
+    'B2B_SHORT_CODE': '600000',
+    'PAY_TAX_CODE': '572572'
+}
+
+
+def test_settings_prebuild_the_urls_and_payloads():
+    """Test that only the per-payment values are filled in the prebuilt payload."""
+    settings = Settings.from_config(config)
+    assert settings.remittax_url == 'https://sandbox.safaricom.co.ke/mpesa/b2b/v1/remittax'
+    assert settings.b2b_payload(100, 'pnr-1', 'credential') == {
+        'Initiator': 'initiator',
+        'SecurityCredential': 'credential',
+        'CommandID': 'PayTaxToKRA',
+        'SenderIdentifierType': '4',
+        'RecieverIdentifierType': '4',
+        'Amount': 100,
+        'PartyA': '600000',
+        'PartyB': '572572',
+        'Remarks': 'B2B payment.',
+        'QueueTimeOutURL': 'https://example.com/api/v1.0/payment/timeout',
+        'ResultURL': 'https://example.com/api/v1.0/payment/confirm',
+        'AccountReference': 'pnr-1'
+    }
+    with pytest.raises(TypeError):
+        settings.b2b_payload_template['Amount'] = 100
+    with pytest.raises(AttributeError):
+        settings.short_code = '600001'
+
+
+def test_settings_fail_fast_on_missing_credentials():
+    """Test that every missing setting is reported at once."""
+    with pytest.raises(ConfigurationError, match='B2B_ACCESS_KEY, B2B_CONSUMER_SECRET'):
+        Settings.from_config({**config, 'B2B_ACCESS_KEY': None, 'B2B_CONSUMER_SECRET': ''})
+
+
+def test_only_the_servers_require_the_daraja_settings():
+    """Test that the `flask` CLI runs without the Daraja B2B settings, while the WSGI app fails fast."""
+    env = dict(os.environ, FLASK_APP='wsgi.py', FLASK_ENV='testing', **{key: '' for key in config})
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    cli = subprocess.run([sys.executable, '-m', 'flask', 'routes'], cwd=root, env=env, capture_output=True, text=True)
+    assert cli.returncode == 0, cli.stderr
+    assert 'Daraja B2B settings are incomplete' in cli.stderr
+    server = subprocess.run([sys.executable, '-c', 'import wsgi'], cwd=root, env=env, capture_output=True, text=True)
+    assert server.returncode != 0
+    assert 'Missing Daraja B2B settings: BASE_URL' in server.stderr
+
+
+def test_the_cli_runs_in_production_without_the_certificate():
+    """Test that the security credential is only preloaded by the servers, the `flask` CLI doesn't need it."""
+    env = dict(os.environ, FLASK_APP='wsgi.py', FLASK_ENV='production', SSL_CERT='missing.cer',
+               SQLALCHEMY_DATABASE_URI=os.environ['SQLALCHEMY_DATABASE_URI_TEST'])
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    cli = subprocess.run([sys.executable, '-m', 'flask', 'routes'], cwd=root, env=env, capture_output=True, text=True)
+    assert cli.returncode == 0, cli.stderr
+    server = subprocess.run([sys.executable, '-c', 'import wsgi'], cwd=root, env=env, capture_output=True, text=True)
+    assert server.returncode != 0
+    assert 'FileNotFoundError' in server.stderr
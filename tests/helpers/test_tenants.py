@@ -0,0 +1,69 @@
+import json
+
+import pytest
+
+from src.api_1_0.helpers.exceptions import ConfigurationError
+from src.api_1_0.helpers.mpesa import MPESA
+from src.api_1_0.helpers.tenants import DEFAULT_TENANT, tenants
+from src.api_1_0.helpers.validator import Validator
+
+
+@pytest.fixture
+def paybill(app, tmp_path, mocker):
+    """A second tenant, with its own shortcode and credentials."""
+    path = tmp_path / 'tenants.json'
+    path.write_text(json.dumps({'paybill-2': {
+        'B2B_SHORT_CODE': '600002', 'B2B_INITIATOR': 'initiator-2', 'B2B_ACCESS_KEY': 'key-2',
+        'PAY_TAX_CODE': '572573', 'DARAJA_TPS': 2, 'DARAJA_BURST': 2
+    }}))
+    mocker.patch.dict(app.config, {'B2B_TENANTS_FILE': str(path)})
+    tenants.init_app(app, fetch=MPESA.fetch_access_token)
+    yield tenants.get('paybill-2')
+    mocker.stopall()
+    tenants.init_app(app, fetch=MPESA.fetch_access_token)
+
+
+def test_each_tenant_has_its_own_clients(paybill):
+    """Test that a tenant overrides the default settings, and doesn't share its clients."""
+    default = tenants.get()
+    assert default.name == DEFAULT_TENANT and paybill.name == 'paybill-2'
+    assert paybill.settings.b2b_payload_template['PartyA'] == '600002'
+    assert paybill.settings.b2b_payload_template['PartyB'] == '572573'
+    assert paybill.settings.remittax_url == default.settings.remittax_url
+    assert paybill.rate_limiter.max_rate == 2
+    for client in ('token_manager', 'credential_provider', 'transport', 'rate_limiter'):
+        assert getattr(paybill, client) is not getattr(default, client)
+    assert Validator.validate({'Amount': 100, 'pnr': '1', 'tenant': 'paybill-3'})[1] == '<tenant> is unknown.'
+
+
+def test_payment_is_made_from_its_tenant_shortcode(app, paybill, mocker):
+    """Test that a payment uses its tenant's token, credential, transport and payload, and is tagged with it."""
+    fetch = mocker.patch.object(paybill.token_manager, 'fetch', return_value=('token-2', 3599))
+    mocker.patch.object(paybill.credential_provider, 'get_credential', return_value='credential-2')
+    post = mocker.patch.object(paybill.transport, 'post')
+    post.return_value.status_code = 200
+    post.return_value.json.return_value = {'ConversationID': 'AG_2', 'OriginatorConversationID': '2'}
+    reserve = mocker.patch('src.api_1_0.helpers.mpesa.reserve_payment', return_value=True)
+    mocker.patch('src.api_1_0.helpers.mpesa.archive_index.archived', return_value=set())
+    submit = mocker.patch('src.api_1_0.helpers.mpesa.persistence_worker.submit')
+    with app.app_context():
+        response, error = MPESA({'amount': 100, 'pnr': 'tenant-pnr', 'tenant': 'paybill-2'}).initiate_b2b()
+    assert not error
+    fetch.assert_called_once()
+    payload, headers = post.call_args.kwargs['json'], post.call_args.kwargs['headers']
+    assert (payload['PartyA'], payload['Initiator'], payload['SecurityCredential']) == \
+        ('600002', 'initiator-2', 'credential-2')
+    assert headers['Authorization'] == 'Bearer token-2'
+    assert reserve.call_args.args[0]['tenant'] == 'paybill-2'
+    assert submit.call_args.args[0]['conversation_id'] == 'AG_2'
+
+
+def test_tenants_cannot_override_the_default_one(app, tmp_path, mocker):
+    """Test that a misconfigured tenant fails at startup."""
+    path = tmp_path / 'tenants.json'
+    path.write_text(json.dumps({DEFAULT_TENANT: {'B2B_SHORT_CODE': '600002'}}))
+    mocker.patch.dict(app.config, {'B2B_TENANTS_FILE': str(path)})
+    with pytest.raises(ConfigurationError):
+        tenants.init_app(app, fetch=MPESA.fetch_access_token)
+    mocker.stopall()
+    tenants.init_app(app, fetch=MPESA.fetch_access_token)
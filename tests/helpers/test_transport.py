@@ -0,0 +1,32 @@
+from src.api_1_0.helpers.transport import Transport
+
+
+def test_request_uses_the_configured_timeouts(mocker):
+    """Test that every request is sent with the configured connect/read timeouts."""
+    transport = Transport()
+    transport.connect_timeout, transport.read_timeout = 1.0, 2.0
+    request = mocker.patch('requests.Session.request')
+    transport.post('http://localhost:8080/mpesa/b2b/v1/remittax', json={})
+    request.assert_called_once_with('POST', 'http://localhost:8080/mpesa/b2b/v1/remittax', json={},
+                                    timeout=(1.0, 2.0))
+
+
+def test_session_is_reused_within_a_process():
+    """Test that the same pooled session is used for every call in a process."""
+    transport = Transport()
+    assert transport.session is transport.session
+
+
+def test_session_is_recreated_after_a_fork():
+    """Test that a forked worker does not reuse the parent's connections."""
+    transport = Transport()
+    session = transport.session
+    transport._pid = -1  # pretend we are in a forked child
+    assert transport.session is not session
+
+
+def test_payments_are_not_retried_once_sent():
+    """Test that the retry policy only replays idempotent requests after they were sent."""
+    retry = Transport().session.get_adapter('https://').max_retries
+    assert 'GET' in retry.allowed_methods
+    assert 'POST' not in retry.allowed_methods
@@ -0,0 +1,24 @@
+from src import db
+from src.api_1_0.helpers.tenants import tenants
+from src.api_1_0.helpers.warmup import dispose_engines, warm_up
+
+
+def test_warm_up_opens_the_connections_and_fetches_the_secrets(app, database, mocker):
+    """Test that a worker opens its DB connections, and fetches the token and credential, upfront."""
+    mocker.patch.dict(app.config, {'WARMUP_DB_CONNECTIONS': 3, 'WARMUP_DARAJA_SECRETS': True})
+    tenant = tenants.get()
+    get_token = mocker.patch.object(tenant.token_manager, 'get_token', return_value='token')
+    get_credential = mocker.patch.object(tenant.credential_provider, 'get_credential', return_value='credential')
+    dispose_engines(app)
+    warmed = warm_up(app)
+    assert warmed == dict(db_connections=3, tenants=[tenant.name])
+    assert db.engine.pool.checkedin() == 3
+    get_token.assert_called_once()
+    get_credential.assert_called_once()
+
+
+def test_warm_up_failures_do_not_stop_the_worker(app, mocker):
+    """Test that a worker still starts when Daraja (or the certificate) is unavailable."""
+    mocker.patch.dict(app.config, {'WARMUP_DB_CONNECTIONS': 0, 'WARMUP_DARAJA_SECRETS': True})
+    mocker.patch.object(tenants.get().token_manager, 'get_token', side_effect=ValueError('Daraja is down'))
+    assert warm_up(app) == dict(db_connections=0, tenants=[])
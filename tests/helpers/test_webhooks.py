@@ -0,0 +1,163 @@
+import json
+import threading
+import time
+import uuid
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+from sqlalchemy import update
+
+from src import db
+from src.api_1_0.helpers.mpesa import MPESA
+from src.api_1_0.helpers.clock import utcnow
+from src.api_1_0.helpers.webhooks import WebhookDispatcher, is_webhook_url
+from src.api_1_0.models.b2b import B2B, StatusEnum, WebhookDelivery
+
+
+@pytest.fixture
+def dispatcher(app, database, mocker):
+    # the clients' hosts resolve to a public address
+    mocker.patch('src.api_1_0.helpers.webhooks.host_addresses', return_value=['93.184.216.34'])
+    dispatcher = WebhookDispatcher()
+    dispatcher.init_app(app)
+    yield dispatcher
+    dispatcher.stop()
+
+
+def enqueue(url: str, count: int) -> None:
+    """Save `count` notifications for the URL."""
+    WebhookDispatcher.enqueue((url, WebhookDispatcher.notification(uuid.uuid4().hex, StatusEnum.SUCCESS))
+                              for _ in range(count))
+    db.session.commit()
+
+
+def test_a_final_status_is_saved_for_its_callback_url(app, database):
+    """Test that a result saves a notification for the payments with a callback URL, and only for those."""
+    records = [B2B(amount=100, pnr=uuid.uuid4().hex, originator_conversation_id=uuid.uuid4().hex,
+                   conversation_id=uuid.uuid4().hex, callback_url=url) for url in ('https://client/hook', None)]
+    database.session.add_all(records)
+    database.session.commit()
+    MPESA.update_b2b_payments(app, [{'ResultCode': 0, 'ConversationID': r.conversation_id,
+                                     'OriginatorConversationID': r.originator_conversation_id,
+                                     'TransactionID': 'NLJ7RT61SV'} for r in records])
+    delivery, = WebhookDelivery.query.all()
+    assert delivery.url == 'https://client/hook'
+    assert json.loads(delivery.payload) == dict(pnr=records[0].pnr, status='SUCCESS', result_code=0,
+                                                result_description=None, receipt='NLJ7RT61SV',
+                                                transaction_amount=None, completed_on=None)
+
+
+def test_notifications_to_the_same_url_are_coalesced(dispatcher, mocker):
+    """Test that the due notifications are sent with one POST per URL, and dropped once delivered."""
+    dispatcher.max_batch = 2
+    enqueue('https://first/hook', 3)
+    enqueue('https://second/hook', 1)
+    post = mocker.patch.object(dispatcher.transport, 'post')
+    post.return_value.status_code = 200
+    for group in dispatcher._coalesce(dispatcher._claim()):
+        assert dispatcher.deliver(*group)
+    sizes = sorted((call.args[0], len(json.loads(call.kwargs['data'])['payments'])) for call in post.call_args_list)
+    assert sizes == [('https://first/hook', 1), ('https://first/hook', 2), ('https://second/hook', 1)]
+    assert WebhookDelivery.query.count() == 0
+
+
+def test_failed_notifications_are_retried_then_dropped(dispatcher, mocker):
+    """Test that a failed POST is retried later, and given up on after `max_attempts`."""
+    dispatcher.max_attempts = 2
+    enqueue('https://client/hook', 2)
+    post = mocker.patch.object(dispatcher.transport, 'post')
+    post.return_value.status_code = 503
+    group, = dispatcher._coalesce(dispatcher._claim())
+    assert not dispatcher.deliver(*group)
+    assert {d.attempts for d in WebhookDelivery.query.all()} == {1}
+    assert dispatcher._claim() == []  # claimed until the lease expires, then backed off
+    db.session.execute(update(WebhookDelivery).values(next_attempt_on=utcnow() - timedelta(minutes=1)))
+    db.session.commit()
+    group, = dispatcher._coalesce(dispatcher._claim())
+    assert not dispatcher.deliver(*group)
+    assert WebhookDelivery.query.count() == 0
+
+
+@pytest.mark.parametrize('url, allowed_hosts, valid', [
+    ('https://client.example.com/hook', (), True),
+    ('http://93.184.216.34:8080/hook', (), True),
+    ('ftp://client.example.com/hook', (), False),
+    ('https://localhost/hook', (), False),
+    ('http://127.0.0.1/hook', (), False),
+    ('http://10.0.0.7/hook', (), False),
+    ('http://169.254.169.254/latest/meta-data', (), False),
+    ('http://[::1]/hook', (), False),
+    ('http://[::ffff:192.168.1.1]/hook', (), False),
+    ('http://client.example.com:port/hook', (), False),
+    ('https://client.example.com/hook', ('client.example.com',), True),
+    ('https://api.client.example.com/hook', ('.example.com',), True),
+    ('https://other.example.org/hook', ('.example.com',), False),
+    ('http://10.0.0.7/hook', ('10.0.0.7',), True),  # explicitly allowed
+])
+def test_callback_urls_of_internal_hosts_are_rejected(url, allowed_hosts, valid):
+    """Test that a callback URL can only point to a public (or allowed) host."""
+    assert is_webhook_url(url, allowed_hosts) is valid
+
+
+def test_notifications_to_a_host_resolving_to_an_internal_address_are_not_sent(dispatcher, mocker):
+    """Test that the host is resolved before the POST, and that an internal one fails the delivery."""
+    enqueue('https://client/hook', 1)
+    mocker.patch('src.api_1_0.helpers.webhooks.host_addresses', return_value=['93.184.216.34', '10.0.0.7'])
+    post = mocker.patch.object(dispatcher.transport, 'post')
+    group, = dispatcher._coalesce(dispatcher._claim())
+    assert not dispatcher.deliver(*group)
+    post.assert_not_called()
+    assert WebhookDelivery.query.one().attempts == 1
+    dispatcher.allowed_hosts = ('client',)
+    assert dispatcher.allows('https://client/hook')
+
+
+def test_dispatcher_connects_to_the_checked_address(app, dispatcher, mocker):
+    """Test that the connection is made to the address checked, so the host can't be rebound to an internal one."""
+    received = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            received.append((self.headers['Host'], self.rfile.read(int(self.headers['Content-Length']))))
+            self.send_response(204)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://client.test:{server.server_port}/hook'
+    try:
+        # 127.0.0.1 stands in for a public address, `client.test` only resolves through `host_addresses`
+        mocker.patch('src.api_1_0.helpers.webhooks.host_addresses', return_value=['127.0.0.1'])
+        mocker.patch('src.api_1_0.helpers.webhooks.is_public_address', return_value=True)
+        enqueue(url, 1)
+        group, = dispatcher._coalesce(dispatcher._claim())
+        assert dispatcher.deliver(*group)
+        assert received[0][0] == f'client.test:{server.server_port}'
+        # the host is rebound to an internal address once checked (by `allows`)
+        mocker.patch('src.api_1_0.helpers.webhooks.is_public_address', side_effect=[True, False])
+        enqueue(url, 1)
+        group, = dispatcher._coalesce(dispatcher._claim())
+        assert not dispatcher.deliver(*group)
+        assert len(received) == 1
+        assert WebhookDelivery.query.one().attempts == 1
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_dispatcher_thread_survives_a_failure(app, dispatcher, mocker):
+    """Test that an unexpected failure is logged, and the deliveries go on."""
+    claim = mocker.patch.object(dispatcher, '_claim', side_effect=[KeyError('url')] + [[]] * 1000)
+    dispatcher.poll_interval = 0.01
+    error = mocker.patch.object(app.logger, 'error')
+    dispatcher.ensure_started()
+    for _ in range(100):
+        if claim.call_count > 1:
+            break
+        time.sleep(0.01)
+    dispatcher.stop()
+    assert claim.call_count > 1
+    error.assert_called_once()
@@ -0,0 +1,78 @@
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Iterator, List
+
+import pytest
+from sqlalchemy import create_engine, event, or_, select, text, update
+
+from src import db
+from src.api_1_0.helpers.mpesa import MPESA
+from src.api_1_0.models.b2b import B2B, StatusEnum
+
+ROWS = 20_000
+
+
+@pytest.fixture(scope='module')
+def engine():
+    """An (analyzed) SQLite database of transactions, 1% of them PENDING."""
+    engine = create_engine('sqlite://')
+    db.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(text(f"""
+            WITH RECURSIVE seq(n) AS (SELECT 1 UNION ALL SELECT n + 1 FROM seq WHERE n < {ROWS})
+            INSERT INTO mpesa_b2b_transactions (amount, pnr, originator_conversation_id, conversation_id,
+                                                status, attempts, created_on, updated_on)
+            SELECT 100, 'pnr-' || n, n, 'AG_' || n, CASE WHEN n % 100 = 0 THEN 'PENDING' ELSE 'SUCCESS' END, 0,
+                   datetime('2024-01-01', '+' || n || ' minutes'), datetime('2024-01-01', '+' || n || ' minutes')
+            FROM seq
+        """))
+        connection.execute(text('ANALYZE'))
+    yield engine
+    engine.dispose()
+
+
+@contextmanager
+def explained(engine) -> Iterator[None]:
+    """Turns the statements executed in the block into EXPLAIN QUERY PLAN ones."""
+    def explain(conn, cursor, statement, parameters, context, executemany):
+        return f'EXPLAIN QUERY PLAN {statement}', parameters
+
+    event.listen(engine, 'before_cursor_execute', explain, retval=True)
+    try:
+        yield
+    finally:
+        event.remove(engine, 'before_cursor_execute', explain)
+
+
+def query_plan(engine, statement) -> List[str]:
+    with explained(engine), engine.connect() as connection:
+        return [row[-1] for row in connection.execute(statement)]
+
+
+def test_callback_lookup_uses_the_conversation_id_index(engine):
+    """Test the lookup and PENDING update of a batch of callbacks (see `update_b2b_payments`)."""
+    keys = [(f'AG_{n}', f'{n}') for n in range(100, 300, 100)]
+    in_pairs = MPESA._in_pairs(keys)
+    lookup = select(B2B.conversation_id, B2B.originator_conversation_id, B2B.status).where(in_pairs)
+    for statement in (lookup, update(B2B).where(in_pairs).where(B2B.status == StatusEnum.PENDING)
+                      .values(status=StatusEnum.SUCCESS)):
+        plan = query_plan(engine, statement)
+        # the unique conversation ID narrows the lookup down to one row, no composite index needed
+        assert any('(conversation_id=?' in step for step in plan), plan
+        assert not any(step.startswith('SCAN mpesa_b2b_transactions') for step in plan), plan
+
+
+def test_stale_pending_lookup_uses_the_status_created_on_index(engine):
+    """Test the reconciler's page of stale PENDING payments, and the listing of transactions by status."""
+    now = datetime(2025, 1, 1)
+    stale = select(B2B.id, B2B.created_on)\
+        .where(B2B.status == StatusEnum.PENDING, B2B.created_on < now, B2B.originator_conversation_id.isnot(None),
+               or_(B2B.next_attempt_on.is_(None), B2B.next_attempt_on <= now))\
+        .order_by(B2B.created_on, B2B.id).limit(500)
+    plan = query_plan(engine, stale)
+    assert any('ix_mpesa_b2b_transactions_status_created_on' in step for step in plan), plan
+    assert not any(step.startswith('SCAN') for step in plan), plan
+    listing = select(B2B.id).where(B2B.status == StatusEnum.PENDING)\
+        .order_by(B2B.created_on.desc(), B2B.id.desc()).limit(100)
+    plan = query_plan(engine, listing)
+    assert any('ix_mpesa_b2b_transactions_status_created_on' in step for step in plan), plan
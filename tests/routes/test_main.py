@@ -1,3 +1,8 @@
+import json
+
+from src.api_1_0.models.b2b import B2B
+
+
 def test_initiate_b2b_payment_with_empty_request_payload(client):
     """Test initiate b2b payment with empty payload."""
     response = client.post(
@@ -66,3 +71,107 @@ def test_initiate_b2b_payment_with_amount_less_than_1(client):
     assert response.json == {
         'error': '<Amount> cannot be less than or equal to zero.'
     }
+
+
+def test_initiate_b2b_payment_with_a_callback_url_while_the_webhooks_are_disabled(client):
+    """Test initiate b2b payment with a callback URL, which needs the webhooks to be enabled."""
+    response = client.post(
+        '/api/v1.0/payment/initiate',
+        json={'Amount': '100', 'pnr': '1234567890', 'callback_url': 'https://client/hook'}
+    )
+    assert response.status_code == 400
+    assert response.json == {
+        'error': '<callback_url> is not supported, the webhooks are disabled.'
+    }
+
+
+def test_confirm_b2b_payment_queues_the_result(client, mocker):
+    """Test confirm b2b payment hands the result over to the callback processor."""
+    submit = mocker.patch('src.api_1_0.routes.main.callback_processor.submit')
+    result = {'ResultCode': 0, 'ConversationID': 'AG_201_88531', 'OriginatorConversationID': '1247_2348'}
+    response = client.post(
+        '/api/v1.0/payment/confirm',
+        json={'Result': result}
+    )
+    assert response.status_code == 200
+    submit.assert_called_once_with(result)
+
+
+def test_health_reports_the_callback_queue(client):
+    """Test the health endpoint exposes the callback queue metrics."""
+    response = client.get('/api/v1.0/health')
+    assert response.status_code == 200
+    assert 'queue_depth' in response.json['callbacks']
+
+
+def test_initiate_b2b_payment_batch_streams_a_result_per_payment(client, database, mocker):
+    """Test a batch is validated, checked for duplicates, and initiated with a single token."""
+    database.session.add(B2B(amount=100, pnr='existing', originator_conversation_id='1', conversation_id='AG_1'))
+    database.session.commit()
+    token = mocker.patch('src.api_1_0.helpers.mpesa.MPESA.generate_access_token', return_value='mock_token')
+    mocker.patch('src.api_1_0.helpers.mpesa.MPESA.security_credential', return_value='mock_encrypted_password')
+    mocker.patch('src.api_1_0.helpers.mpesa.persistence_worker.submit')
+    post = mocker.patch('src.api_1_0.helpers.transport.transport.post')
+    post.return_value.status_code = 200
+    post.return_value.json.side_effect = lambda: {'ConversationID': 'AG_2', 'OriginatorConversationID': '2'}
+    payload = [{'Amount': '100', 'pnr': 'batch-1'}, {'Amount': '0', 'pnr': 'batch-2'},
+               {'Amount': '100', 'pnr': 'existing'}, {'Amount': '100', 'pnr': 'batch-3'}]
+    response = client.post(
+        '/api/v1.0/payment/initiate/batch',
+        data='\n'.join(json.dumps(item) for item in payload),
+        content_type='application/x-ndjson'
+    )
+    assert response.status_code == 200
+    results = {r['index']: r for r in map(json.loads, response.get_data(as_text=True).splitlines())}
+    assert results[0]['status'] == results[3]['status'] == 201
+    assert results[1]['error'] == '<Amount> cannot be less than or equal to zero.'
+    assert results[2]['status_message'] == 'A similar B2B payment already exists.'
+    assert post.call_count == 2
+    token.assert_called_once()
+
+
+def test_initiate_b2b_payment_batch_with_an_invalid_payload(client):
+    """Test initiate b2b payment batch with a payload that isn't a list."""
+    response = client.post(
+        '/api/v1.0/payment/initiate/batch',
+        json={'Amount': '100', 'pnr': '1234567890'}
+    )
+    assert response.status_code == 400
+    assert response.json == {
+        'error': 'request must be a non-empty list of payments.'
+    }
+
+
+def test_metrics_expose_the_phase_timings(client, database, mocker):
+    """Test the metrics endpoint exposes the initiation phases and outcomes."""
+    database.session.add(B2B(amount=100, pnr='metrics', originator_conversation_id='1', conversation_id='AG_1'))
+    database.session.commit()
+    client.post('/api/v1.0/payment/initiate', json={'Amount': '100', 'pnr': 'metrics'})
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    text = response.get_data(as_text=True)
+    assert 'mpesa_b2b_phase_seconds_count{operation="initiate_b2b",phase="pnr_lookup"}' in text
+    assert 'mpesa_b2b_payments_total{outcome="duplicate_pnr"}' in text
+
+
+def test_profiler_is_disabled_by_default(client):
+    """Test the profiler cannot be started unless enabled."""
+    response = client.post('/metrics/profile?seconds=1')
+    assert response.status_code == 404
+
+
+def test_transaction_status_result_is_applied_like_a_payment_result(client, database, mocker):
+    """Test the status result of a payment is queued for processing, with the payment's conversation IDs."""
+    database.session.add(B2B(amount=100, pnr='status', originator_conversation_id='1', conversation_id='AG_1'))
+    database.session.commit()
+    submit = mocker.patch('src.api_1_0.routes.main.callback_processor.submit')
+    response = client.post('/api/v1.0/payment/status/result', json={'Result': {
+        'ResultCode': 0,
+        'ResultParameters': {'ResultParameter': [{'Key': 'TransactionStatus', 'Value': 'Completed'}]},
+        'ReferenceData': {'ReferenceItem': {'Key': 'Occasion', 'Value': '1'}}
+    }})
+    assert response.status_code == 200
+    submit.assert_called_once()
+    assert submit.call_args.args[0]['ConversationID'] == 'AG_1'
+    assert submit.call_args.args[0]['ResultCode'] == 0
@@ -0,0 +1,65 @@
+import csv
+import io
+import json
+from datetime import datetime
+
+import pytest
+
+from src.api_1_0.models.b2b import B2B, StatusEnum
+
+
+@pytest.fixture
+def transactions(database):
+    """Five transactions, the first three created at the same time."""
+    created_on = [datetime(2024, 1, 1)] * 3 + [datetime(2024, 1, 2), datetime(2024, 1, 3)]
+    for index, created in enumerate(created_on):
+        database.session.add(B2B(amount=100, pnr=f'pnr-{index}', originator_conversation_id=f'{index}',
+                                 conversation_id=f'AG_{index}', created_on=created,
+                                 status=StatusEnum.SUCCESS if index % 2 else StatusEnum.PENDING))
+    database.session.commit()
+
+
+def test_transaction_lookup_by_pnr_or_conversation_id(client, transactions):
+    """Test a transaction can be found by its PNR or either conversation ID."""
+    for reference in ('pnr-1', 'AG_1', '1'):
+        response = client.get(f'/api/v1.0/transactions/{reference}')
+        assert response.status_code == 200
+        assert response.json['pnr'] == 'pnr-1'
+        assert response.json['status'] == 'SUCCESS'
+    assert client.get('/api/v1.0/transactions/unknown').status_code == 404
+
+
+def test_transactions_are_listed_with_keyset_pagination(client, transactions):
+    """Test the pages follow each other, newest first, with ties broken by id."""
+    pnrs, cursor = [], None
+    while True:
+        response = client.get('/api/v1.0/transactions', query_string={'limit': 2, 'cursor': cursor or ''})
+        assert response.status_code == 200
+        pnrs += [item['pnr'] for item in response.json['transactions']]
+        cursor = response.json['next_cursor']
+        if cursor is None:
+            break
+    assert pnrs == ['pnr-4', 'pnr-3', 'pnr-2', 'pnr-1', 'pnr-0']
+
+
+def test_transactions_are_filtered_by_status_and_date(client, transactions):
+    """Test the status and created_on filters, and that invalid ones are rejected."""
+    response = client.get('/api/v1.0/transactions?status=pending&created_from=2024-01-01&created_to=2024-01-03')
+    assert [item['pnr'] for item in response.json['transactions']] == ['pnr-2', 'pnr-0']
+    assert client.get('/api/v1.0/transactions?status=lost').status_code == 400
+    assert client.get('/api/v1.0/transactions?created_from=yesterday').status_code == 400
+    assert client.get('/api/v1.0/transactions?cursor=invalid').status_code == 400
+
+
+def test_transactions_export_streams_csv_and_ndjson(client, transactions, app, mocker):
+    """Test the export as CSV and NDJSON, oldest first, fetched a few rows at a time."""
+    mocker.patch.dict(app.config, {'TRANSACTIONS_EXPORT_YIELD_PER': 2})
+    response = client.get('/api/v1.0/transactions/export?format=csv&status=SUCCESS')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/csv'
+    rows = list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))
+    assert [row['pnr'] for row in rows] == ['pnr-1', 'pnr-3']
+    response = client.get('/api/v1.0/transactions/export?format=ndjson')
+    items = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert [item['pnr'] for item in items] == ['pnr-0', 'pnr-1', 'pnr-2', 'pnr-3', 'pnr-4']
+    assert client.get('/api/v1.0/transactions/export?format=xml').status_code == 400
@@ -1,6 +1,9 @@
 import os
+import click
 from src import create_app, db
 from flask_migrate import Migrate
 
-app = create_app(os.environ.get('FLASK_ENV', 'default'))
+# the `flask` CLI (`db upgrade`, `archive run`...) loads the app within a command, which doesn't need the Daraja
+# secrets; the servers (gunicorn) do, and fail fast without them
+app = create_app(os.environ.get('FLASK_ENV', 'default'), require_daraja=click.get_current_context(silent=True) is None)
 migrate = Migrate(app, db, include_schemas=True)